@@ -1,33 +1,146 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, make_response, jsonify, send_from_directory
-from flask_mail import Mail
+from flask import Flask, render_template, request, redirect, url_for, flash, make_response, jsonify, send_from_directory, Response, abort, stream_with_context, g
 from flask_wtf.csrf import CSRFProtect
 from flask_migrate import Migrate
 from models import db, User, TempUser, Bus, BusStop, Driver, AcademicResource, Event, Alumni, Faculty, Club, \
     ClubMembership, CommunityPost, PostLike, Admin, ChatHistory, PracticeQuestion, UserPreferences, PasswordResetToken, \
-    BusManager, ClubTagRequest, AlumniContactRequest, EventParticipation, AlumniChat, Timetable
+    BusManager, ClubTagRequest, AlumniContactRequest, EventParticipation, AlumniChat, Timetable, SegmentTravelTime, IdentityIndex
 from config import Config
+from utils.password_hashing import PasswordHasherBusy
+from utils.schema import prepare_schema
 from utils.auth import generate_token, generate_session_token, get_expiry_time, is_token_expired
 from utils.email_utils import send_verification_email, send_password_reset_email
-from utils.decorators import login_required, admin_required, driver_required, bus_manager_required, faculty_required, alumni_required, club_leader_required
+from utils.decorators import login_required, admin_required, driver_required, bus_manager_required, faculty_required, alumni_required, club_leader_required, load_principal, session_activity, invalidate_session, issue_session_token, PRINCIPAL_ROLES, revoke_session, PrincipalGlobals
 from utils.gemini_utils import chat_with_ai, generate_practice_questions, check_coding_answer
 from utils.db_context import get_database_context, format_context_for_ai
-from datetime import datetime
+from utils.bus_stream import LocationPublisher, FLEET_CHANNEL, format_sse, stream_events
+from utils.live_location import LiveLocationStore, WriteBehindFlusher, fix_to_dict, parse_fixes, parse_timestamp
+from utils.trajectory import TrajectoryStore, downsample
+from utils.route_progress import RouteProgressEngine
+from utils.eta import EtaEngine, DEFAULT_SPEED_MPS
+from utils.sampling import recommend_interval
+from utils.spatial_index import GridIndex
+from utils.notifications import ArrivalNotifier, user_channel
+from utils.fleet_health import FleetHealthMonitor, HEALTH_CHANNEL
+from utils.route_planner import plan_route
+from utils.expiry_sweeper import ExpirySweeper
+from utils.outbox import EmailOutbox, SMTPConnection
+from utils.digest import DigestMailer, DigestConflict
+from utils.ai_cache import AIResponseCache, make_key
+from utils.roster_import import parse_roster, drop_registered, RosterImportJob, RosterImports
+from utils.route_io import parse_routes_csv, parse_routes_geojson, diff_routes, summarize_diff, apply_diff, export_routes_csv, export_routes_geojson
+from datetime import datetime, timedelta
 import os
 import json
+import math
+import click
+import io
 
 app = Flask(__name__)
 app.config.from_object(Config)
+app.app_ctx_globals_class = PrincipalGlobals
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
 
 db.init_app(app)
-migrate = Migrate(app, db)
+migrate = Migrate(app, db, directory=MIGRATIONS_DIR)
 
-mail = Mail(app)
 csrf = CSRFProtect(app)
+location_publisher = LocationPublisher()
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 with app.app_context():
-    db.create_all()
+    # A database still waiting for its migrations is left alone, and the
+    # background writers below stay stopped so they don't race the upgrade
+    schema_ready = prepare_schema(db, MIGRATIONS_DIR)
+    # Databases created before the identity index existed start with it empty
+    if schema_ready and not IdentityIndex.query.first():
+        IdentityIndex.rebuild()
+
+live_locations = LiveLocationStore()
+write_behind = WriteBehindFlusher(app, app.config['LIVE_LOCATION_FLUSH_INTERVAL'])
+write_behind.register(live_locations)
+trajectory_store = TrajectoryStore()
+write_behind.register(trajectory_store)
+route_progress = RouteProgressEngine()
+write_behind.register(route_progress)
+eta_engine = EtaEngine(route_progress)
+write_behind.register(eta_engine)
+arrival_notifier = ArrivalNotifier(route_progress, location_publisher, eta_engine)
+fleet_health = FleetHealthMonitor(location_publisher, app.config['BUS_STALE_AFTER_SECONDS'], route_progress.off_route_m)
+roster_imports = RosterImports(app)
+# Tracking versions are per process, so clients holding one from before a
+# restart are sent a full state.
+tracking_epoch = os.urandom(4).hex()
+
+def load_stop_points():
+    rows = db.session.query(BusStop.id, BusStop.lat, BusStop.lng, BusStop.stop_name, BusStop.bus_id).all()
+    return [(stop_id, lat, lng, {'stop_name': name, 'bus_id': bus_id}) for stop_id, lat, lng, name, bus_id in rows]
+
+def load_bus_points():
+    points = []
+    for bus_id in live_locations.active_bus_ids():
+        fix = live_locations.get(bus_id)
+        if fix is not None and fix.lat is not None and fix.lng is not None:
+            points.append((bus_id, fix.lat, fix.lng, None))
+    return points
+
+stop_index = GridIndex(loader=load_stop_points)
+bus_index = GridIndex(loader=load_bus_points)
+write_behind.register(session_activity)
+if schema_ready:
+    write_behind.start()
+expiry_sweeper = ExpirySweeper(
+    app, session_activity.models, app.config['EXPIRY_SWEEP_INTERVAL'],
+    app.config['EXPIRY_SWEEP_BATCH_SIZE'], app.config['SESSION_IDLE_TIMEOUT']
+)
+if schema_ready:
+    expiry_sweeper.start()
+
+def smtp_connection():
+    return SMTPConnection(
+        app.config['MAIL_SERVER'], app.config['MAIL_PORT'], app.config['MAIL_USE_TLS'],
+        app.config['MAIL_USE_SSL'], app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD']
+    )
+
+email_outbox = EmailOutbox(
+    app, smtp_connection, app.config['MAIL_DEFAULT_SENDER'], app.config['EMAIL_OUTBOX_WORKERS'],
+    app.config['EMAIL_OUTBOX_BATCH_SIZE'], app.config['EMAIL_OUTBOX_MAX_ATTEMPTS']
+)
+if schema_ready:
+    email_outbox.start()
+digest_mailer = DigestMailer(
+    app, 'email/digest.html', app.config['APP_BASE_URL'].rstrip('/') + '/events', app.config['DIGEST_DAYS']
+)
+ai_cache = AIResponseCache(app.config['AI_CACHE_SIZE'], app.config['AI_CACHE_TTL'], app.config['AI_CACHE_PATH'])
+
+@app.cli.command('send-digest')
+@click.option('--dry-run', is_flag=True, help='Build every digest but queue nothing.')
+def send_digest_command(dry_run):
+    """Queue this week's digest email for every student."""
+    try:
+        stats = digest_mailer.run(dry_run=dry_run)
+    except DigestConflict as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(stats))
+
+@app.context_processor
+def inject_principal():
+    # The identity the view's auth decorator resolved, for templates.
+    return {'principal': getattr(g, 'principal', None)}
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    # Shed sign-in load quickly rather than queueing behind the hashing
+    # pool, so the web workers stay free for everything else.
+    message = 'Too many sign-ins right now. Please try again in a few seconds.'
+    if request.is_json:
+        response = jsonify({'success': False, 'error': message})
+    else:
+        response = make_response(message)
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
 
 @app.route('/')
 def index():
@@ -43,7 +156,7 @@ def signup():
         email = request.form.get('email')
         password = request.form.get('password')
         
-        if User.query.filter_by(email=email).first() or TempUser.query.filter_by(email=email).first():
+        if IdentityIndex.lookup(email, 'user') or TempUser.query.filter_by(email=email).first():
             flash('Email already registered', 'error')
             return redirect(url_for('signup'))
         
@@ -57,10 +170,9 @@ def signup():
         temp_user.set_password(password)
         
         db.session.add(temp_user)
+        send_verification_email(email, verification_token, name)
         db.session.commit()
         
-        send_verification_email(mail, email, verification_token, name)
-        
         flash('Verification email sent! Please check your inbox.', 'success')
         return redirect(url_for('login'))
     
@@ -104,7 +216,8 @@ def login_student():
         password = request.form.get('password')
         force_logout = request.form.get('force_logout', False)
 
-        user_obj = User.query.filter_by(email=email).first()
+        identity = IdentityIndex.lookup(email, 'user')
+        user_obj = db.session.get(User, identity.principal_id) if identity else None
 
         if not user_obj or not user_obj.check_password(password):
             flash('Invalid credentials', 'error')
@@ -114,11 +227,13 @@ def login_student():
             flash('Account is active on another device. Please confirm force logout.', 'warning')
             return render_template('login-student.html', email=email, ask_force=True)
 
-        session_token = generate_session_token()
+        session_token = issue_session_token('user', user_obj.id)
         user_obj.session_token = session_token
         user_obj.login_status = True
+        user_obj.last_seen_at = datetime.utcnow()
         user_obj.last_login_device = request.headers.get('User-Agent', 'Unknown')
         db.session.commit()
+        invalidate_session('user', user_obj.id)
 
         response = make_response(redirect(url_for('dashboard')))
         response.set_cookie('user_id', str(user_obj.id), max_age=30*24*60*60, httponly=True, samesite='Lax')
@@ -129,6 +244,15 @@ def login_student():
 
     return render_template('login-student.html')
 
+# role picked on the form -> (landing endpoint, principal role)
+AUTHORITY_LOGINS = {
+    'faculty': ('faculty_dashboard', 'faculty'),
+    'alumni': ('alumni_dashboard', 'alumni'),
+    'driver': ('driver_panel', 'driver'),
+    'bus_manager': ('bus_manager_dashboard', 'bus_manager'),
+    'club_leader': ('club_leader_dashboard', 'user'),
+}
+
 @app.route('/login-authority', methods=['GET', 'POST'])
 def login_authority():
     if request.method == 'POST':
@@ -138,32 +262,12 @@ def login_authority():
         force_logout = request.form.get('force_logout', False)
 
         user_obj = None
-        redirect_to = None
-        cookie_prefix = None
-
-        if role == 'faculty':
-            user_obj = Faculty.query.filter_by(email=email).first()
-            redirect_to = 'faculty_dashboard'
-            cookie_prefix = 'faculty'
-        elif role == 'alumni':
-            user_obj = Alumni.query.filter_by(email=email).first()
-            redirect_to = 'alumni_dashboard'
-            cookie_prefix = 'alumni'
-        elif role == 'driver':
-            user_obj = Driver.query.filter_by(email=email).first()
-            redirect_to = 'driver_panel'
-            cookie_prefix = 'driver'
-        elif role == 'bus_manager':
-            user_obj = BusManager.query.filter_by(email=email).first()
-            redirect_to = 'bus_manager_dashboard'
-            cookie_prefix = 'bus_manager'
-        elif role == 'club_leader':
-            user_obj = User.query.filter_by(email=email).first()
-            if user_obj and user_obj.led_clubs:
-                redirect_to = 'club_leader_dashboard'
-                cookie_prefix = 'user'
-            else:
-                user_obj = None
+        redirect_to, cookie_prefix = AUTHORITY_LOGINS.get(role, (None, None))
+        if cookie_prefix:
+            identity = IdentityIndex.lookup(email, cookie_prefix, club_leader=role == 'club_leader')
+            if identity:
+                model = PRINCIPAL_ROLES[cookie_prefix][0]
+                user_obj = db.session.get(model, identity.principal_id)
 
         if not user_obj or not user_obj.check_password(password):
             flash('Invalid credentials', 'error')
@@ -173,13 +277,15 @@ def login_authority():
             flash('Account is active on another device. Please confirm force logout.', 'warning')
             return render_template('login-authority.html', role=role, email=email, ask_force=True)
 
-        session_token = generate_session_token()
+        session_token = issue_session_token(cookie_prefix, user_obj.id)
         user_obj.session_token = session_token
         if hasattr(user_obj, 'login_status'):
             user_obj.login_status = True
+            user_obj.last_seen_at = datetime.utcnow()
         if hasattr(user_obj, 'last_login_device'):
             user_obj.last_login_device = request.headers.get('User-Agent', 'Unknown')
         db.session.commit()
+        invalidate_session(cookie_prefix, user_obj.id)
 
         response = make_response(redirect(url_for(redirect_to)))
         response.set_cookie(f'{cookie_prefix}_id', str(user_obj.id), max_age=30*24*60*60, httponly=True, samesite='Lax')
@@ -205,6 +311,7 @@ def login_admin():
         session_token = generate_session_token()
         admin_obj.session_token = session_token
         db.session.commit()
+        invalidate_session('admin', admin_obj.id)
 
         response = make_response(redirect(url_for('admin_dashboard')))
         response.set_cookie('admin_id', str(admin_obj.id), max_age=30*24*60*60, httponly=True, samesite='Lax')
@@ -218,13 +325,13 @@ def login_admin():
 @app.route('/logout')
 @login_required
 def logout():
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
     
     if user:
         user.login_status = False
         user.session_token = None
         db.session.commit()
+        revoke_session('user', user.id)
     
     response = make_response(redirect(url_for('login')))
     response.delete_cookie('user_id')
@@ -247,9 +354,9 @@ def forgot_password():
                 expires_at=get_expiry_time(15)
             )
             db.session.add(password_reset)
+            send_password_reset_email(email, reset_token, user.name)
             db.session.commit()
             
-            send_password_reset_email(mail, email, reset_token, user.name)
             flash('Password reset link sent to your email', 'success')
         else:
             flash('If this email exists, a reset link has been sent', 'info')
@@ -294,8 +401,7 @@ def reset_password(token):
 @login_required
 def dashboard():
     # Get current user from cookie
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
 
     # Count upcoming events (event_date in the future)
     upcoming_events_count = db.session.query(Event.id).filter(Event.event_date >= datetime.utcnow()).count()
@@ -327,8 +433,7 @@ def dashboard():
 @app.route('/profile')
 @login_required
 def profile():
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
     buses = Bus.query.filter_by(is_active=True).all()
     
     bus_stops = {}
@@ -341,8 +446,7 @@ def profile():
 @app.route('/update-profile', methods=['POST'])
 @login_required
 def update_profile():
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
     
     user.course = request.form.get('course')
     user.branch = request.form.get('branch')
@@ -351,19 +455,20 @@ def update_profile():
     
     selected_bus_id = request.form.get('selected_bus_id')
     selected_stop = request.form.get('selected_stop')
+    old_bus_id, old_stop = user.selected_bus_id, user.selected_stop
     
     user.selected_bus_id = int(selected_bus_id) if selected_bus_id else None
     user.selected_stop = selected_stop if selected_stop else None
     
     db.session.commit()
+    arrival_notifier.update_subscription(user.id, old_bus_id, old_stop, user.selected_bus_id, user.selected_stop)
     flash('Profile updated successfully', 'success')
     return redirect(url_for('profile'))
 
 @app.route('/bus-tracking')
 @login_required
 def bus_tracking():
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
     buses = Bus.query.filter_by(is_active=True).all()
     return render_template('bus-tracking.html', user=user, buses=buses)
 
@@ -371,43 +476,251 @@ def bus_tracking():
 @login_required
 @csrf.exempt
 def select_bus():
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
     data = request.get_json()
+    old_bus_id = user.selected_bus_id
     
     user.selected_bus_id = data.get('bus_id')
     db.session.commit()
+    arrival_notifier.update_subscription(user.id, old_bus_id, user.selected_stop, user.selected_bus_id, user.selected_stop)
     
     return jsonify({'message': 'Bus selected successfully'})
 
 @app.route('/bus/<int:bus_id>/data')
 @login_required
 def bus_data(bus_id):
-    bus = Bus.query.get_or_404(bus_id)
-    stops = BusStop.query.filter_by(bus_id=bus_id).order_by(BusStop.stop_order).all()
+    """
+    Full bus state, or with ?since=<version> from an earlier response only
+    what changed after it: the position and ETAs if the bus moved, and the
+    stops whose crossed state changed. Versions the server cannot honour
+    get a full response, marked by 'full': true.
+    """
+    fix = live_locations.get(bus_id)
+    if fix is None:
+        abort(404)
+    
+    since_fix, since_stops = None, None
+    since = request.args.get('since', '').split('.')
+    if len(since) == 3 and since[0] == tracking_epoch:
+        try:
+            since_fix, since_stops = int(since[1]), int(since[2])
+        except ValueError:
+            pass
+    
+    stops_version, changed_stops = route_progress.stop_changes(bus_id, since_stops)
+    version = f"{tracking_epoch}.{fix.seq}.{stops_version}"
+    now = datetime.utcnow()
     
+    if changed_stops is not None and since_fix is not None and since_fix <= fix.seq:
+        delta = {'full': False, 'version': version}
+        if fix.seq > since_fix:
+            delta['location'] = fix_to_dict(fix)
+            delta['etas'] = {
+                stop['stop_id']: stop['eta_seconds']
+                for stop in eta_engine.stops_with_etas(bus_id, fix, now)
+                if stop['eta_seconds'] is not None
+            }
+        if changed_stops:
+            delta['stops'] = changed_stops
+        return jsonify(delta)
+    
+    bus = Bus.query.get_or_404(bus_id)
     return jsonify({
+        'full': True,
+        'version': version,
         'bus_number': bus.bus_number,
-        'current_lat': bus.current_lat,
-        'current_lng': bus.current_lng,
-        'stops': [{
-            'stop_name': stop.stop_name,
-            'lat': stop.lat,
-            'lng': stop.lng,
-            'is_crossed': stop.is_crossed
-        } for stop in stops]
+        'current_lat': fix.lat,
+        'current_lng': fix.lng,
+        'last_updated': fix.recorded_at.isoformat() if fix.recorded_at else None,
+        'stops': eta_engine.stops_with_etas(bus_id, fix, now)
+    })
+
+@app.route('/my-stop/eta')
+@login_required
+def my_stop_eta():
+    user = g.principal
+    
+    if not user.selected_bus_id or not user.selected_stop:
+        return jsonify({'success': False, 'error': 'Select your bus and stop in your profile first'}), 400
+    
+    fix = live_locations.get(user.selected_bus_id)
+    stops = eta_engine.stops_with_etas(user.selected_bus_id, fix, datetime.utcnow())
+    stop = next((stop for stop in stops if stop['stop_name'] == user.selected_stop), None)
+    if not stop:
+        return jsonify({'success': False, 'error': 'Your stop is no longer on this route'}), 404
+    
+    return jsonify({
+        'success': True,
+        'bus_id': user.selected_bus_id,
+        'stop_name': stop['stop_name'],
+        'is_crossed': stop['is_crossed'],
+        'eta': stop['eta'],
+        'eta_seconds': stop['eta_seconds']
     })
 
 @app.route('/bus/<int:bus_id>/location')
 @login_required
 def bus_location(bus_id):
-    bus = Bus.query.get_or_404(bus_id)
+    fix = live_locations.get(bus_id)
+    if fix is None:
+        abort(404)
+    return jsonify(fix_to_dict(fix))
+
+@app.route('/bus/<int:bus_id>/track')
+@login_required
+def bus_track(bus_id):
+    Bus.query.get_or_404(bus_id)
+    
+    try:
+        end = parse_timestamp(request.args['to']) if request.args.get('to') else datetime.utcnow()
+        start = parse_timestamp(request.args['from']) if request.args.get('from') else end.replace(hour=0, minute=0, second=0, microsecond=0)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'from and to must be ISO 8601 timestamps'}), 400
+    
+    if start > end:
+        return jsonify({'success': False, 'error': 'from must be before to'}), 400
+    max_hours = app.config['TRACK_QUERY_MAX_HOURS']
+    if end - start > timedelta(hours=max_hours):
+        return jsonify({'success': False, 'error': f'from and to can be at most {max_hours} hours apart'}), 400
+    
+    points = trajectory_store.points(bus_id, start, end)
+    simplified = downsample(
+        points,
+        tolerance_m=request.args.get('tolerance', default=0, type=float),
+        max_points=request.args.get('max_points', type=int)
+    )
+    
     return jsonify({
-        'lat': bus.current_lat,
-        'lng': bus.current_lng,
-        'last_updated': bus.last_updated.isoformat() if bus.last_updated else None
+        'success': True,
+        'bus_id': bus_id,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'total_points': len(points),
+        'points': [[recorded_at.isoformat(), lat, lng] for recorded_at, lat, lng in simplified]
+    })
+
+@app.route('/buses/locations')
+@login_required
+def fleet_locations():
+    now = datetime.utcnow()
+    stale_after = app.config['BUS_STALE_AFTER_SECONDS']
+    etag = live_locations.snapshot_etag(now, stale_after)
+    
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = jsonify(live_locations.snapshot(now, stale_after))
+    
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def parse_nearby_args():
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    radius = request.args.get('radius', default=500, type=float)
+    limit = max(min(request.args.get('limit', default=20, type=int), 100), 1)
+    if lat is None or lng is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    if not math.isfinite(radius) or radius <= 0:
+        return None
+    return lat, lng, min(radius, 5000), limit
+
+@app.route('/stops/nearby')
+@login_required
+def nearby_stops():
+    args = parse_nearby_args()
+    if args is None:
+        return jsonify({'success': False, 'error': 'Valid lat and lng and a positive radius are required'}), 400
+    lat, lng, radius, limit = args
+    
+    return jsonify({
+        'success': True,
+        'stops': [{
+            'stop_id': stop_id,
+            'stop_name': payload['stop_name'],
+            'bus_id': payload['bus_id'],
+            'lat': stop_lat,
+            'lng': stop_lng,
+            'distance_m': round(distance)
+        } for distance, stop_id, stop_lat, stop_lng, payload in stop_index.nearby(lat, lng, radius, limit)]
+    })
+
+@app.route('/buses/nearby')
+@login_required
+def nearby_buses():
+    args = parse_nearby_args()
+    if args is None:
+        return jsonify({'success': False, 'error': 'Valid lat and lng and a positive radius are required'}), 400
+    lat, lng, radius, limit = args
+    
+    active = set(live_locations.active_bus_ids())
+    buses = []
+    for distance, bus_id, bus_lat, bus_lng, _ in bus_index.nearby(lat, lng, radius):
+        if bus_id not in active:
+            continue
+        fix = live_locations.get(bus_id)
+        buses.append({
+            'bus_id': bus_id,
+            'lat': bus_lat,
+            'lng': bus_lng,
+            'last_updated': fix.recorded_at.isoformat() if fix and fix.recorded_at else None,
+            'distance_m': round(distance)
+        })
+        if len(buses) >= limit:
+            break
+    
+    return jsonify({'success': True, 'buses': buses})
+
+def event_stream_response(stream):
+    return Response(stream, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
     })
 
+@app.route('/bus/<int:bus_id>/stream')
+@login_required
+def bus_stream(bus_id):
+    fix = live_locations.get(bus_id)
+    if fix is None:
+        abort(404)
+    initial = [format_sse('location', dict(fix_to_dict(fix), bus_id=bus_id))]
+    return event_stream_response(stream_events(location_publisher, bus_id, initial=initial))
+
+@app.route('/buses/stream')
+@login_required
+def fleet_stream():
+    initial = [
+        format_sse('location', dict(fix_to_dict(live_locations.get(bus_id)), bus_id=bus_id))
+        for bus_id in live_locations.active_bus_ids()
+    ]
+    return event_stream_response(stream_events(location_publisher, FLEET_CHANNEL, initial=initial))
+
+@app.route('/tracking/stream')
+@login_required
+def tracking_stream():
+    """
+    One stream per student page: approach notifications for the student
+    and, with ?bus_id=, the location and stop events of the tracked bus
+    """
+    user = g.principal
+    channels = [user_channel(user.id)]
+    initial = []
+    
+    bus_id = request.args.get('bus_id', type=int)
+    if bus_id is not None:
+        fix = live_locations.get(bus_id)
+        if fix is None:
+            abort(404)
+        channels.append(bus_id)
+        initial.append(format_sse('location', dict(fix_to_dict(fix), bus_id=bus_id)))
+    
+    if user.selected_bus_id and user.selected_stop:
+        latest = arrival_notifier.latest(user.selected_bus_id, user.selected_stop)
+        if latest is not None:
+            initial.append(format_sse('approaching', latest))
+    return event_stream_response(stream_events(location_publisher, *channels, initial=initial))
+
 @app.route('/driver/login', methods=['GET', 'POST'])
 def driver_login():
     if request.method == 'POST':
@@ -419,6 +732,7 @@ def driver_login():
         if not driver or not driver.check_password(password):
             flash('Invalid credentials', 'error')
             return redirect(url_for('driver_login'))
+        db.session.commit()  # keeps a password hash upgraded by check_password
         
         response = make_response(redirect(url_for('driver_panel')))
         response.set_cookie('driver_id', str(driver.id), max_age=24*60*60)
@@ -431,35 +745,89 @@ def driver_login():
 @app.route('/driver/panel')
 @driver_required
 def driver_panel():
-    driver_id = request.cookies.get('driver_id')
-    driver = Driver.query.get(driver_id)
+    driver = load_principal('driver')
     return render_template('driver.html', driver=driver)
 
 @app.route('/driver/toggle-location', methods=['POST'])
 @driver_required
 @csrf.exempt
 def toggle_location():
-    driver_id = request.cookies.get('driver_id')
-    driver = Driver.query.get(driver_id)
-    driver.is_sharing_location = not driver.is_sharing_location
+    driver = load_principal('driver')
+    data = request.get_json(silent=True) or {}
+    # An explicit state keeps a reloaded driver page from flipping it back.
+    if 'sharing' in data:
+        driver.is_sharing_location = bool(data['sharing'])
+    else:
+        driver.is_sharing_location = not driver.is_sharing_location
     db.session.commit()
+    fleet_health.set_sharing(driver.id, driver.is_sharing_location)
     return jsonify({'status': driver.is_sharing_location})
 
+def ingest_fixes(bus_id, fixes):
+    """
+    Apply time-ordered (lat, lng, recorded_at) fixes for one bus. Every fix
+    goes into the trajectory history; only fixes newer than the current
+    live position advance route progress, and only the newest of them
+    becomes the live position that is published.
+    """
+    current = live_locations.get(bus_id)
+    newest = None
+    offset = None
+    stops_changed = False
+    
+    for lat, lng, recorded_at in fixes:
+        trajectory_store.append(bus_id, lat, lng, recorded_at)
+        if current is not None and current.recorded_at and recorded_at <= current.recorded_at:
+            continue
+        
+        progress = route_progress.update(bus_id, lat, lng)
+        if progress.crossed:
+            eta_engine.record_crossings(bus_id, progress.crossed, recorded_at)
+        if progress.completed:
+            eta_engine.finish_trip(bus_id)
+        stops_changed = stops_changed or bool(progress.crossed) or progress.completed
+        newest = (lat, lng, recorded_at)
+        offset = progress.offset
+    
+    if newest is None:
+        fleet_health.record_report(bus_id)
+        return None
+    
+    fix = live_locations.record(bus_id, *newest)
+    bus_index.insert(bus_id, fix.lat, fix.lng)
+    location_publisher.publish_location(bus_id, fix_to_dict(fix))
+    arrival_notifier.check(bus_id, fix)
+    fleet_health.record_report(bus_id, fix, offset)
+    if stops_changed:
+        location_publisher.publish(bus_id, 'stops', {
+            'bus_id': bus_id,
+            'stops': route_progress.stops(bus_id)
+        })
+    return fix
+
 @app.route('/driver/update-location', methods=['POST'])
 @driver_required
 @csrf.exempt
 def update_location():
     driver_id = request.cookies.get('driver_id')
-    driver = Driver.query.get(driver_id)
-    data = request.get_json()
-    
-    if driver.bus:
-        driver.bus.current_lat = data.get('lat')
-        driver.bus.current_lng = data.get('lng')
-        driver.bus.last_updated = datetime.utcnow()
-        db.session.commit()
+    fixes, rejected = parse_fixes(request.get_json(silent=True), datetime.utcnow())
+    
+    if not fixes:
+        return jsonify({'success': False, 'error': 'No valid fixes in request', 'rejected': rejected}), 400
+    
+    bus_id = live_locations.bus_for_driver(driver_id)
+    next_interval = app.config['DRIVER_MAX_REPORT_INTERVAL']
+    if bus_id:
+        ingest_fixes(bus_id, fixes)
+        next_interval = recommend_interval(
+            live_locations.speed(bus_id),
+            route_progress.distance_to_next_stop(bus_id),
+            location_publisher.subscriber_count(bus_id) + location_publisher.subscriber_count(FLEET_CHANNEL),
+            min_interval=app.config['DRIVER_MIN_REPORT_INTERVAL'],
+            max_interval=app.config['DRIVER_MAX_REPORT_INTERVAL']
+        )
     
-    return jsonify({'success': True})
+    return jsonify({'success': True, 'accepted': len(fixes), 'rejected': rejected, 'next_interval': next_interval})
 
 @app.route('/driver/logout')
 def driver_logout():
@@ -472,8 +840,7 @@ def driver_logout():
 @app.route('/academic-resources')
 @login_required
 def academic_resources():
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
     # Query the database for a list of unique subjects
     # The 'subject' field is what we want to display on the cards
     # Use SQLAlchemy's distinct() method to get unique values
@@ -486,8 +853,7 @@ def academic_resources():
 @app.route('/academic-resources/<string:subject_name>')
 @login_required
 def subject_resources(subject_name):
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
     # This is the new route for the sub-page
     # Query all resources that match the given subject name
     resources = AcademicResource.query.filter_by(subject=subject_name).all()
@@ -515,8 +881,7 @@ def download_resource(resource_id):
 @app.route('/events')
 @login_required
 def events():
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
     now = datetime.utcnow()
 
     # 1. Query for the single highlighted upcoming event
@@ -547,16 +912,14 @@ def events():
 @app.route('/alumni')
 @login_required
 def alumni():
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
     alumni_list = Alumni.query.all()
     return render_template('alumni.html', alumni=alumni_list, user=user)
 
 @app.route('/faculty')
 @login_required
 def faculty():
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
     faculty_list = Faculty.query.all()
     return render_template('faculty.html', faculty=faculty_list, user=user)
 
@@ -578,8 +941,8 @@ def faculty_profile(faculty_id):
 @app.route('/community')
 @login_required
 def community():
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
+    user_id = user.id
     posts = CommunityPost.query.order_by(CommunityPost.created_at.desc()).all()
     
     user_liked_posts = set()
@@ -592,7 +955,7 @@ def community():
 @app.route('/create-post', methods=['POST'])
 @login_required
 def create_post():
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     content = request.form.get('content')
     post_type = request.form.get('post_type')
     
@@ -617,7 +980,7 @@ def create_post():
 @app.route('/post/<int:post_id>/like', methods=['POST'])
 @login_required
 def like_post(post_id):
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     post = CommunityPost.query.get_or_404(post_id)
     
     existing_like = PostLike.query.filter_by(user_id=user_id, post_id=post_id).first()
@@ -639,8 +1002,7 @@ def like_post(post_id):
 @app.route('/clubs')
 @login_required
 def clubs():
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
 
     clubs_list = Club.query.options(
         db.joinedload(Club.memberships),
@@ -659,8 +1021,8 @@ def clubs():
 @app.route('/club/<int:club_id>')
 @login_required
 def club_detail(club_id):
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
+    user_id = user.id
     
     club = Club.query.options(
         db.joinedload(Club.memberships).joinedload(ClubMembership.user),
@@ -682,7 +1044,7 @@ def club_detail(club_id):
 @login_required
 @csrf.exempt
 def join_club(club_id):
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     
     existing = ClubMembership.query.filter_by(user_id=user_id, club_id=club_id).first()
     if existing:
@@ -698,7 +1060,7 @@ def join_club(club_id):
 @login_required
 @csrf.exempt
 def leave_club(club_id):
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     
     membership = ClubMembership.query.filter_by(user_id=user_id, club_id=club_id).first()
     if not membership:
@@ -720,6 +1082,7 @@ def admin_login():
         if not admin or not admin.check_password(password):
             flash('Invalid credentials', 'error')
             return redirect(url_for('admin_login'))
+        db.session.commit()  # keeps a password hash upgraded by check_password
         
         response = make_response(redirect(url_for('admin_dashboard')))
         response.set_cookie('admin_id', str(admin.id), max_age=24*60*60)
@@ -819,6 +1182,82 @@ def manage_alumni():
     alumni_list = Alumni.query.all()
     return render_template('admin/manage-alumni.html', alumni_list=alumni_list)
 
+@app.route('/admin/students/import', methods=['POST'])
+@admin_required
+@csrf.exempt
+def import_students():
+    """
+    Create student accounts from an uploaded CSV roster. Rows are checked
+    up front and the accounts are created by a background job; poll the
+    returned status URL for progress. Send dry_run=1 to only validate.
+    """
+    file = request.files.get('file')
+    if file is None or not file.filename:
+        return jsonify({'success': False, 'error': 'Upload a CSV roster'}), 400
+    
+    lines = io.TextIOWrapper(file.stream, encoding='utf-8-sig', errors='replace', newline='')
+    rows, errors = parse_roster(lines)
+    rows, registered = drop_registered(rows)
+    errors.extend(registered)
+    
+    if request.values.get('dry_run') in ('1', 'true'):
+        return jsonify({'success': True, 'applied': False, 'valid': len(rows), 'errors': errors})
+    if not rows:
+        return jsonify({'success': False, 'error': 'No new students in file', 'errors': errors}), 400
+    
+    job = roster_imports.submit(RosterImportJob(
+        rows, errors, app.config['PASSWORD_HASH_METHOD'],
+        url_for('reset_password', token='', _external=True),
+        app.config['ROSTER_IMPORT_BATCH_SIZE'], app.config['ROSTER_IMPORT_WORKERS'],
+        app.config['ROSTER_INVITE_EXPIRY_HOURS']
+    ))
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': url_for('student_import_status', job_id=job.id),
+        'valid': len(rows),
+        'errors': errors
+    }), 202
+
+@app.route('/admin/students/import/<job_id>')
+@admin_required
+def student_import_status(job_id):
+    job = roster_imports.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Unknown import'}), 404
+    return jsonify({'success': True, 'job': job.progress()})
+
+@app.route('/admin/maintenance/sweeper')
+@admin_required
+def sweeper_stats():
+    return jsonify({'success': True, 'sweeper': expiry_sweeper.stats()})
+
+@app.route('/admin/maintenance/outbox')
+@admin_required
+def outbox_stats():
+    return jsonify({'success': True, 'outbox': email_outbox.stats()})
+
+@app.route('/admin/maintenance/ai-cache')
+@admin_required
+def ai_cache_stats():
+    return jsonify({'success': True, 'ai_cache': ai_cache.stats()})
+
+@app.route('/admin/digest', methods=['GET', 'POST'])
+@admin_required
+@csrf.exempt
+def admin_digest():
+    if request.method == 'POST':
+        dry_run = request.values.get('dry_run') in ('1', 'true')
+        if not dry_run:
+            try:
+                digest_mailer.check()
+            except DigestConflict as e:
+                return jsonify({'success': False, 'error': str(e)}), 409
+        if not digest_mailer.run_in_background(dry_run=dry_run):
+            return jsonify({'success': False, 'error': 'A digest run is already in progress'}), 409
+        return jsonify({'success': True, 'started': True, 'dry_run': dry_run}), 202
+    return jsonify({'success': True, 'digest': digest_mailer.status()})
+
 @app.route('/admin/manage/clubs', methods=['GET', 'POST'])
 @admin_required
 def manage_clubs():
@@ -861,8 +1300,7 @@ def manage_clubs():
 @app.route('/ai-teacher')
 @login_required
 def ai_teacher():
-    user_id = request.cookies.get('user_id')
-    user = User.query.get(user_id)
+    user = g.principal
     return render_template('ai-teacher.html', user=user)
 
 @app.route('/api/chat', methods=['POST'])
@@ -873,9 +1311,8 @@ def api_chat():
         data = request.get_json()
         message = data.get('message')
         mode = data.get('mode', 'normal')
-        user_id = request.cookies.get('user_id')
-        
-        user = User.query.get(user_id)
+        user = g.principal
+        user_id = user.id
         user_context = {
             'name': user.name,
             'course': user.course,
@@ -890,7 +1327,13 @@ def api_chat():
         if db_context_text:
             enhanced_message = f"{message}\n{db_context_text}"
         
-        ai_response = chat_with_ai(enhanced_message, mode, user_context)
+        # Only the counseling prompt uses the student's details, so other
+        # modes share answers between students asking the same thing
+        cache_key = make_key('chat', mode, message, db_context_text, user_context if mode == 'counseling' else None)
+        ai_response = ai_cache.get_or_call(
+            cache_key, lambda: chat_with_ai(enhanced_message, mode, user_context),
+            cacheable=lambda response: not response.startswith(('Error communicating with AI', "I'm sorry"))
+        )
         
         chat_entry = ChatHistory(
             user_id=user_id,
@@ -932,7 +1375,12 @@ def api_get_questions():
         question_type = data.get('type', 'coding')
         difficulty = data.get('difficulty', 'medium')
         
-        question_data = generate_practice_questions(subject, question_type, difficulty)
+        question_data = ai_cache.get_or_call(
+            make_key('practice', question_type, subject, difficulty),
+            lambda: generate_practice_questions(subject, question_type, difficulty),
+            ttl=app.config['AI_PRACTICE_CACHE_TTL'], variants=app.config['AI_PRACTICE_VARIANTS'],
+            cacheable=lambda question: 'error' not in question
+        )
         
         return jsonify({
             'success': True,
@@ -972,7 +1420,7 @@ def api_check_answer():
 @login_required
 def api_chat_history():
     try:
-        user_id = request.cookies.get('user_id')
+        user_id = g.principal_id
         history = ChatHistory.query.filter_by(user_id=user_id).order_by(ChatHistory.timestamp.desc()).limit(50).all()
         
         history_data = [{
@@ -998,12 +1446,22 @@ def api_chat_history():
 @app.route('/bus-manager/dashboard')
 @bus_manager_required
 def bus_manager_dashboard():
-    bus_manager_id = request.cookies.get('bus_manager_id')
-    bus_manager = BusManager.query.get(bus_manager_id)
+    bus_manager = g.principal
     buses = Bus.query.all()
     drivers = Driver.query.all()
     return render_template('bus-manager-dashboard.html', bus_manager=bus_manager, buses=buses, drivers=drivers)
 
+@app.route('/bus-manager/fleet-health')
+@bus_manager_required
+def fleet_health_view():
+    return jsonify(fleet_health.snapshot())
+
+@app.route('/bus-manager/fleet-health/stream')
+@bus_manager_required
+def fleet_health_stream():
+    initial = [format_sse('snapshot', fleet_health.snapshot())]
+    return event_stream_response(stream_events(location_publisher, HEALTH_CHANNEL, initial=initial))
+
 # CLUB LEADER ROUTES
 @app.route('/club-leader/dashboard')
 def club_leader_dashboard():
@@ -1027,6 +1485,8 @@ def manage_bus():
         bus = Bus(bus_number=data.get('bus_number'), route_description=data.get('route_description'), is_active=True)
         db.session.add(bus)
         db.session.commit()
+        live_locations.forget_active()
+        fleet_health.reset()
         return jsonify({'success': True, 'bus_id': bus.id})
     elif action == 'update':
         bus = Bus.query.get(data.get('bus_id'))
@@ -1034,16 +1494,147 @@ def manage_bus():
             bus.is_active = data.get('is_active', bus.is_active)
             bus.driver_id = data.get('driver_id', bus.driver_id)
             db.session.commit()
+            live_locations.forget_drivers()
+            live_locations.forget_active()
+            fleet_health.reset()
             return jsonify({'success': True})
     elif action == 'delete':
         bus = Bus.query.get(data.get('bus_id'))
         if bus:
+            stop_ids = [stop.id for stop in bus.stops]
             db.session.delete(bus)
             db.session.commit()
+            for stop_id in stop_ids:
+                stop_index.remove(stop_id)
+            bus_index.remove(bus.id)
+            live_locations.forget_bus(bus.id)
+            live_locations.forget_active()
+            trajectory_store.forget_bus(bus.id)
+            route_progress.invalidate(bus.id)
+            eta_engine.forget_bus(bus.id)
+            arrival_notifier.forget_bus(bus.id)
+            fleet_health.forget_bus(bus.id)
             return jsonify({'success': True})
     
     return jsonify({'success': False, 'error': 'Invalid action'})
 
+@app.route('/bus-manager/plan-route', methods=['POST'])
+@bus_manager_required
+@csrf.exempt
+def plan_bus_route():
+    """
+    Suggest a stop order for a bus's current stops, or for candidate stops
+    sent as [{stop_name, lat, lng}], keeping the first stop first. Apply a
+    suggestion for existing stops with the reorder_stops route action.
+    """
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        speed_mps = float(data.get('speed_mps') or DEFAULT_SPEED_MPS)
+    except (TypeError, ValueError):
+        speed_mps = None
+    if speed_mps is None or not math.isfinite(speed_mps) or speed_mps <= 0:
+        return jsonify({'success': False, 'error': 'speed_mps must be a positive number'}), 400
+    
+    if data.get('stops'):
+        try:
+            stops = [{
+                'stop_id': stop.get('stop_id'),
+                'stop_name': stop.get('stop_name'),
+                'lat': float(stop['lat']),
+                'lng': float(stop['lng'])
+            } for stop in data['stops']]
+        except (AttributeError, KeyError, TypeError, ValueError):
+            stops = None
+        # comparisons with nan are false, so this also rejects nan and inf
+        if stops is None or not all(-90 <= stop['lat'] <= 90 and -180 <= stop['lng'] <= 180 for stop in stops):
+            return jsonify({'success': False, 'error': 'Every stop needs a valid lat and lng'}), 400
+    elif data.get('bus_id'):
+        stops = [{
+            'stop_id': stop.id,
+            'stop_name': stop.stop_name,
+            'lat': stop.lat,
+            'lng': stop.lng
+        } for stop in BusStop.query.filter_by(bus_id=data['bus_id']).order_by(BusStop.stop_order)]
+    else:
+        return jsonify({'success': False, 'error': 'Provide a bus_id or a list of stops'}), 400
+    
+    plan = plan_route(
+        [stop['lat'] for stop in stops],
+        [stop['lng'] for stop in stops],
+        round_trip=bool(data.get('round_trip')),
+        speed_mps=speed_mps
+    )
+    return jsonify({
+        'success': True,
+        'stops': [stops[i] for i in plan['order']],
+        'length_m': round(plan['length_m']),
+        'original_length_m': round(plan['original_length_m']),
+        'estimated_seconds': round(plan['estimated_seconds'])
+    })
+
+@app.route('/bus-manager/routes/import', methods=['POST'])
+@bus_manager_required
+@csrf.exempt
+def import_routes():
+    """
+    Replace the stops of every bus in an uploaded CSV or GeoJSON file in
+    one transaction, creating buses that do not exist yet. Send dry_run=1
+    to only see the diff.
+    """
+    file = request.files.get('file')
+    if file is not None and file.filename:
+        content = file.read().decode('utf-8-sig', errors='replace')
+        is_geojson = file.filename.lower().endswith(('.geojson', '.json'))
+    elif request.is_json:
+        content = request.get_data(as_text=True)
+        is_geojson = True
+    else:
+        return jsonify({'success': False, 'error': 'Upload a CSV or GeoJSON file'}), 400
+    
+    if is_geojson:
+        try:
+            routes, errors = parse_routes_geojson(json.loads(content))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Invalid GeoJSON'}), 400
+    else:
+        routes, errors = parse_routes_csv(content)
+    
+    if errors:
+        return jsonify({'success': False, 'error': 'Some rows are invalid', 'rows': errors}), 400
+    if not routes:
+        return jsonify({'success': False, 'error': 'No stops in file'}), 400
+    
+    diff, buses = diff_routes(routes)
+    summary = summarize_diff(diff)
+    if request.values.get('dry_run') in ('1', 'true'):
+        return jsonify({'success': True, 'applied': False, 'diff': summary})
+    
+    try:
+        changed_bus_ids = apply_diff(diff, buses)
+    except Exception as e:
+        print(f"Error importing routes: {e}")
+        return jsonify({'success': False, 'error': 'Import failed, nothing was changed'}), 500
+    
+    for bus_id in changed_bus_ids:
+        route_progress.invalidate(bus_id)
+    stop_index.reset()
+    if diff['new_buses']:
+        live_locations.forget_active()
+        fleet_health.reset()
+    return jsonify({'success': True, 'applied': True, 'diff': summary})
+
+@app.route('/bus-manager/routes/export')
+@bus_manager_required
+def export_routes():
+    if request.args.get('format') == 'geojson':
+        return Response(stream_with_context(export_routes_geojson()), mimetype='application/geo+json', headers={
+            'Content-Disposition': 'attachment; filename=routes.geojson'
+        })
+    return Response(stream_with_context(export_routes_csv()), mimetype='text/csv', headers={
+        'Content-Disposition': 'attachment; filename=routes.csv'
+    })
+
 @app.route('/bus-manager/manage-driver', methods=['POST'])
 @bus_manager_required
 @csrf.exempt
@@ -1062,6 +1653,8 @@ def manage_driver():
         if driver:
             db.session.delete(driver)
             db.session.commit()
+            live_locations.forget_drivers()
+            fleet_health.reset()
             return jsonify({'success': True})
     elif action == 'assign_bus':
         driver = Driver.query.get(data.get('driver_id'))
@@ -1071,6 +1664,8 @@ def manage_driver():
             if bus:
                 bus.driver_id = driver.id
             db.session.commit()
+            live_locations.forget_drivers()
+            fleet_health.reset()
             return jsonify({'success': True})
     
     return jsonify({'success': False, 'error': 'Invalid action'})
@@ -1092,13 +1687,34 @@ def manage_route():
         )
         db.session.add(stop)
         db.session.commit()
+        route_progress.invalidate(stop.bus_id)
+        stop_index.insert(stop.id, stop.lat, stop.lng, {'stop_name': stop.stop_name, 'bus_id': stop.bus_id})
         return jsonify({'success': True, 'stop_id': stop.id})
     elif action == 'remove_stop':
         stop = BusStop.query.get(data.get('stop_id'))
         if stop:
+            bus_id = stop.bus_id
+            SegmentTravelTime.query.filter(db.or_(
+                SegmentTravelTime.from_stop_id == stop.id,
+                SegmentTravelTime.to_stop_id == stop.id
+            )).delete(synchronize_session=False)
+            stop_id = stop.id
             db.session.delete(stop)
             db.session.commit()
+            route_progress.invalidate(bus_id)
+            stop_index.remove(stop_id)
+            return jsonify({'success': True})
+    elif action == 'reorder_stops':
+        stops = BusStop.query.filter_by(bus_id=data.get('bus_id')).all()
+        stop_ids = data.get('stop_ids') or []
+        by_id = {stop.id: stop for stop in stops}
+        if stops and sorted(stop_ids) == sorted(by_id):
+            for order, stop_id in enumerate(stop_ids, start=1):
+                by_id[stop_id].stop_order = order
+            db.session.commit()
+            route_progress.invalidate(stops[0].bus_id)
             return jsonify({'success': True})
+        return jsonify({'success': False, 'error': 'stop_ids must list every stop of the bus exactly once'})
     elif action == 'update_time':
         bus = Bus.query.get(data.get('bus_id'))
         if bus:
@@ -1113,7 +1729,7 @@ def manage_route():
 @login_required
 @csrf.exempt
 def request_club_tag():
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     data = request.get_json()
     
     club_id = data.get('club_id')
@@ -1131,7 +1747,7 @@ def request_club_tag():
 @app.route('/club-leader/tag-requests')
 @club_leader_required
 def view_tag_requests():
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     clubs = Club.query.filter_by(secretary_id=user_id).all()
     
     requests = []
@@ -1152,7 +1768,7 @@ def view_tag_requests():
 @club_leader_required
 @csrf.exempt
 def review_tag_request():
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     data = request.get_json()
     
     tag_request = ClubTagRequest.query.get(data.get('request_id'))
@@ -1175,7 +1791,7 @@ def review_tag_request():
 @login_required
 @csrf.exempt
 def request_alumni_contact():
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     data = request.get_json()
     
     alumni_id = data.get('alumni_id')
@@ -1194,7 +1810,7 @@ def request_alumni_contact():
 @app.route('/alumni/contact-requests')
 @alumni_required
 def view_contact_requests():
-    alumni_id = request.cookies.get('alumni_id')
+    alumni_id = g.principal_id
     requests = AlumniContactRequest.query.filter_by(alumni_id=alumni_id, status='pending').all()
     
     return jsonify({
@@ -1212,7 +1828,7 @@ def view_contact_requests():
 @alumni_required
 @csrf.exempt
 def review_contact_request():
-    alumni_id = request.cookies.get('alumni_id')
+    alumni_id = g.principal_id
     data = request.get_json()
     
     contact_request = AlumniContactRequest.query.get(data.get('request_id'))
@@ -1230,7 +1846,7 @@ def review_contact_request():
 @alumni_required
 @csrf.exempt
 def alumni_send_message():
-    alumni_id = request.cookies.get('alumni_id')
+    alumni_id = g.principal_id
     data = request.get_json()
     
     student_id = data.get('student_id')
@@ -1249,7 +1865,7 @@ def alumni_send_message():
 @login_required
 @csrf.exempt
 def student_send_alumni_message():
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     data = request.get_json()
     
     alumni_id = data.get('alumni_id')
@@ -1267,7 +1883,7 @@ def student_send_alumni_message():
 @app.route('/alumni/chat/<int:student_id>')
 @alumni_required
 def get_alumni_chat(student_id):
-    alumni_id = request.cookies.get('alumni_id')
+    alumni_id = g.principal_id
     messages = AlumniChat.query.filter_by(alumni_id=alumni_id, student_id=student_id).order_by(AlumniChat.timestamp).all()
     
     return jsonify({
@@ -1284,7 +1900,7 @@ def get_alumni_chat(student_id):
 @app.route('/student/chat/<int:alumni_id>')
 @login_required
 def get_student_chat(alumni_id):
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     messages = AlumniChat.query.filter_by(alumni_id=alumni_id, student_id=user_id).order_by(AlumniChat.timestamp).all()
     
     return jsonify({
@@ -1303,7 +1919,7 @@ def get_student_chat(alumni_id):
 @club_leader_required
 @csrf.exempt
 def create_club_event():
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     data = request.get_json()
     
     club = Club.query.filter_by(secretary_id=user_id).first()
@@ -1331,7 +1947,7 @@ def create_club_event():
 @login_required
 @csrf.exempt
 def enroll_event():
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     data = request.get_json()
     
     event_id = data.get('event_id')
@@ -1354,7 +1970,7 @@ def enroll_event():
 @app.route('/club-leader/event-participants/<int:event_id>')
 @club_leader_required
 def view_event_participants(event_id):
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     event = Event.query.get(event_id)
     
     if not event or event.created_by != int(user_id):
@@ -1378,7 +1994,7 @@ def view_event_participants(event_id):
 @club_leader_required
 @csrf.exempt
 def review_participant():
-    user_id = request.cookies.get('user_id')
+    user_id = g.principal_id
     data = request.get_json()
     
     participation = EventParticipation.query.get(data.get('participation_id'))
@@ -1396,7 +2012,7 @@ def review_participant():
 @faculty_required
 @csrf.exempt
 def update_timetable():
-    faculty_id = request.cookies.get('faculty_id')
+    faculty_id = g.principal_id
     data = request.get_json()
     
     action = data.get('action')
@@ -1423,7 +2039,7 @@ def update_timetable():
 @app.route('/faculty/upload-resource', methods=['POST'])
 @faculty_required
 def upload_faculty_resource():
-    faculty_id = request.cookies.get('faculty_id')
+    faculty_id = g.principal_id
     
     if 'file' not in request.files:
         return jsonify({'success': False, 'error': 'No file provided'})
@@ -1455,8 +2071,7 @@ def upload_faculty_resource():
 @faculty_required
 @csrf.exempt
 def update_faculty_profile():
-    faculty_id = request.cookies.get('faculty_id')
-    faculty = Faculty.query.get(faculty_id)
+    faculty = g.principal
     data = request.get_json()
     
     faculty.bio = data.get('bio', faculty.bio)
@@ -1472,8 +2087,7 @@ def update_faculty_profile():
 @alumni_required
 @csrf.exempt
 def update_alumni_profile():
-    alumni_id = request.cookies.get('alumni_id')
-    alumni = Alumni.query.get(alumni_id)
+    alumni = g.principal
     data = request.get_json()
     
     alumni.current_designation = data.get('current_designation', alumni.current_designation)
@@ -1486,7 +2100,7 @@ def update_alumni_profile():
 @app.route('/alumni/notifications')
 @alumni_required
 def get_alumni_notifications():
-    alumni_id = request.cookies.get('alumni_id')
+    alumni_id = g.principal_id
     
     pending_requests = AlumniContactRequest.query.filter_by(alumni_id=alumni_id, status='pending').all()
     unread_chats = AlumniChat.query.filter_by(alumni_id=alumni_id, sender_type='student', is_read=False).count()
@@ -7,16 +7,62 @@ class Config:
     SQLALCHEMY_DATABASE_URI = 'sqlite:///database.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
-    MAIL_SERVER = 'smtp.gmail.com'
-    MAIL_PORT = 587
-    MAIL_USE_TLS = True
-    MAIL_USE_SSL = False
+    # Point MAIL_SERVER/MAIL_PORT at a local SMTP stand-in with TLS off to
+    # test email without sending any
+    MAIL_SERVER = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
+    MAIL_PORT = int(os.environ.get('MAIL_PORT', 587))
+    MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS', '1') == '1'
+    MAIL_USE_SSL = os.environ.get('MAIL_USE_SSL', '0') == '1'
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
-    MAIL_DEFAULT_SENDER = os.environ.get('MAIL_USERNAME')
+    MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER') or os.environ.get('MAIL_USERNAME')
+    EMAIL_OUTBOX_WORKERS = int(os.environ.get('EMAIL_OUTBOX_WORKERS', 2))
+    EMAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('EMAIL_OUTBOX_BATCH_SIZE', 20))
+    EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS', 6))
 
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
     UPLOAD_FOLDER = 'static/uploads'
     ALLOWED_EXTENSIONS = {
         'pdf', 'doc', 'docx', 'ppt', 'pptx', 'jpg', 'jpeg', 'png'
     }
+
+    LIVE_LOCATION_FLUSH_INTERVAL = int(os.environ.get('LIVE_LOCATION_FLUSH_INTERVAL', 10))
+    BUS_STALE_AFTER_SECONDS = int(os.environ.get('BUS_STALE_AFTER_SECONDS', 120))
+    # Longest span one /bus/<id>/track request may cover
+    TRACK_QUERY_MAX_HOURS = int(os.environ.get('TRACK_QUERY_MAX_HOURS', 24))
+    DRIVER_MIN_REPORT_INTERVAL = int(os.environ.get('DRIVER_MIN_REPORT_INTERVAL', 3))
+    DRIVER_MAX_REPORT_INTERVAL = int(os.environ.get('DRIVER_MAX_REPORT_INTERVAL', 60))
+
+    SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000))
+    SESSION_CACHE_TTL = int(os.environ.get('SESSION_CACHE_TTL', 60))
+
+    # 'random' tokens are checked against the database; 'signed' tokens are
+    # HMAC-signed and verified in memory (see utils/signed_sessions.py)
+    SESSION_TOKEN_MODE = os.environ.get('SESSION_TOKEN_MODE', 'random')
+    SESSION_TOKEN_MAX_AGE = int(os.environ.get('SESSION_TOKEN_MAX_AGE', 30 * 24 * 60 * 60))
+    SESSION_GENERATION_REFRESH = int(os.environ.get('SESSION_GENERATION_REFRESH', 5))
+
+    # Stored hashes made with another method are upgraded on the next login
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', max((os.cpu_count() or 2) // 2, 1)))
+    PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 32))
+
+    ROSTER_IMPORT_BATCH_SIZE = int(os.environ.get('ROSTER_IMPORT_BATCH_SIZE', 1000))
+    ROSTER_IMPORT_WORKERS = int(os.environ.get('ROSTER_IMPORT_WORKERS', os.cpu_count() or 2))
+    ROSTER_INVITE_EXPIRY_HOURS = int(os.environ.get('ROSTER_INVITE_EXPIRY_HOURS', 72))
+
+    EXPIRY_SWEEP_INTERVAL = int(os.environ.get('EXPIRY_SWEEP_INTERVAL', 300))
+    EXPIRY_SWEEP_BATCH_SIZE = int(os.environ.get('EXPIRY_SWEEP_BATCH_SIZE', 500))
+    SESSION_IDLE_TIMEOUT = int(os.environ.get('SESSION_IDLE_TIMEOUT', 7 * 24 * 60 * 60))
+
+    # Used for links in email sent outside a request, such as the digest
+    APP_BASE_URL = os.environ.get('APP_BASE_URL', 'http://localhost:5000')
+    DIGEST_DAYS = int(os.environ.get('DIGEST_DAYS', 7))
+
+    AI_CACHE_SIZE = int(os.environ.get('AI_CACHE_SIZE', 2048))
+    AI_CACHE_TTL = int(os.environ.get('AI_CACHE_TTL', 60 * 60))
+    AI_PRACTICE_CACHE_TTL = int(os.environ.get('AI_PRACTICE_CACHE_TTL', 10 * 60))
+    # distinct questions collected per subject/type/difficulty before repeats
+    AI_PRACTICE_VARIANTS = int(os.environ.get('AI_PRACTICE_VARIANTS', 3))
+    # SQLite file that keeps cached responses across restarts; unset keeps them in memory only
+    AI_CACHE_PATH = os.environ.get('AI_CACHE_PATH')
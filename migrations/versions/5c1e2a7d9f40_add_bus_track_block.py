@@ -0,0 +1,37 @@
+"""Add bus track blocks
+
+Revision ID: 5c1e2a7d9f40
+Revises: 3bd154ad0510
+Create Date: 2026-10-18 09:12:41.503218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e2a7d9f40'
+down_revision = '3bd154ad0510'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # app.py used to create_all() at startup, so the table may already exist
+    if sa.inspect(op.get_bind()).has_table('bus_track_block'):
+        return
+
+    op.create_table('bus_track_block',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('bus_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('point_count', sa.Integer(), nullable=True),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['bus_id'], ['bus.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('bus_id', 'day', name='unique_bus_track_day')
+    )
+
+
+def downgrade():
+    op.drop_table('bus_track_block')
@@ -0,0 +1,39 @@
+"""Add digest runs
+
+Revision ID: a7d3c5e91f02
+Revises: f2c6e9b1a4d7
+Create Date: 2026-10-18 22:15:37.504126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d3c5e91f02'
+down_revision = 'f2c6e9b1a4d7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # app.py used to create_all() at startup, so the table may already exist
+    if sa.inspect(op.get_bind()).has_table('digest_run'):
+        return
+
+    op.create_table('digest_run',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('period_start', sa.Date(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=False),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.Column('last_user_id', sa.Integer(), nullable=False),
+    sa.Column('queued', sa.Integer(), nullable=False),
+    sa.Column('claimed_by', sa.String(length=32), nullable=True),
+    sa.Column('claimed_until', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('period_start')
+    )
+
+
+def downgrade():
+    op.drop_table('digest_run')
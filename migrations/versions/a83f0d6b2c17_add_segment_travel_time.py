@@ -0,0 +1,41 @@
+"""Add segment travel times
+
+Revision ID: a83f0d6b2c17
+Revises: 5c1e2a7d9f40
+Create Date: 2026-10-18 11:40:07.281934
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a83f0d6b2c17'
+down_revision = '5c1e2a7d9f40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # app.py used to create_all() at startup, so the table may already exist
+    if sa.inspect(op.get_bind()).has_table('segment_travel_time'):
+        return
+
+    op.create_table('segment_travel_time',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('bus_id', sa.Integer(), nullable=False),
+    sa.Column('from_stop_id', sa.Integer(), nullable=False),
+    sa.Column('to_stop_id', sa.Integer(), nullable=False),
+    sa.Column('time_bucket', sa.Integer(), nullable=False),
+    sa.Column('total_seconds', sa.Float(), nullable=True),
+    sa.Column('samples', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['bus_id'], ['bus.id'], ),
+    sa.ForeignKeyConstraint(['from_stop_id'], ['bus_stop.id'], ),
+    sa.ForeignKeyConstraint(['to_stop_id'], ['bus_stop.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('bus_id', 'from_stop_id', 'to_stop_id', 'time_bucket', name='unique_segment_bucket')
+    )
+
+
+def downgrade():
+    op.drop_table('segment_travel_time')
@@ -0,0 +1,55 @@
+"""Add identity index
+
+Revision ID: b6d2f08e4a91
+Revises: e4b7c9a1d305
+Create Date: 2026-10-18 16:21:09.730412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6d2f08e4a91'
+down_revision = 'e4b7c9a1d305'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # app.py used to create_all() at startup and fill the index itself, so
+    # the table may already exist; refill it from the principal tables then
+    if sa.inspect(op.get_bind()).has_table('identity_index'):
+        op.execute('DELETE FROM identity_index')
+        backfill()
+        return
+
+    op.create_table('identity_index',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('email', sa.String(length=100), nullable=False),
+    sa.Column('role', sa.String(length=20), nullable=False),
+    sa.Column('principal_id', sa.Integer(), nullable=False),
+    sa.Column('is_club_leader', sa.Boolean(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('role', 'principal_id', name='unique_identity_principal')
+    )
+    with op.batch_alter_table('identity_index', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_identity_index_email'), ['email'], unique=False)
+    backfill()
+
+
+def backfill():
+    for table, role in (('user', 'user'), ('faculty', 'faculty'), ('alumni', 'alumni'),
+                        ('driver', 'driver'), ('bus_manager', 'bus_manager')):
+        leader = "EXISTS (SELECT 1 FROM club WHERE club.secretary_id = t.id)" if role == 'user' else '0'
+        op.execute(
+            f"INSERT INTO identity_index (email, role, principal_id, is_club_leader) "
+            f"SELECT lower(trim(t.email)), '{role}', t.id, {leader} FROM \"{table}\" AS t WHERE t.email IS NOT NULL"
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('identity_index', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_identity_index_email'))
+
+    op.drop_table('identity_index')
@@ -0,0 +1,40 @@
+"""Add expiry indexes and last seen times
+
+Revision ID: c3f8a5e27b14
+Revises: b6d2f08e4a91
+Create Date: 2026-10-18 17:48:31.204665
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f8a5e27b14'
+down_revision = 'b6d2f08e4a91'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('temp_user', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_temp_user_expires_at'), ['expires_at'], unique=False)
+
+    with op.batch_alter_table('password_reset_token', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_password_reset_token_expires_at'), ['expires_at'], unique=False)
+
+    for table in ('user', 'driver', 'alumni', 'faculty', 'bus_manager'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('last_seen_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    for table in ('bus_manager', 'faculty', 'alumni', 'driver', 'user'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('last_seen_at')
+
+    with op.batch_alter_table('password_reset_token', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_password_reset_token_expires_at'))
+
+    with op.batch_alter_table('temp_user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_temp_user_expires_at'))
@@ -0,0 +1,48 @@
+"""Add outbound email queue
+
+Revision ID: d9a41c6e8f23
+Revises: c3f8a5e27b14
+Create Date: 2026-10-18 19:05:12.663018
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd9a41c6e8f23'
+down_revision = 'c3f8a5e27b14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # app.py used to create_all() at startup, so the table may already exist
+    if sa.inspect(op.get_bind()).has_table('outbound_email'):
+        return
+
+    op.create_table('outbound_email',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('recipient', sa.String(length=255), nullable=False),
+    sa.Column('subject', sa.String(length=255), nullable=False),
+    sa.Column('html', sa.Text(), nullable=True),
+    sa.Column('body', sa.Text(), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+    sa.Column('claimed_by', sa.String(length=32), nullable=True),
+    sa.Column('claimed_until', sa.DateTime(), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('sent_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('outbound_email', schema=None) as batch_op:
+        batch_op.create_index('ix_outbound_email_due', ['status', 'next_attempt_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('outbound_email', schema=None) as batch_op:
+        batch_op.drop_index('ix_outbound_email_due')
+
+    op.drop_table('outbound_email')
@@ -0,0 +1,41 @@
+"""Add session generations
+
+Revision ID: e4b7c9a1d305
+Revises: a83f0d6b2c17
+Create Date: 2026-10-18 15:02:44.518390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b7c9a1d305'
+down_revision = 'a83f0d6b2c17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # app.py used to create_all() at startup, so the table may already exist
+    if sa.inspect(op.get_bind()).has_table('session_generation'):
+        return
+
+    op.create_table('session_generation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('role', sa.String(length=20), nullable=False),
+    sa.Column('principal_id', sa.Integer(), nullable=False),
+    sa.Column('generation', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('role', 'principal_id', name='unique_session_generation')
+    )
+    with op.batch_alter_table('session_generation', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_session_generation_updated_at'), ['updated_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('session_generation', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_session_generation_updated_at'))
+
+    op.drop_table('session_generation')
@@ -0,0 +1,53 @@
+"""Store bus track blocks as one chunk row per flush
+
+Revision ID: f2c6e9b1a4d7
+Revises: d9a41c6e8f23
+Create Date: 2026-10-18 21:40:03.118452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2c6e9b1a4d7'
+down_revision = 'd9a41c6e8f23'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a table made by app.py's old startup create_all() already has chunks
+    columns = [column['name'] for column in sa.inspect(op.get_bind()).get_columns('bus_track_block')]
+    if 'seq' in columns:
+        return
+
+    with op.batch_alter_table('bus_track_block', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('seq', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.drop_constraint('unique_bus_track_day', type_='unique')
+        batch_op.create_unique_constraint('unique_bus_track_chunk', ['bus_id', 'day', 'seq'])
+
+
+def downgrade():
+    # fold each day's chunks back into a single row; chunks are
+    # self-contained, so the blob is their concatenation in seq order
+    bind = op.get_bind()
+    block = sa.table('bus_track_block', sa.column('id', sa.Integer), sa.column('bus_id', sa.Integer),
+                     sa.column('day', sa.Date), sa.column('seq', sa.Integer),
+                     sa.column('point_count', sa.Integer), sa.column('data', sa.LargeBinary))
+    days = {}
+    for row in bind.execute(sa.select(block).order_by(block.c.bus_id, block.c.day, block.c.seq)):
+        days.setdefault((row.bus_id, row.day), []).append(row)
+    for rows in days.values():
+        if len(rows) < 2:
+            continue
+        bind.execute(block.update().where(block.c.id == rows[0].id).values(
+            point_count=sum(row.point_count or 0 for row in rows),
+            data=b''.join(row.data for row in rows)
+        ))
+        bind.execute(block.delete().where(block.c.id.in_([row.id for row in rows[1:]])))
+
+    with op.batch_alter_table('bus_track_block', schema=None) as batch_op:
+        batch_op.drop_constraint('unique_bus_track_chunk', type_='unique')
+        batch_op.create_unique_constraint('unique_bus_track_day', ['bus_id', 'day'])
+        batch_op.drop_column('seq')
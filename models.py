@@ -1,6 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
 from datetime import datetime, timezone
-from werkzeug.security import generate_password_hash, check_password_hash
+from utils.password_hashing import password_hasher
 
 # Note: The 'db' object should be imported from your 'extensions.py' file.
 # The code below assumes it's defined there, but is shown here for clarity.
@@ -14,10 +15,10 @@ class TempUser(db.Model):
     password_hash = db.Column(db.String(255), nullable=False)
     verification_token = db.Column(db.String(100), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
-    expires_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
 
 class User(db.Model):
@@ -33,15 +34,16 @@ class User(db.Model):
     selected_bus_id = db.Column(db.Integer, db.ForeignKey('bus.id'))
     selected_stop = db.Column(db.String(100))
     login_status = db.Column(db.Boolean, default=False)
+    last_seen_at = db.Column(db.DateTime)
     session_token = db.Column(db.String(100))
     last_login_device = db.Column(db.String(255))
     created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.check_and_upgrade(self, password)
 
 
 class Bus(db.Model):
@@ -55,6 +57,8 @@ class Bus(db.Model):
     driver_id = db.Column(db.Integer, db.ForeignKey('driver.id', use_alter=True))  # Corrected foreign key
 
     stops = db.relationship('BusStop', backref='bus', lazy=True, cascade='all, delete-orphan')
+    track_blocks = db.relationship('BusTrackBlock', backref='bus', lazy=True, cascade='all, delete-orphan')
+    travel_times = db.relationship('SegmentTravelTime', backref='bus', lazy=True, cascade='all, delete-orphan')
     users = db.relationship('User', backref='selected_bus', lazy=True, foreign_keys=[User.selected_bus_id])
 
 
@@ -68,6 +72,44 @@ class BusStop(db.Model):
     is_crossed = db.Column(db.Boolean, default=False)
 
 
+class BusTrackBlock(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    bus_id = db.Column(db.Integer, db.ForeignKey('bus.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    # one row per flush; a day's track is its chunks in seq order
+    seq = db.Column(db.Integer, nullable=False, default=0)
+    point_count = db.Column(db.Integer, default=0)
+    data = db.Column(db.LargeBinary, nullable=False, default=b'')
+
+    __table_args__ = (db.UniqueConstraint('bus_id', 'day', 'seq', name='unique_bus_track_chunk'),)
+
+
+class SegmentTravelTime(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    bus_id = db.Column(db.Integer, db.ForeignKey('bus.id'), nullable=False)
+    from_stop_id = db.Column(db.Integer, db.ForeignKey('bus_stop.id'), nullable=False)
+    to_stop_id = db.Column(db.Integer, db.ForeignKey('bus_stop.id'), nullable=False)
+    time_bucket = db.Column(db.Integer, nullable=False)
+    total_seconds = db.Column(db.Float, default=0.0)
+    samples = db.Column(db.Integer, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('bus_id', 'from_stop_id', 'to_stop_id', 'time_bucket', name='unique_segment_bucket'),
+    )
+
+
+class SessionGeneration(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    role = db.Column(db.String(20), nullable=False)
+    principal_id = db.Column(db.Integer, nullable=False)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('role', 'principal_id', name='unique_session_generation'),
+    )
+
+
 class Driver(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -76,15 +118,16 @@ class Driver(db.Model):
     assigned_bus_id = db.Column(db.Integer, db.ForeignKey('bus.id', use_alter=True))  # Corrected foreign key name
     is_sharing_location = db.Column(db.Boolean, default=False)
     login_status = db.Column(db.Boolean, default=False)
+    last_seen_at = db.Column(db.DateTime)
     session_token = db.Column(db.String(100))
 
     bus = db.relationship('Bus', backref='driver', foreign_keys=[Bus.driver_id], uselist=False)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.check_and_upgrade(self, password)
 
 
 class AcademicResource(db.Model):
@@ -133,6 +176,7 @@ class Alumni(db.Model):
     email = db.Column(db.String(100), unique=True)
     password_hash = db.Column(db.String(255))
     login_status = db.Column(db.Boolean, default=False)
+    last_seen_at = db.Column(db.DateTime)
     session_token = db.Column(db.String(100))
     
     about = db.Column(db.Text)
@@ -143,10 +187,10 @@ class Alumni(db.Model):
     accepts_contact_requests = db.Column(db.Boolean, default=True)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.check_and_upgrade(self, password)
 
 
 class Faculty(db.Model):
@@ -164,16 +208,17 @@ class Faculty(db.Model):
     linkedin = db.Column(db.String(255))
     password_hash = db.Column(db.String(255))
     login_status = db.Column(db.Boolean, default=False)
+    last_seen_at = db.Column(db.DateTime)
     session_token = db.Column(db.String(100))
 
     education = db.relationship('Education', backref='faculty', lazy=True)
     timetable = db.relationship('Timetable', backref='faculty', lazy=True)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.check_and_upgrade(self, password)
 
 
 class Education(db.Model):
@@ -246,10 +291,10 @@ class Admin(db.Model):
     permissions = db.Column(db.Text)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.check_and_upgrade(self, password)
 
 
 class UserPreferences(db.Model):
@@ -290,10 +335,42 @@ class PasswordResetToken(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(100), nullable=False)
     token = db.Column(db.String(100), unique=True, nullable=False)
-    expires_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
 
 
+class OutboundEmail(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(255), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html = db.Column(db.Text)
+    body = db.Column(db.Text)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(32))
+    claimed_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_outbound_email_due', 'status', 'next_attempt_at'),
+    )
+
+
+class DigestRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    period_start = db.Column(db.Date, unique=True, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    # students up to this id have had the period's digest queued
+    last_user_id = db.Column(db.Integer, nullable=False, default=0)
+    queued = db.Column(db.Integer, nullable=False, default=0)
+    claimed_by = db.Column(db.String(32))
+    claimed_until = db.Column(db.DateTime)
+
+
 class BusManager(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -301,13 +378,14 @@ class BusManager(db.Model):
     password_hash = db.Column(db.String(255), nullable=False)
     phone = db.Column(db.String(20))
     login_status = db.Column(db.Boolean, default=False)
+    last_seen_at = db.Column(db.DateTime)
     session_token = db.Column(db.String(100))
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.check_and_upgrade(self, password)
 
 
 class ClubTagRequest(db.Model):
@@ -361,4 +439,124 @@ class AlumniChat(db.Model):
     is_read = db.Column(db.Boolean, default=False)
     
     alumni = db.relationship('Alumni', backref='chats')
-    student = db.relationship('User', backref='alumni_chats')
\ No newline at end of file
+    student = db.relationship('User', backref='alumni_chats')
+
+
+def normalize_email(email):
+    return (email or '').strip().lower()
+
+
+class IdentityIndex(db.Model):
+    """
+    One row per (role, account) with an email, keyed by normalised email so
+    logins and role checks take a single indexed lookup. The password hash
+    stays on the account row named by role and principal_id. Kept in sync
+    by the mapper events below; bulk query updates bypass those, so run
+    IdentityIndex.rebuild() after any.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(100), nullable=False, index=True)
+    role = db.Column(db.String(20), nullable=False)
+    principal_id = db.Column(db.Integer, nullable=False)
+    is_club_leader = db.Column(db.Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('role', 'principal_id', name='unique_identity_principal'),
+    )
+
+    @classmethod
+    def lookup(cls, email, role, club_leader=False):
+        query = cls.query.filter_by(email=normalize_email(email), role=role)
+        if club_leader:
+            query = query.filter_by(is_club_leader=True)
+        return query.first()
+
+    @classmethod
+    def roles_for(cls, email):
+        """
+        Every role an email can sign in as, with 'club_leader' for students
+        who lead a club
+        """
+        roles = []
+        for identity in cls.query.filter_by(email=normalize_email(email)):
+            roles.append(identity.role)
+            if identity.is_club_leader:
+                roles.append('club_leader')
+        return roles
+
+    @classmethod
+    def rebuild(cls):
+        leaders = {secretary_id for secretary_id, in db.session.query(Club.secretary_id).filter(Club.secretary_id.isnot(None))}
+        rows = []
+        for model, role in IDENTITY_ROLES.items():
+            for principal_id, email in db.session.query(model.id, model.email).filter(model.email.isnot(None)):
+                rows.append({
+                    'email': normalize_email(email),
+                    'role': role,
+                    'principal_id': principal_id,
+                    'is_club_leader': role == 'user' and principal_id in leaders
+                })
+        cls.query.delete()
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+        db.session.commit()
+        return len(rows)
+
+
+IDENTITY_ROLES = {User: 'user', Faculty: 'faculty', Alumni: 'alumni', Driver: 'driver', BusManager: 'bus_manager'}
+
+_identity_table = IdentityIndex.__table__
+_club_table = Club.__table__
+
+
+def _is_club_leader(connection, user_id):
+    return connection.execute(
+        db.select(_club_table.c.id).where(_club_table.c.secretary_id == user_id).limit(1)
+    ).first() is not None
+
+
+def _index_principal(mapper, connection, target):
+    role = IDENTITY_ROLES[mapper.class_]
+    connection.execute(_identity_table.delete().where(
+        _identity_table.c.role == role, _identity_table.c.principal_id == target.id
+    ))
+    if target.email:
+        connection.execute(_identity_table.insert().values(
+            email=normalize_email(target.email), role=role, principal_id=target.id,
+            is_club_leader=role == 'user' and _is_club_leader(connection, target.id)
+        ))
+
+
+def _reindex_principal_email(mapper, connection, target):
+    if inspect(target).attrs.email.history.has_changes():
+        _index_principal(mapper, connection, target)
+
+
+def _unindex_principal(mapper, connection, target):
+    connection.execute(_identity_table.delete().where(
+        _identity_table.c.role == IDENTITY_ROLES[mapper.class_], _identity_table.c.principal_id == target.id
+    ))
+
+
+def _refresh_club_leaders(mapper, connection, target):
+    history = inspect(target).attrs.secretary_id.history
+    user_ids = {user_id for user_id in (*history.added, *history.unchanged, *history.deleted) if user_id is not None}
+    for user_id in user_ids:
+        connection.execute(_identity_table.update().where(
+            _identity_table.c.role == 'user', _identity_table.c.principal_id == user_id
+        ).values(is_club_leader=_is_club_leader(connection, user_id)))
+
+
+def _refresh_club_leaders_on_change(mapper, connection, target):
+    if inspect(target).attrs.secretary_id.history.has_changes():
+        _refresh_club_leaders(mapper, connection, target)
+
+
+for _model in IDENTITY_ROLES:
+    event.listen(_model, 'after_insert', _index_principal)
+    event.listen(_model, 'after_update', _reindex_principal_email)
+    event.listen(_model, 'after_delete', _unindex_principal)
+
+event.listen(Club, 'after_insert', _refresh_club_leaders)
+event.listen(Club, 'after_update', _refresh_club_leaders_on_change)
+event.listen(Club, 'after_delete', _refresh_club_leaders)
@@ -0,0 +1,364 @@
+"""
+Load test for the bus tracking pipeline.
+
+Synthesizes driver traces for N buses driving their stop routes and plays
+them, as fast as the app accepts them, through /driver/update-location
+using the Flask test client. While that runs, M students keep a
+/tracking/stream open and P students poll /bus/<id>/data in delta mode.
+The report covers ingest throughput, request latencies, fix-to-client
+latency on the streams and the number of database statements.
+
+Runs against its own SQLite database, which is recreated on every run:
+
+    python simulate_fleet.py --buses 40 --watchers 200 --pollers 100 --duration 1800
+"""
+import argparse
+import heapq
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import config
+
+STOP_SPACING_M = 600.0
+CAMPUS_LAT = 28.6139
+CAMPUS_LNG = 77.2090
+
+
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 2)
+
+    return {'count': len(ordered), 'p50_ms': pick(50), 'p95_ms': pick(95), 'p99_ms': pick(99), 'max_ms': pick(100)}
+
+
+def make_route(index, stops, rng):
+    """
+    A loop of stops leaving the campus in a direction of its own, so
+    buses do not all share the same streets
+    """
+    heading = 2 * math.pi * index / 40 + rng.uniform(-0.05, 0.05)
+    points = []
+    for i in range(stops):
+        distance = STOP_SPACING_M * i
+        bend = math.sin(i / 3) * 200
+        north = distance * math.cos(heading) - bend * math.sin(heading)
+        east = distance * math.sin(heading) + bend * math.cos(heading)
+        points.append((
+            CAMPUS_LAT + north / 111320.0,
+            CAMPUS_LNG + east / (111320.0 * math.cos(math.radians(CAMPUS_LAT)))
+        ))
+    return points
+
+
+class SimulatedDriver:
+    """
+    Moves along a polyline at a varying speed, dwelling at every stop, and
+    reports noisy GPS fixes
+    """
+
+    def __init__(self, bus_id, points, rng, speed_mps, dwell_seconds, noise_m):
+        self.bus_id = bus_id
+        self.points = points
+        self.rng = rng
+        self.speed_mps = speed_mps
+        self.dwell_seconds = dwell_seconds
+        self.noise_m = noise_m
+        self.segment = 0
+        self.along = 0.0
+        self.dwell_left = dwell_seconds
+        self.clock = 0.0
+
+    def _segment_length(self):
+        (lat1, lng1), (lat2, lng2) = self.points[self.segment], self.points[self.segment + 1]
+        dy = (lat2 - lat1) * 111320.0
+        dx = (lng2 - lng1) * 111320.0 * math.cos(math.radians(lat1))
+        return math.hypot(dx, dy)
+
+    def advance(self, seconds):
+        while seconds > 0:
+            if self.dwell_left > 0:
+                spent = min(seconds, self.dwell_left)
+                self.dwell_left -= spent
+                seconds -= spent
+                continue
+
+            length = self._segment_length()
+            speed = self.speed_mps * self.rng.uniform(0.6, 1.2)
+            remaining = length - self.along
+            if speed * seconds < remaining:
+                self.along += speed * seconds
+                seconds = 0
+            else:
+                seconds -= remaining / speed
+                self.segment += 1
+                self.along = 0.0
+                self.dwell_left = self.dwell_seconds
+                if self.segment >= len(self.points) - 1:
+                    # Back at the depot: start the next trip.
+                    self.segment = 0
+
+    def position(self):
+        (lat1, lng1), (lat2, lng2) = self.points[self.segment], self.points[self.segment + 1]
+        length = self._segment_length()
+        t = self.along / length if length else 0.0
+        noise_lat = self.rng.gauss(0, self.noise_m) / 111320.0
+        noise_lng = self.rng.gauss(0, self.noise_m) / (111320.0 * math.cos(math.radians(lat1)))
+        return lat1 + t * (lat2 - lat1) + noise_lat, lng1 + t * (lng2 - lng1) + noise_lng
+
+
+def setup_fleet(db, models, args, rng):
+    db.drop_all()
+    db.create_all()
+
+    drivers, buses, routes = [], [], []
+    for i in range(args.buses):
+        driver = models.Driver(name=f'sim-driver-{i}', password_hash='!', session_token=f'sim-driver-{i}',
+                               is_sharing_location=True)
+        bus = models.Bus(bus_number=f'SIM-{i}', is_active=True)
+        bus.driver = driver
+        drivers.append(driver)
+        buses.append(bus)
+    db.session.add_all(drivers + buses)
+    db.session.flush()
+
+    stop_names = []
+    for i, bus in enumerate(buses):
+        bus.driver.assigned_bus_id = bus.id
+        points = make_route(i, args.stops, rng)
+        # Drive out and back so every trip ends at the depot.
+        routes.append(points + points[-2::-1])
+        names = [f'SIM-{i} stop {k}' for k in range(len(points))]
+        stop_names.append(names)
+        db.session.add_all([
+            models.BusStop(bus_id=bus.id, stop_name=name, stop_order=k + 1, lat=lat, lng=lng)
+            for k, (name, (lat, lng)) in enumerate(zip(names, points))
+        ])
+
+    users = []
+    for i in range(args.watchers + args.pollers):
+        bus_index = i % args.buses
+        users.append(models.User(
+            name=f'sim-student-{i}',
+            email=f'sim-student-{i}@example.com',
+            password_hash='!',
+            session_token=f'sim-student-{i}',
+            selected_bus_id=buses[bus_index].id,
+            selected_stop=rng.choice(stop_names[bus_index])
+        ))
+    db.session.add_all(users)
+    db.session.commit()
+
+    fleet = [(bus.id, bus.driver.id, bus.driver.session_token) for bus in buses]
+    students = [(user.id, user.session_token, user.selected_bus_id) for user in users]
+    return fleet, routes, students
+
+
+class StatementCounter:
+    """
+    Counts the statements, and rows for executemany, that reach the
+    database, by statement kind
+    """
+
+    def __init__(self):
+        self.statements = {}
+        self.rows = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        kind = statement.lstrip().split(None, 1)[0].upper()
+        with self._lock:
+            self.statements[kind] = self.statements.get(kind, 0) + 1
+            self.rows[kind] = self.rows.get(kind, 0) + (len(parameters) if executemany else 1)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.statements), dict(self.rows)
+
+
+def watch(client, user_id, token, bus_id, sent, latencies, stop):
+    client.set_cookie('user_id', str(user_id))
+    client.set_cookie('user_token', token)
+    response = client.get(f'/tracking/stream?bus_id={bus_id}', buffered=False)
+    event = None
+    for chunk in response.response:
+        received = time.perf_counter()
+        for line in chunk.splitlines() if isinstance(chunk, str) else chunk.decode().splitlines():
+            if line.startswith('event: '):
+                event = line[7:]
+            elif line.startswith('data: ') and event == 'location':
+                data = json.loads(line[6:])
+                started = sent.get((bus_id, data.get('last_updated')))
+                if started is not None:
+                    latencies.append(received - started)
+        if stop.is_set():
+            break
+    response.close()
+
+
+def run(args):
+    config.Config.SQLALCHEMY_DATABASE_URI = args.database
+    config.Config.LIVE_LOCATION_FLUSH_INTERVAL = args.flush_interval
+
+    import models
+    from sqlalchemy import event
+    from app import app, db, write_behind
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        fleet, routes, students = setup_fleet(db, models, args, rng)
+        counter = StatementCounter()
+        event.listen(db.engine, 'before_cursor_execute', counter)
+
+    sent = {}
+    stream_latencies = []
+    stop = threading.Event()
+    watchers = []
+    for user_id, token, bus_id in students[:args.watchers]:
+        thread = threading.Thread(target=watch, args=(app.test_client(), user_id, token, bus_id, sent, stream_latencies, stop),
+                                  daemon=True)
+        thread.start()
+        watchers.append(thread)
+    time.sleep(0.5)
+
+    drivers = {}
+    clients = {}
+    queue = []
+    for (bus_id, driver_id, token), points in zip(fleet, routes):
+        drivers[bus_id] = SimulatedDriver(bus_id, points, random.Random(rng.random()), args.speed, args.dwell, args.noise)
+        client = app.test_client()
+        client.set_cookie('driver_id', str(driver_id))
+        client.set_cookie('driver_token', token)
+        clients[bus_id] = client
+        heapq.heappush(queue, (rng.uniform(0, args.min_interval), 'fix', bus_id))
+
+    pollers = {}
+    for user_id, token, bus_id in students[args.watchers:]:
+        client = app.test_client()
+        client.set_cookie('user_id', str(user_id))
+        client.set_cookie('user_token', token)
+        pollers[user_id] = [client, bus_id, None]
+        heapq.heappush(queue, (rng.uniform(0, args.poll_interval), 'poll', user_id))
+
+    base = datetime.utcnow() - timedelta(seconds=args.duration)
+    counter_before = counter.snapshot()
+    ingest_latencies, poll_latencies = [], []
+    fixes = 0
+    started = time.perf_counter()
+
+    while queue and queue[0][0] <= args.duration:
+        clock, kind, key = heapq.heappop(queue)
+        if kind == 'fix':
+            driver = drivers[key]
+            driver.advance(clock - driver.clock)
+            driver.clock = clock
+            lat, lng = driver.position()
+            recorded_at = (base + timedelta(seconds=clock)).isoformat()
+            request_started = time.perf_counter()
+            sent[(key, recorded_at)] = request_started
+            response = clients[key].post('/driver/update-location', json={
+                'fixes': [{'lat': lat, 'lng': lng, 'timestamp': recorded_at}]
+            })
+            ingest_latencies.append(time.perf_counter() - request_started)
+            fixes += 1
+            interval = args.min_interval
+            if args.adaptive and response.status_code == 200:
+                interval = response.get_json().get('next_interval', interval)
+            heapq.heappush(queue, (clock + interval, 'fix', key))
+        else:
+            client, bus_id, version = pollers[key]
+            query = f'?since={version}' if version else ''
+            request_started = time.perf_counter()
+            response = client.get(f'/bus/{bus_id}/data{query}')
+            poll_latencies.append(time.perf_counter() - request_started)
+            pollers[key][2] = response.get_json().get('version')
+            heapq.heappush(queue, (clock + args.poll_interval, 'poll', key))
+
+    elapsed = time.perf_counter() - started
+    with app.app_context():
+        write_behind.flush_all()
+    time.sleep(0.2)
+    stop.set()
+
+    statements_before, rows_before = counter_before
+    statements, rows = counter.snapshot()
+    writes = {kind: statements.get(kind, 0) - statements_before.get(kind, 0)
+              for kind in ('INSERT', 'UPDATE', 'DELETE')}
+    written_rows = {kind: rows.get(kind, 0) - rows_before.get(kind, 0) for kind in ('INSERT', 'UPDATE', 'DELETE')}
+
+    return {
+        'buses': args.buses,
+        'watchers': args.watchers,
+        'pollers': args.pollers,
+        'simulated_seconds': args.duration,
+        'wall_seconds': round(elapsed, 3),
+        'fixes': fixes,
+        'fixes_per_second': round(fixes / elapsed, 1) if elapsed else None,
+        'ingest_latency': percentiles(ingest_latencies),
+        'poll_latency': percentiles(poll_latencies),
+        'fix_to_client_latency': percentiles(stream_latencies),
+        'db_statements': {
+            'select': statements.get('SELECT', 0) - statements_before.get('SELECT', 0),
+            'write': writes,
+            'written_rows': written_rows
+        }
+    }
+
+
+def print_report(report):
+    print(f"{report['buses']} buses, {report['watchers']} streaming watchers, {report['pollers']} pollers")
+    print(f"{report['fixes']} fixes for {report['simulated_seconds']}s of driving in {report['wall_seconds']}s "
+          f"({report['fixes_per_second']} fixes/s)")
+    for name in ('ingest_latency', 'poll_latency', 'fix_to_client_latency'):
+        stats = report[name]
+        if stats['count']:
+            print(f"{name:>22}: p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms, "
+                  f"p99 {stats['p99_ms']} ms, max {stats['max_ms']} ms ({stats['count']} samples)")
+    db_stats = report['db_statements']
+    print(f"{'db statements':>22}: {db_stats['select']} selects, "
+          + ', '.join(f"{count} {kind.lower()}s ({db_stats['written_rows'][kind]} rows)"
+                      for kind, count in db_stats['write'].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a bus fleet against the tracking endpoints')
+    parser.add_argument('--buses', type=int, default=10)
+    parser.add_argument('--stops', type=int, default=12, help='stops per route')
+    parser.add_argument('--watchers', type=int, default=20, help='students holding a tracking stream open')
+    parser.add_argument('--pollers', type=int, default=20, help='students polling bus data in delta mode')
+    parser.add_argument('--duration', type=int, default=900, help='simulated seconds of driving')
+    parser.add_argument('--min-interval', type=float, default=5, help='driver report interval in seconds')
+    parser.add_argument('--adaptive', action='store_true', help='follow the next_interval the server suggests')
+    parser.add_argument('--poll-interval', type=float, default=15)
+    parser.add_argument('--speed', type=float, default=8.0, help='average bus speed in m/s')
+    parser.add_argument('--dwell', type=float, default=20.0, help='seconds spent at each stop')
+    parser.add_argument('--noise', type=float, default=5.0, help='GPS noise in metres')
+    parser.add_argument('--flush-interval', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database', default='sqlite:///simulation.db')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    if args.database == config.Config.SQLALCHEMY_DATABASE_URI:
+        parser.error('the simulator recreates its database; point --database somewhere else')
+    if args.buses < 1 or args.stops < 2:
+        parser.error('need at least one bus and two stops per route')
+    if args.duration > 6 * 60 * 60:
+        parser.error('fixes older than the ingest age limit would be rejected; keep --duration under 6 hours')
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,163 @@
 let map = null;
 let busMarker = null;
 let stopMarkers = [];
-let currentBusId = null;
+let stopStates = [];
+
+const POLL_MIN_DELAY = 15000;
+const POLL_MAX_DELAY = 120000;
+const ETA_REFRESH_INTERVAL = 30000;
+
+// Keeps exactly one live subscription for the page: a single event stream
+// carrying the tracked bus and this student's notifications while the tab
+// is visible, and a notifications-only stream plus a delta poll that backs
+// off while it is hidden or the bus stream is unavailable. Switching buses
+// replaces the subscription instead of adding another one.
+const tracker = {
+    busId: null,
+    version: null,
+    source: null,
+    pollTimer: null,
+    pollDelay: POLL_MIN_DELAY,
+    fetchedAt: 0,
+    fetching: false,
+
+    track(busId) {
+        this.disconnect();
+        this.busId = busId || null;
+        this.version = null;
+        if (this.busId) {
+            this.fetchData().then(() => {
+                document.getElementById('bus-info').classList.remove('hidden');
+                document.getElementById('stops-list').classList.remove('hidden');
+            });
+        }
+        this.connect();
+    },
+
+    connect() {
+        // A hidden tab still needs approach notices pushed to it, but not
+        // every position; the bus itself is polled instead.
+        if (document.hidden) {
+            this.openStream(null);
+            this.schedulePoll(POLL_MIN_DELAY);
+            return;
+        }
+        this.openStream(this.busId);
+    },
+
+    openStream(busId) {
+        const query = busId ? `?bus_id=${busId}` : '';
+        const source = new EventSource(`/tracking/stream${query}`);
+        if (busId) {
+            source.addEventListener('location', event => {
+                updateBusLocation(JSON.parse(event.data));
+                this.refreshEtas();
+            });
+            source.addEventListener('stops', event => {
+                mergeStops(JSON.parse(event.data).stops, true);
+                this.refreshEtas();
+            });
+        }
+        source.addEventListener('approaching', event => {
+            showApproachNotice(JSON.parse(event.data));
+        });
+        source.onerror = () => {
+            // The browser retries on its own unless the server refused the
+            // stream; only then fall back to polling, keeping notifications.
+            if (source.readyState === EventSource.CLOSED && this.source === source) {
+                this.source = null;
+                if (busId) {
+                    this.openStream(null);
+                }
+                this.schedulePoll(POLL_MIN_DELAY);
+            }
+        };
+        this.source = source;
+    },
+
+    refreshEtas() {
+        // The stream carries positions but not ETAs; pick them up from a
+        // delta fetch at most once per interval.
+        if (this.fetching || Date.now() - this.fetchedAt < ETA_REFRESH_INTERVAL) {
+            return;
+        }
+        this.fetchData().catch(() => {});
+    },
+
+    disconnect() {
+        if (this.source) {
+            this.source.close();
+            this.source = null;
+        }
+        clearTimeout(this.pollTimer);
+        this.pollTimer = null;
+    },
+
+    schedulePoll(delay) {
+        clearTimeout(this.pollTimer);
+        this.pollDelay = delay;
+        this.pollTimer = setTimeout(() => this.poll(), delay);
+    },
+
+    poll() {
+        if (!this.busId) {
+            return;
+        }
+
+        this.fetchData()
+            .then(changed => {
+                this.schedulePoll(changed ? POLL_MIN_DELAY : Math.min(this.pollDelay * 2, POLL_MAX_DELAY));
+            })
+            .catch(() => {
+                this.schedulePoll(Math.min(this.pollDelay * 2, POLL_MAX_DELAY));
+            });
+    },
+
+    fetchData() {
+        const busId = this.busId;
+        const query = this.version ? `?since=${encodeURIComponent(this.version)}` : '';
+        this.fetchedAt = Date.now();
+        this.fetching = true;
+        return fetch(`/bus/${busId}/data${query}`)
+            .then(response => response.json())
+            .finally(() => {
+                this.fetching = false;
+            })
+            .then(data => {
+                if (busId !== this.busId) {
+                    return false;
+                }
+                this.version = data.version;
+                if (data.full) {
+                    updateMap(data);
+                    return true;
+                }
+                return applyDelta(data);
+            });
+    },
+
+    onVisibilityChange() {
+        this.disconnect();
+        if (!document.hidden && this.busId) {
+            this.fetchData();
+        }
+        this.connect();
+    }
+};
 
 document.addEventListener('DOMContentLoaded', function() {
     map = L.map('busMap').setView([28.6139, 77.2090], 13);
     L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
         attribution: '© OpenStreetMap contributors'
     }).addTo(map);
-    
-    const busSelect = document.getElementById('bus-select');
-    if (busSelect && busSelect.value) {
-        loadBusData(busSelect.value);
+
+    if ('Notification' in window && Notification.permission === 'default') {
+        Notification.requestPermission();
     }
+
+    const busSelect = document.getElementById('bus-select');
+    tracker.track(busSelect ? busSelect.value : null);
+    document.addEventListener('visibilitychange', () => tracker.onVisibilityChange());
 });
 
 function selectBus() {
@@ -21,7 +166,7 @@ function selectBus() {
         alert('Please select a bus');
         return;
     }
-    
+
     fetch('/select-bus', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
@@ -35,23 +180,7 @@ function selectBus() {
 }
 
 function loadBusData(busId) {
-    currentBusId = busId;
-    
-    fetch(`/bus/${busId}/data`)
-        .then(response => response.json())
-        .then(data => {
-            updateMap(data);
-            document.getElementById('bus-info').classList.remove('hidden');
-            document.getElementById('stops-list').classList.remove('hidden');
-        });
-    
-    setInterval(() => {
-        if (currentBusId) {
-            fetch(`/bus/${currentBusId}/location`)
-                .then(response => response.json())
-                .then(data => updateBusLocation(data));
-        }
-    }, 5000);
+    tracker.track(busId);
 }
 
 function updateMap(data) {
@@ -63,35 +192,107 @@ function updateMap(data) {
         }
         map.setView([data.current_lat, data.current_lng], 14);
     }
-    
-    stopMarkers.forEach(marker => marker.remove());
-    stopMarkers = [];
-    
+
     if (data.stops) {
-        let stopsHTML = '';
-        data.stops.forEach(stop => {
-            const color = stop.is_crossed ? '#ef4444' : '#10b981';
-            const marker = L.circleMarker([stop.lat, stop.lng], {
-                color: color,
-                fillColor: color,
-                fillOpacity: 0.5,
-                radius: 8
-            }).addTo(map).bindPopup(stop.stop_name);
-            stopMarkers.push(marker);
-            
-            stopsHTML += `
-                <div class="flex items-center justify-between p-2 rounded" style="background-color: ${stop.is_crossed ? '#fee2e2' : '#d1fae5'}">
-                    <span class="text-sm">${stop.stop_name}</span>
-                    <span class="text-xs ${stop.is_crossed ? 'text-red-600' : 'text-green-600'}">${stop.is_crossed ? 'Crossed' : 'Upcoming'}</span>
-                </div>
-            `;
+        renderStops(data.stops);
+    }
+}
+
+function applyDelta(data) {
+    let changed = false;
+
+    if (data.location) {
+        updateBusLocation(data.location);
+        changed = true;
+    }
+    if (data.etas) {
+        stopStates.forEach(stop => {
+            const seconds = data.etas[stop.stop_id];
+            stop.eta_seconds = seconds === undefined ? null : seconds;
         });
-        document.getElementById('stops-container').innerHTML = stopsHTML;
+        changed = true;
+    }
+    if (data.stops) {
+        mergeStops(data.stops, false);
+        changed = true;
+    } else if (data.etas) {
+        renderStops(stopStates);
     }
+    return changed;
+}
+
+function mergeStops(stops, complete) {
+    if (complete) {
+        const previous = new Map(stopStates.map(stop => [stop.stop_id, stop]));
+        stops.forEach(stop => {
+            const known = previous.get(stop.stop_id);
+            stop.eta_seconds = known && !stop.is_crossed ? known.eta_seconds : null;
+        });
+        renderStops(stops);
+        return;
+    }
+
+    const changes = new Map(stops.map(stop => [stop.stop_id, stop]));
+    renderStops(stopStates.map(stop => {
+        const change = changes.get(stop.stop_id);
+        return change ? Object.assign({}, stop, change) : stop;
+    }));
+}
+
+function renderStops(stops) {
+    stopStates = stops;
+    stopMarkers.forEach(marker => marker.remove());
+    stopMarkers = [];
+
+    let stopsHTML = '';
+    stops.forEach(stop => {
+        const color = stop.is_crossed ? '#ef4444' : '#10b981';
+        const marker = L.circleMarker([stop.lat, stop.lng], {
+            color: color,
+            fillColor: color,
+            fillOpacity: 0.5,
+            radius: 8
+        }).addTo(map).bindPopup(stop.stop_name);
+        stopMarkers.push(marker);
+
+        let status = stop.is_crossed ? 'Crossed' : 'Upcoming';
+        if (!stop.is_crossed && stop.eta_seconds !== null && stop.eta_seconds !== undefined) {
+            status += ` · ${Math.round(stop.eta_seconds / 60)} min`;
+        }
+        stopsHTML += `
+            <div class="flex items-center justify-between p-2 rounded" style="background-color: ${stop.is_crossed ? '#fee2e2' : '#d1fae5'}">
+                <span class="text-sm">${stop.stop_name}</span>
+                <span class="text-xs ${stop.is_crossed ? 'text-red-600' : 'text-green-600'}">${status}</span>
+            </div>
+        `;
+    });
+    document.getElementById('stops-container').innerHTML = stopsHTML;
 }
 
 function updateBusLocation(data) {
-    if (data.lat && data.lng && busMarker) {
+    if (!data.lat || !data.lng) {
+        return;
+    }
+
+    if (busMarker) {
         busMarker.setLatLng([data.lat, data.lng]);
+    } else {
+        busMarker = L.marker([data.lat, data.lng]).addTo(map);
+        map.setView([data.lat, data.lng], 14);
+    }
+}
+
+function showApproachNotice(data) {
+    let message = `Your bus is ${data.distance_m} m from ${data.stop_name}`;
+    if (data.eta) {
+        const minutes = Math.max(0, Math.round((new Date(data.eta + 'Z') - new Date()) / 60000));
+        message += minutes ? `, arriving in about ${minutes} min` : ', arriving now';
+    }
+
+    document.getElementById('approach-message').textContent = message;
+    document.getElementById('approach-notice').classList.remove('hidden');
+
+    if ('Notification' in window && Notification.permission === 'granted' && document.hidden) {
+        new Notification('Bus approaching', { body: message, tag: `approach-${data.bus_id}-${data.stop_id}` });
     }
 }
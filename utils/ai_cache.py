@@ -0,0 +1,170 @@
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+
+from utils.ttl_cache import TTLCache
+
+PRUNE_EVERY = 100
+# how long a miss waits for the same call already running elsewhere
+INFLIGHT_WAIT = 30
+
+
+def normalize_prompt(text):
+    return ' '.join((text or '').lower().split())
+
+
+def make_key(kind, mode, prompt, *context):
+    """
+    Cache key for a model call: the kind of call, its mode, the prompt
+    with case and spacing normalised, and a fingerprint of whatever
+    context was sent alongside it
+    """
+    fingerprint = hashlib.sha256(json.dumps(context, sort_keys=True, default=str).encode()).hexdigest()
+    raw = json.dumps([kind, mode, normalize_prompt(prompt), fingerprint])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class AIResponseCache:
+    """
+    LRU + TTL cache for model responses, optionally backed by a SQLite
+    file so entries survive restarts. Each entry remembers how long the
+    call that produced it took, so hits can report the latency they saved.
+
+    With ``variants`` above one, a key collects that many distinct
+    responses before it starts serving hits, picked at random; practice
+    questions use this so repeated requests don't all get one question.
+    """
+
+    def __init__(self, maxsize=2048, ttl=3600, path=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._memory = TTLCache(maxsize, ttl)
+        self._lock = threading.Lock()
+        # serialises read-append-store of an entry's variants
+        self._merge_lock = threading.Lock()
+        self._db = None
+        self._writes = 0
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.persisted_hits = 0
+        self.latency_saved = 0.0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS ai_response '
+                '(key TEXT PRIMARY KEY, entry TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS ix_ai_response_expires_at ON ai_response (expires_at)')
+            self._db.commit()
+
+    def _load(self, key):
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                'SELECT entry, expires_at FROM ai_response WHERE key = ? AND expires_at > ?', (key, time.time())
+            ).fetchone()
+        if row is None:
+            return None
+        entry = json.loads(row[0])
+        self._memory.set(key, entry, ttl=row[1] - time.time())
+        return entry
+
+    def _store(self, key, entry, ttl):
+        self._memory.set(key, entry, ttl=ttl)
+        if self._db is None:
+            return
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO ai_response (key, entry, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(entry), time.time() + ttl)
+            )
+            self._writes += 1
+            if self._writes % PRUNE_EVERY == 0:
+                self._db.execute('DELETE FROM ai_response WHERE expires_at <= ?', (time.time(),))
+                self._db.execute(
+                    'DELETE FROM ai_response WHERE key NOT IN '
+                    '(SELECT key FROM ai_response ORDER BY expires_at DESC LIMIT ?)', (self.maxsize,)
+                )
+            self._db.commit()
+
+    def _lookup(self, key):
+        entry = self._memory.get(key)
+        if entry is not None:
+            return entry, False
+        entry = self._load(key)
+        return entry, entry is not None
+
+    def get_or_call(self, key, call, ttl=None, variants=1, cacheable=lambda value: True):
+        """
+        The cached response for ``key``, or the result of ``call()``, which
+        is cached when ``cacheable`` accepts it. Concurrent misses on one
+        key wait for the first caller rather than all calling the model.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        entry, from_disk = self._lookup(key)
+        owner = None
+        if entry is None or len(entry['values']) < variants:
+            with self._lock:
+                pending = self._inflight.get(key)
+                if pending is None:
+                    owner = self._inflight[key] = threading.Event()
+            if pending is not None:
+                pending.wait(INFLIGHT_WAIT)
+                entry, from_disk = self._lookup(key)
+
+        if entry is not None and len(entry['values']) >= variants:
+            with self._lock:
+                self.hits += 1
+                self.persisted_hits += from_disk
+                self.latency_saved += entry['seconds']
+            return random.choice(entry['values'])
+
+        started = time.perf_counter()
+        try:
+            value = call()
+        finally:
+            if owner is not None:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                owner.set()
+        seconds = time.perf_counter() - started
+        with self._lock:
+            self.misses += 1
+        if cacheable(value):
+            with self._merge_lock:
+                # re-read, as concurrent misses may have added variants since
+                entry, _ = self._lookup(key)
+                if entry is None:
+                    entry = {'values': [], 'seconds': 0.0}
+                count = len(entry['values'])
+                if count < variants:
+                    self._store(key, {
+                        'values': entry['values'] + [value],
+                        'seconds': (entry['seconds'] * count + seconds) / (count + 1)
+                    }, ttl)
+        return value
+
+    def clear(self):
+        self._memory.clear()
+        if self._db is not None:
+            with self._lock:
+                self._db.execute('DELETE FROM ai_response')
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'persisted_hits': self.persisted_hits,
+                'latency_saved_seconds': round(self.latency_saved, 3),
+                'memory': self._memory.stats(),
+                'persistent': self._db is not None
+            }
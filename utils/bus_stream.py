@@ -0,0 +1,104 @@
+import json
+import queue
+import threading
+
+FLEET_CHANNEL = 'fleet'
+
+
+def format_sse(event, data):
+    """
+    Encode a single Server-Sent Events message
+    """
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class LocationPublisher:
+    """
+    In-process hub that fans a bus location event out to every open stream.
+
+    Each update is encoded once and pushed onto the bounded queue of every
+    subscriber of the bus channel and of the fleet-wide channel, so N
+    watchers cost one publish instead of N database reads.
+    """
+
+    def __init__(self, max_queue_size=32):
+        self.max_queue_size = max_queue_size
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, channel, subscriber=None):
+        """
+        Register a queue on a channel. Passing the queue returned by an
+        earlier call multiplexes several channels onto one stream.
+        """
+        if subscriber is None:
+            subscriber = queue.Queue(maxsize=self.max_queue_size)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, channel, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(channel)
+            if subscribers is None:
+                return
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[channel]
+
+    def subscriber_count(self, channel):
+        with self._lock:
+            return len(self._subscribers.get(channel, ()))
+
+    def publish(self, channel, event, data):
+        self.publish_many([channel], event, data)
+
+    def publish_many(self, channels, event, data):
+        message = format_sse(event, data)
+        with self._lock:
+            subscribers = [
+                subscriber for channel in channels for subscriber in self._subscribers.get(channel, ())
+            ]
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                # A slow client only ever needs the newest position, so drop
+                # its oldest pending message instead of blocking the publisher.
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    subscriber.put_nowait(message)
+                except queue.Full:
+                    pass
+
+    def publish_location(self, bus_id, data):
+        payload = dict(data, bus_id=bus_id)
+        self.publish(bus_id, 'location', payload)
+        self.publish(FLEET_CHANNEL, 'location', payload)
+
+
+def stream_events(publisher, *channels, initial=None, heartbeat=15):
+    """
+    Generator for a text/event-stream response over one or more channels.
+    Sends the optional initial messages, then whatever the publisher
+    pushes, with periodic keep-alives so proxies do not close an idle
+    connection.
+    """
+    subscriber = None
+    for channel in channels:
+        subscriber = publisher.subscribe(channel, subscriber)
+    try:
+        for message in initial or ():
+            yield message
+        while True:
+            try:
+                yield subscriber.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ': keep-alive\n\n'
+    finally:
+        for channel in channels:
+            publisher.unsubscribe(channel, subscriber)
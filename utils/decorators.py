@@ -1,130 +1,203 @@
+import time
 from functools import wraps
-from flask import request, redirect, url_for, flash
-from models import User, Admin, BusManager, Faculty, Alumni
+from flask import request, redirect, url_for, flash, g
+from flask.ctx import _AppCtxGlobals
+from config import Config
+from models import User, Admin, BusManager, Faculty, Alumni, Driver
+from utils.ttl_cache import TTLCache
+from utils.auth import generate_session_token
+from utils.expiry_sweeper import SessionActivity
+from utils.signed_sessions import SessionGenerations, sign_session_token, parse_session_token
 
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        user_id = request.cookies.get('user_id')
-        session_token = request.cookies.get('user_token')
+# role -> (model, id cookie, token cookie, whether the token is checked
+# against the stored session token)
+PRINCIPAL_ROLES = {
+    'user': (User, 'user_id', 'user_token', True),
+    'faculty': (Faculty, 'faculty_id', 'faculty_token', True),
+    'alumni': (Alumni, 'alumni_id', 'alumni_token', True),
+    'bus_manager': (BusManager, 'bus_manager_id', 'bus_manager_token', True),
+    'admin': (Admin, 'admin_id', 'admin_token', False),
+    'driver': (Driver, 'driver_id', 'driver_token', False),
+}
 
-        
-        if not user_id or not session_token:
-            flash('Please login to access this page', 'warning')
-            return redirect(url_for('login'))
-        
-        user = User.query.get(user_id)
-        if not user or user.session_token != session_token:
-            flash('Invalid session. Please login again', 'warning')
-            return redirect(url_for('login'))
-        
-        return f(*args, **kwargs)
-    return decorated_function
+# (role, id) -> session token last validated against the database. Logins
+# and logouts in this process invalidate entries straight away; the TTL
+# bounds how long a token rotated by another process is still accepted.
+session_cache = TTLCache(Config.SESSION_CACHE_SIZE, Config.SESSION_CACHE_TTL)
 
-def admin_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        admin_id = request.cookies.get('admin_id')
-        admin_token = request.cookies.get('admin_token')
-        
-        if not admin_id or not admin_token:
-            flash('Please login as admin', 'warning')
-            return redirect(url_for('admin_login'))
-        
-        admin = Admin.query.get(admin_id)
-        if not admin:
-            flash('Invalid admin session', 'warning')
-            return redirect(url_for('admin_login'))
-        
-        return f(*args, **kwargs)
-    return decorated_function
+# In 'signed' mode tokens of roles with a stored session token are verified
+# from their signature and these generations alone, with no session lookup.
+SIGNED_SESSIONS = Config.SESSION_TOKEN_MODE == 'signed'
+session_generations = SessionGenerations(Config.SESSION_GENERATION_REFRESH)
+
+# Last-seen times for the idle-session sweep; written behind by the app.
+session_activity = SessionActivity({
+    role: model for role, (model, *_) in PRINCIPAL_ROLES.items() if hasattr(model, 'last_seen_at')
+})
+
+class PrincipalGlobals(_AppCtxGlobals):
+    """
+    flask.g that loads g.principal on first access, so requests whose
+    session was validated from the cache and never touch the principal
+    make no query at all
+    """
+
+    def __getattr__(self, name):
+        if name == 'principal' and 'principal_role' in self.__dict__:
+            self.principal = load_principal(self.principal_role)
+            return self.principal
+        return super().__getattr__(name)
+
+def invalidate_session(role, principal_id):
+    """
+    Forget a cached session. Call whenever a login, logout or force logout
+    changes the stored session token.
+    """
+    session_cache.pop((role, int(principal_id)))
+
+def issue_session_token(role, principal_id):
+    """
+    A new session token for a login. In signed mode this starts a new
+    session generation, which revokes the principal's earlier tokens.
+    """
+    if SIGNED_SESSIONS and PRINCIPAL_ROLES[role][3]:
+        generation = session_generations.bump(role, principal_id)
+        return sign_session_token(Config.SECRET_KEY, role, principal_id, generation, Config.SESSION_TOKEN_MAX_AGE)
+    return generate_session_token()
+
+def revoke_session(role, principal_id):
+    """
+    End a principal's session on logout
+    """
+    if SIGNED_SESSIONS and PRINCIPAL_ROLES[role][3]:
+        session_generations.bump(role, principal_id)
+    invalidate_session(role, principal_id)
+
+def verify_signed_token(role, principal_id, token):
+    claims = parse_session_token(Config.SECRET_KEY, token)
+    if claims is None:
+        return False
+    token_role, token_principal_id, generation, expires = claims
+    return (token_role == role and token_principal_id == principal_id
+            and expires > time.time()
+            and session_generations.is_current(role, principal_id, generation))
+
+def has_session_cookies(role):
+    _, id_cookie, token_cookie, _ = PRINCIPAL_ROLES[role]
+    return bool(request.cookies.get(id_cookie) and request.cookies.get(token_cookie))
+
+def load_principal(role):
+    """
+    The signed-in identity for a role, or None. Resolved from the role's
+    cookies at most once per request and kept on flask.g, so decorators,
+    views and templates share a single lookup.
+    """
+    principals = g.setdefault('principals', {})
+    if role in principals:
+        return principals[role]
+
+    model, id_cookie, token_cookie, check_token = PRINCIPAL_ROLES[role]
+    principal_id = request.cookies.get(id_cookie)
+    token = request.cookies.get(token_cookie)
+
+    principal = None
+    if principal_id and token:
+        principal = model.query.get(principal_id)
+        if principal is not None and check_token:
+            if SIGNED_SESSIONS:
+                valid = verify_signed_token(role, principal.id, token)
+            else:
+                valid = principal.session_token == token
+            if not valid:
+                principal = None
+
+    principals[role] = principal
+    return principal
+
+def authenticate(role):
+    """
+    The principal's id when the role's cookies carry a valid session, else
+    None. Signed tokens are verified in memory; other tokens are answered
+    from the session cache when possible and otherwise by loading the
+    principal.
+    """
+    _, id_cookie, token_cookie, check_token = PRINCIPAL_ROLES[role]
+    token = request.cookies.get(token_cookie)
+    try:
+        principal_id = int(request.cookies.get(id_cookie))
+    except (TypeError, ValueError):
+        return None
+
+    if check_token and SIGNED_SESSIONS:
+        return principal_id if verify_signed_token(role, principal_id, token) else None
+
+    if check_token and session_cache.get((role, principal_id)) == token:
+        return principal_id
+
+    if load_principal(role) is None:
+        return None
+    if check_token:
+        session_cache.set((role, principal_id), token)
+    return principal_id
+
+def _principal_required(role, login_endpoint, missing_message, invalid_message):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not has_session_cookies(role):
+                flash(missing_message, 'warning')
+                return redirect(url_for(login_endpoint))
+
+            principal_id = authenticate(role)
+            if principal_id is None:
+                flash(invalid_message, 'warning')
+                return redirect(url_for(login_endpoint))
+
+            g.principal_role = role
+            g.principal_id = principal_id
+            session_activity.touch(role, principal_id)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+login_required = _principal_required('user', 'login', 'Please login to access this page', 'Invalid session. Please login again')
+admin_required = _principal_required('admin', 'admin_login', 'Please login as admin', 'Invalid admin session')
+bus_manager_required = _principal_required('bus_manager', 'login', 'Please login as bus manager', 'Invalid session')
+faculty_required = _principal_required('faculty', 'login', 'Please login as faculty', 'Invalid session')
+alumni_required = _principal_required('alumni', 'login', 'Please login as alumni', 'Invalid session')
 
 def driver_required(f):
+    # Only the cookies are checked here; the location ingest path is hot
+    # and resolves the driver's bus from a cache, so views that need the
+    # Driver row call load_principal('driver') themselves.
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        driver_id = request.cookies.get('driver_id')
-        driver_token = request.cookies.get('driver_token')
-        
-        if not driver_id or not driver_token:
+        if not has_session_cookies('driver'):
             flash('Please login as driver', 'warning')
             return redirect(url_for('driver_login'))
-        
-        return f(*args, **kwargs)
-    return decorated_function
-
-def bus_manager_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        bus_manager_id = request.cookies.get('bus_manager_id')
-        bus_manager_token = request.cookies.get('bus_manager_token')
-        
-        if not bus_manager_id or not bus_manager_token:
-            flash('Please login as bus manager', 'warning')
-            return redirect(url_for('login'))
-        
-        bus_manager = BusManager.query.get(bus_manager_id)
-        if not bus_manager or bus_manager.session_token != bus_manager_token:
-            flash('Invalid session', 'warning')
-            return redirect(url_for('login'))
-        
-        return f(*args, **kwargs)
-    return decorated_function
-
-def faculty_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        faculty_id = request.cookies.get('faculty_id')
-        faculty_token = request.cookies.get('faculty_token')
-        
-        if not faculty_id or not faculty_token:
-            flash('Please login as faculty', 'warning')
-            return redirect(url_for('login'))
-        
-        faculty = Faculty.query.get(faculty_id)
-        if not faculty or faculty.session_token != faculty_token:
-            flash('Invalid session', 'warning')
-            return redirect(url_for('login'))
-        
-        return f(*args, **kwargs)
-    return decorated_function
 
-def alumni_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        alumni_id = request.cookies.get('alumni_id')
-        alumni_token = request.cookies.get('alumni_token')
-        
-        if not alumni_id or not alumni_token:
-            flash('Please login as alumni', 'warning')
-            return redirect(url_for('login'))
-        
-        alumni = Alumni.query.get(alumni_id)
-        if not alumni or alumni.session_token != alumni_token:
-            flash('Invalid session', 'warning')
-            return redirect(url_for('login'))
-        
         return f(*args, **kwargs)
     return decorated_function
 
 def club_leader_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user_id = request.cookies.get('user_id')
-        session_token = request.cookies.get('session_token')
-        
-        if not user_id or not session_token:
+        if not has_session_cookies('user'):
             flash('Please login to access this page', 'warning')
             return redirect(url_for('login'))
-        
-        user = User.query.get(user_id)
-        if not user or user.session_token != session_token:
+
+        user_id = authenticate('user')
+        if user_id is None:
             flash('Invalid session', 'warning')
             return redirect(url_for('login'))
-        
+
         from models import Club
-        if not Club.query.filter_by(secretary_id=user.id).first():
+        if not Club.query.filter_by(secretary_id=user_id).first():
             flash('Access denied. Club leader privileges required', 'error')
             return redirect(url_for('dashboard'))
-        
+
+        g.principal_role = 'user'
+        g.principal_id = user_id
+        session_activity.touch('user', user_id)
         return f(*args, **kwargs)
     return decorated_function
@@ -0,0 +1,255 @@
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Event, Club, ClubMembership, CommunityPost, DigestRun
+from utils.outbox import enqueue_many
+
+DIGEST_SUBJECT = 'Campus Sphere - Your weekly digest'
+EXCERPT_LENGTH = 140
+# how long a run may go without finishing a batch before another may take over
+LEASE_SECONDS = 600
+
+
+class DigestConflict(Exception):
+    """
+    The period's digest has already been sent, or another run is sending it
+    """
+
+
+def period_start(day, days):
+    """
+    First day of the ``days``-long digest period containing ``day``.
+    Periods are counted from a Monday, so weekly digests run Monday to
+    Sunday.
+    """
+    return date.fromordinal(day.toordinal() - (day.toordinal() - 1) % days)
+
+
+def _event_summary(event, club_name=None):
+    return {
+        'title': event.title,
+        'venue': event.venue,
+        'when': event.event_date.strftime('%a %d %b, %I:%M %p'),
+        'club_name': club_name
+    }
+
+
+def load_digest_content(now, days, top_posts):
+    """
+    The parts of the digest shared by every student, read once per run:
+    upcoming events keyed by club, upcoming highlighted events and the
+    most liked recent posts. Events are paired with their position in
+    date order, which both sorts and identifies them.
+    """
+    upcoming = db.session.query(Event, Club.name).outerjoin(Club, Event.club_id == Club.id).filter(
+        Event.event_date >= now, Event.event_date < now + timedelta(days=days)
+    ).order_by(Event.event_date)
+
+    club_events, highlighted = {}, []
+    for position, (event, club_name) in enumerate(upcoming):
+        summary = _event_summary(event, club_name)
+        if event.club_id is not None:
+            club_events.setdefault(event.club_id, []).append((position, summary))
+        if event.is_highlighted:
+            highlighted.append((position, summary))
+
+    posts = []
+    rows = db.session.query(CommunityPost.content, CommunityPost.likes, User.name).join(
+        User, CommunityPost.user_id == User.id
+    ).filter(CommunityPost.created_at >= now - timedelta(days=days)).order_by(
+        CommunityPost.likes.desc()
+    ).limit(top_posts)
+    for content, likes, author in rows:
+        excerpt = content if len(content) <= EXCERPT_LENGTH else content[:EXCERPT_LENGTH].rsplit(' ', 1)[0] + '...'
+        posts.append({'excerpt': excerpt, 'author': author, 'likes': likes or 0})
+
+    return club_events, highlighted, posts
+
+
+def iter_student_batches(batch_size, after_id=0):
+    """
+    (id, name, email, club ids) for every student with an id above
+    ``after_id``, a batch at a time, with one membership query per batch.
+    Pages by id rather than holding a cursor open, so callers can commit
+    between batches.
+    """
+    last_id = after_id
+    while True:
+        batch = db.session.query(User.id, User.name, User.email).filter(User.id > last_id).order_by(
+            User.id
+        ).limit(batch_size).all()
+        if not batch:
+            return
+        last_id = batch[-1][0]
+
+        clubs = {}
+        memberships = db.session.query(ClubMembership.user_id, ClubMembership.club_id).filter(
+            ClubMembership.user_id.in_([user_id for user_id, _, _ in batch]),
+            ClubMembership.is_verified.is_(True)
+        )
+        for user_id, club_id in memberships:
+            clubs.setdefault(user_id, []).append(club_id)
+        yield [(user_id, name, email, clubs.get(user_id, [])) for user_id, name, email in batch]
+
+
+class DigestMailer:
+    """
+    Builds each student's digest in one pass over the users table and
+    queues it in the email outbox, whose workers send it over their pooled
+    SMTP connections. Students are read and queued in batches, so memory
+    stays flat however many there are.
+
+    Each period is sent once. A run claims the period's DigestRun row under
+    a lease, and every batch commits together with the id of the last
+    student queued. A run that died part way is resumed from there by the
+    next one, and a finished period is refused.
+    """
+
+    def __init__(self, app, template, events_url, days=7, top_posts=5, batch_size=1000):
+        self.app = app
+        self.template_name = template
+        self.events_url = events_url
+        self.days = days
+        self.top_posts = top_posts
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last_run = None
+
+    def check(self, now=None):
+        """
+        Raise DigestConflict if the current period cannot be sent now
+        """
+        now = now or datetime.utcnow()
+        digest_run = DigestRun.query.filter_by(period_start=period_start(now.date(), self.days)).first()
+        if digest_run is None:
+            return
+        if digest_run.finished_at is not None:
+            raise DigestConflict(f'The digest for the period starting {digest_run.period_start} was already sent')
+        if digest_run.claimed_until is not None and digest_run.claimed_until >= now:
+            raise DigestConflict('A digest run is already in progress')
+
+    def _claim(self, now, worker_id):
+        period = period_start(now.date(), self.days)
+        if DigestRun.query.filter_by(period_start=period).first() is None:
+            db.session.add(DigestRun(period_start=period, started_at=now))
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # another run created it first; the claim below decides
+                db.session.rollback()
+
+        table = DigestRun.__table__
+        claimed = db.session.execute(update(table).where(
+            table.c.period_start == period,
+            table.c.finished_at.is_(None),
+            or_(table.c.claimed_until.is_(None), table.c.claimed_until < now)
+        ).values(claimed_by=worker_id, claimed_until=now + timedelta(seconds=LEASE_SECONDS))).rowcount
+        db.session.commit()
+        if not claimed:
+            self.check(now)
+            raise DigestConflict('A digest run is already in progress')
+        return DigestRun.query.filter_by(period_start=period).one()
+
+    def run(self, dry_run=False):
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        # compiled once here and rendered per student
+        template = self.app.jinja_env.get_template(self.template_name)
+        club_events, highlighted, posts = load_digest_content(now, self.days, self.top_posts)
+        digest_run = None if dry_run else self._claim(now, uuid.uuid4().hex)
+        after_id = digest_run.last_user_id if digest_run else 0
+
+        stats = {'students': 0, 'queued': 0, 'skipped': 0}
+        try:
+            for batch in iter_student_batches(self.batch_size, after_id):
+                messages = []
+                for user_id, name, email, club_ids in batch:
+                    stats['students'] += 1
+                    own = [summary for club_id in club_ids for summary in club_events.get(club_id, ())]
+                    own_positions = {position for position, _ in own}
+                    others = [summary for position, summary in highlighted if position not in own_positions]
+                    if not own and not others and not posts:
+                        stats['skipped'] += 1
+                        continue
+                    messages.append({
+                        'recipient': email,
+                        'subject': DIGEST_SUBJECT,
+                        'html': template.render(
+                            name=name, days=self.days, events_url=self.events_url,
+                            club_events=[summary for _, summary in sorted(own, key=lambda item: item[0])],
+                            highlighted_events=others, top_posts=posts
+                        )
+                    })
+                if not dry_run:
+                    enqueue_many(messages)
+                    digest_run.last_user_id = batch[-1][0]
+                    digest_run.queued += len(messages)
+                    digest_run.claimed_until = datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)
+                    db.session.commit()
+                stats['queued'] += len(messages)
+
+            if not dry_run:
+                digest_run.finished_at = datetime.utcnow()
+                digest_run.claimed_by = None
+                digest_run.claimed_until = None
+                db.session.commit()
+        except Exception:
+            if not dry_run:
+                # let the next run resume straight away rather than after the lease
+                db.session.rollback()
+                digest_run.claimed_by = None
+                digest_run.claimed_until = None
+                db.session.commit()
+            raise
+
+        stats.update({
+            'dry_run': dry_run,
+            'period_start': period_start(now.date(), self.days).isoformat(),
+            'resumed_after_user_id': after_id or None,
+            'at': now.isoformat(),
+            'duration_ms': round((time.perf_counter() - started) * 1000, 1)
+        })
+        with self._lock:
+            self.last_run = stats
+        return stats
+
+    def run_in_background(self, dry_run=False):
+        """
+        Start a run on its own thread unless one is already going. Returns
+        whether a run was started.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._thread = threading.Thread(target=self._run_with_context, args=(dry_run,), name='digest-mailer', daemon=True)
+            self._thread.start()
+            return True
+
+    def _run_with_context(self, dry_run):
+        with self.app.app_context():
+            try:
+                self.run(dry_run)
+            except DigestConflict as e:
+                with self._lock:
+                    self.last_run = {'dry_run': dry_run, 'error': str(e)}
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error sending digest: {e}")
+
+    def status(self):
+        period = period_start(datetime.utcnow().date(), self.days)
+        digest_run = DigestRun.query.filter_by(period_start=period).first()
+        with self._lock:
+            return {
+                'running': self._thread is not None and self._thread.is_alive(),
+                'period_start': period.isoformat(),
+                'period_sent': digest_run is not None and digest_run.finished_at is not None,
+                'period_queued': digest_run.queued if digest_run else 0,
+                'last_run': self.last_run
+            }
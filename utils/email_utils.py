@@ -1,15 +1,14 @@
-from flask_mail import Message
 from flask import url_for
+from markupsafe import escape
+from utils.outbox import enqueue_email
 
-def send_verification_email(mail, user_email, verification_token, user_name):
+# These only queue the message; the caller's commit releases it to the
+# outbox workers.
+
+def send_verification_email(user_email, verification_token, user_name):
     verification_url = url_for('verify_email', token=verification_token, _external=True)
     
-    msg = Message(
-        subject='Campus Sphere - Verify Your Email',
-        recipients=[user_email]
-    )
-    
-    msg.html = f'''
+    html = f'''
     <html>
         <body style="font-family: Arial, sans-serif; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 20px;">
             <div style="max-width: 600px; margin: 0 auto; background: white; border-radius: 10px; padding: 30px;">
@@ -29,17 +28,11 @@ def send_verification_email(mail, user_email, verification_token, user_name):
     </html>
     '''
     
-    try:
-        mail.send(msg)
-        return True
-    except Exception as e:
-        print(f"Error sending email: {e}")
-        return False
+    return enqueue_email(user_email, 'Campus Sphere - Verify Your Email', html=html)
 
-def send_force_logout_email(mail, email, token, name):
+def send_force_logout_email(email, token, name):
     logout_link = url_for('force_logout_verify', token=token, _external=True)
-    msg = Message('Force Logout Request', recipients=[email])
-    msg.body = f'''
+    body = f'''
 Hello {name},
 
 You requested to logout your account from all active devices.
@@ -49,17 +42,12 @@ Click the link below to confirm logout (valid for 15 minutes):
 
 If you didn’t request this, please ignore this email.
 '''
-    mail.send(msg)
+    return enqueue_email(email, 'Force Logout Request', body=body)
 
-def send_password_reset_email(mail, user_email, reset_token, user_name):
+def send_password_reset_email(user_email, reset_token, user_name):
     reset_url = url_for('reset_password', token=reset_token, _external=True)
     
-    msg = Message(
-        subject='Campus Sphere - Password Reset Request',
-        recipients=[user_email]
-    )
-    
-    msg.html = f'''
+    html = f'''
     <html>
         <body style="font-family: Arial, sans-serif; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 20px;">
             <div style="max-width: 600px; margin: 0 auto; background: white; border-radius: 10px; padding: 30px;">
@@ -79,9 +67,26 @@ def send_password_reset_email(mail, user_email, reset_token, user_name):
     </html>
     '''
     
-    try:
-        mail.send(msg)
-        return True
-    except Exception as e:
-        print(f"Error sending password reset email: {e}")
-        return False
+    return enqueue_email(user_email, 'Campus Sphere - Password Reset Request', html=html)
+
+def send_account_invite_email(user_email, invite_url, user_name, valid_hours):
+    html = f'''
+    <html>
+        <body style="font-family: Arial, sans-serif; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 20px;">
+            <div style="max-width: 600px; margin: 0 auto; background: white; border-radius: 10px; padding: 30px;">
+                <h2 style="color: #667eea;">Your Campus Sphere account is ready</h2>
+                <p>Hi {escape(user_name)},</p>
+                <p>Your college has created a Campus Sphere account for you. Click the button below to choose your password:</p>
+                <div style="text-align: center; margin: 30px 0;">
+                    <a href="{invite_url}" style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 12px 30px; text-decoration: none; border-radius: 5px; display: inline-block;">
+                        Set Password
+                    </a>
+                </div>
+                <p>This link will expire in {valid_hours} hours. After that, use "Forgot password" on the login page.</p>
+                <p>Best regards,<br>Campus Sphere Team</p>
+            </div>
+        </body>
+    </html>
+    '''
+    
+    return enqueue_email(user_email, 'Campus Sphere - Set Up Your Account', html=html)
@@ -0,0 +1,228 @@
+import threading
+from datetime import timedelta
+
+from models import db, BusStop, SegmentTravelTime
+
+BUCKET_MINUTES = 30
+BUCKET_COUNT = 24 * 60 // BUCKET_MINUTES
+DEFAULT_SPEED_MPS = 6.0
+MAX_SEGMENT_SECONDS = 2 * 60 * 60
+
+
+def time_bucket(moment):
+    return (moment.hour * 60 + moment.minute) // BUCKET_MINUTES
+
+
+class SegmentModel:
+    """
+    Learned travel times for the segments between one bus's consecutive
+    stops, held as per-segment, per-bucket sums and counts plus cumulative
+    travel-time arrays that are rebuilt only for buckets that change
+    """
+
+    def __init__(self, route, rows):
+        self.route = route
+        self.stop_ids = list(route.stop_ids)
+        segments = max(len(self.stop_ids) - 1, 0)
+        self.lengths = [route.cumulative[i + 1] - route.cumulative[i] for i in range(segments)]
+        self.totals = [[0.0] * BUCKET_COUNT for _ in range(segments)]
+        self.counts = [[0] * BUCKET_COUNT for _ in range(segments)]
+        self._cumulative = {}
+
+        index = {(a, b): i for i, (a, b) in enumerate(zip(self.stop_ids, self.stop_ids[1:]))}
+        for row in rows:
+            segment = index.get((row.from_stop_id, row.to_stop_id))
+            if segment is not None:
+                self.totals[segment][row.time_bucket] += row.total_seconds
+                self.counts[segment][row.time_bucket] += row.samples
+
+    def add_sample(self, segment, bucket, seconds):
+        self.totals[segment][bucket] += seconds
+        self.counts[segment][bucket] += 1
+        self._cumulative.pop(bucket, None)
+
+    def segment_seconds(self, segment, bucket):
+        if self.counts[segment][bucket]:
+            return self.totals[segment][bucket] / self.counts[segment][bucket]
+        count = sum(self.counts[segment])
+        if count:
+            return sum(self.totals[segment]) / count
+        return self.lengths[segment] / DEFAULT_SPEED_MPS
+
+    def cumulative(self, bucket):
+        """
+        Travel time from the first stop to each stop, for one time bucket
+        """
+        cumulative = self._cumulative.get(bucket)
+        if cumulative is None:
+            cumulative = [0.0]
+            for segment in range(len(self.lengths)):
+                cumulative.append(cumulative[-1] + self.segment_seconds(segment, bucket))
+            self._cumulative[bucket] = cumulative
+        return cumulative
+
+
+class EtaEngine:
+    """
+    Per-stop arrival estimates learned from completed trips.
+
+    Stop crossing times reported by the route progress engine are logged
+    per trip. When a trip finishes its segment times are folded into the
+    in-memory model straight away, which only invalidates the affected
+    time buckets, and are upserted into SegmentTravelTime on the next
+    write-behind flush.
+    """
+
+    def __init__(self, route_progress):
+        self.route_progress = route_progress
+        self._lock = threading.Lock()
+        self._models = {}
+        self._trips = {}
+        self._pending = []
+
+    def _model(self, bus_id):
+        route = self.route_progress.route(bus_id)
+        with self._lock:
+            model = self._models.get(bus_id)
+            if model is not None and model.route is route:
+                return model
+
+        rows = SegmentTravelTime.query.filter_by(bus_id=bus_id).all()
+        model = SegmentModel(route, rows)
+        with self._lock:
+            self._models[bus_id] = model
+        return model
+
+    def forget_bus(self, bus_id):
+        with self._lock:
+            self._models.pop(bus_id, None)
+            self._trips.pop(bus_id, None)
+
+    def record_crossings(self, bus_id, stop_indices, crossed_at):
+        with self._lock:
+            trip = self._trips.setdefault(bus_id, {})
+            if trip and min(stop_indices) <= max(trip):
+                # The bus started over without finishing the previous trip.
+                trip.clear()
+            for index in stop_indices:
+                trip[index] = crossed_at
+
+    def finish_trip(self, bus_id):
+        with self._lock:
+            trip = self._trips.pop(bus_id, {})
+        model = self._model(bus_id)
+
+        samples = []
+        for segment in range(len(model.lengths)):
+            start = trip.get(segment)
+            end = trip.get(segment + 1)
+            if start is None or end is None:
+                continue
+            seconds = (end - start).total_seconds()
+            # Stops crossed by the same fix carry no timing information.
+            if 0 < seconds <= MAX_SEGMENT_SECONDS:
+                samples.append((segment, time_bucket(start), seconds))
+
+        with self._lock:
+            for segment, bucket, seconds in samples:
+                model.add_sample(segment, bucket, seconds)
+                self._pending.append((bus_id, model.stop_ids[segment], model.stop_ids[segment + 1], bucket, seconds))
+        return len(samples)
+
+    def estimate(self, bus_id, fix):
+        """
+        Predicted arrival time at each stop still ahead of the bus, keyed by
+        stop id. Empty when the bus is not currently on a trip.
+        """
+        model = self._model(bus_id)
+        route = model.route
+        progress = route.progress
+        if progress is None or fix is None or fix.recorded_at is None or not model.lengths:
+            return {}
+
+        segment = 0
+        while segment < len(model.lengths) - 1 and route.cumulative[segment + 1] <= progress:
+            segment += 1
+
+        with self._lock:
+            bucket = time_bucket(fix.recorded_at)
+            cumulative = model.cumulative(bucket)
+            length = model.lengths[segment]
+            remaining = max(route.cumulative[segment + 1] - progress, 0.0)
+            to_next = model.segment_seconds(segment, bucket) * (remaining / length if length else 0.0)
+
+        arrivals = {}
+        for index in range(segment + 1, len(model.stop_ids)):
+            if route.crossed[index]:
+                continue
+            seconds = to_next + cumulative[index] - cumulative[segment + 1]
+            arrivals[model.stop_ids[index]] = fix.recorded_at + timedelta(seconds=seconds)
+        return arrivals
+
+    def stops_with_etas(self, bus_id, fix, now):
+        arrivals = self.estimate(bus_id, fix)
+        stops = self.route_progress.stops(bus_id)
+        for stop in stops:
+            arrival = arrivals.get(stop['stop_id'])
+            stop['eta'] = arrival.isoformat() if arrival else None
+            stop['eta_seconds'] = max(0, round((arrival - now).total_seconds())) if arrival else None
+        return stops
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+
+        if not pending:
+            return 0
+
+        totals = {}
+        for bus_id, from_stop_id, to_stop_id, bucket, seconds in pending:
+            key = (bus_id, from_stop_id, to_stop_id, bucket)
+            total, count = totals.get(key, (0.0, 0))
+            totals[key] = (total + seconds, count + 1)
+
+        try:
+            # Samples taken before a stop was removed or the route reordered
+            # no longer describe a segment of the route; drop them rather
+            # than write rows for stops that are gone.
+            route_stops = {}
+            for stop in BusStop.query.filter(
+                BusStop.bus_id.in_({key[0] for key in totals})
+            ).order_by(BusStop.bus_id, BusStop.stop_order, BusStop.id):
+                route_stops.setdefault(stop.bus_id, []).append(stop.id)
+            segments = {
+                (bus_id, from_stop_id, to_stop_id)
+                for bus_id, stop_ids in route_stops.items()
+                for from_stop_id, to_stop_id in zip(stop_ids, stop_ids[1:])
+            }
+            totals = {key: value for key, value in totals.items() if key[:3] in segments}
+
+            existing = {
+                (row.bus_id, row.from_stop_id, row.to_stop_id, row.time_bucket): row
+                for row in SegmentTravelTime.query.filter(
+                    SegmentTravelTime.bus_id.in_({key[0] for key in totals})
+                )
+            }
+            for key, (total, count) in totals.items():
+                row = existing.get(key)
+                if row is None:
+                    row = SegmentTravelTime(
+                        bus_id=key[0],
+                        from_stop_id=key[1],
+                        to_stop_id=key[2],
+                        time_bucket=key[3],
+                        total_seconds=0.0,
+                        samples=0
+                    )
+                    db.session.add(row)
+                row.total_seconds += total
+                row.samples += count
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                self._pending = pending + self._pending
+            raise
+
+        return len(pending)
@@ -0,0 +1,155 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, delete, or_, select, update
+
+from models import db, TempUser, PasswordResetToken
+from utils.ttl_cache import TTLCache
+
+
+class SessionActivity:
+    """
+    Records when signed-in principals were last seen and writes it behind,
+    like the live location store. A principal is written at most once per
+    ``resolution`` seconds; idle-session sweeping only needs that much
+    precision and it keeps busy users from causing a write every flush.
+    """
+
+    def __init__(self, models, resolution=300):
+        # role -> model with a last_seen_at column
+        self.models = models
+        self._recent = TTLCache(maxsize=100000, ttl=resolution)
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def touch(self, role, principal_id):
+        if role not in self.models:
+            return
+        key = (role, int(principal_id))
+        if self._recent.get(key) is not None:
+            return
+        self._recent.set(key, True)
+        with self._lock:
+            self._pending[key] = datetime.utcnow()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        by_role = {}
+        for (role, principal_id), seen_at in pending.items():
+            by_role.setdefault(role, []).append({'principal_id': principal_id, 'seen_at': seen_at})
+        try:
+            for role, rows in by_role.items():
+                table = self.models[role].__table__
+                db.session.execute(
+                    update(table).where(table.c.id == bindparam('principal_id')).values(last_seen_at=bindparam('seen_at')),
+                    rows
+                )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for key, seen_at in pending.items():
+                    self._pending.setdefault(key, seen_at)
+            raise
+        return len(pending)
+
+
+class ExpirySweeper:
+    """
+    Background thread that deletes expired signups and password reset
+    tokens in bounded batches, so no single delete holds SQLite's write
+    lock for long, and clears login_status on sessions idle longer than
+    ``idle_after`` seconds
+    """
+
+    def __init__(self, app, session_models, interval=300, batch_size=500, idle_after=7 * 24 * 60 * 60):
+        self.app = app
+        self.session_models = session_models
+        self.interval = interval
+        self.batch_size = batch_size
+        self.idle_after = idle_after
+        self._thread = None
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.totals = {'temp_users': 0, 'password_reset_tokens': 0, 'idle_sessions': 0}
+        self.last_run = None
+
+    def _delete_expired(self, model, now):
+        table = model.__table__
+        deleted = 0
+        while True:
+            ids = select(table.c.id).where(table.c.expires_at < now).limit(self.batch_size).scalar_subquery()
+            count = db.session.execute(delete(table).where(table.c.id.in_(ids))).rowcount
+            db.session.commit()
+            deleted += count
+            if count < self.batch_size:
+                return deleted
+
+    def _clear_idle_sessions(self, now):
+        cutoff = now - timedelta(seconds=self.idle_after)
+        cleared = 0
+        for model in self.session_models.values():
+            table = model.__table__
+            cleared += db.session.execute(
+                update(table).where(
+                    table.c.login_status.is_(True),
+                    or_(table.c.last_seen_at < cutoff, table.c.last_seen_at.is_(None))
+                ).values(login_status=False)
+            ).rowcount
+        db.session.commit()
+        return cleared
+
+    def run_once(self):
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        with self.app.app_context():
+            try:
+                reclaimed = {
+                    'temp_users': self._delete_expired(TempUser, now),
+                    'password_reset_tokens': self._delete_expired(PasswordResetToken, now),
+                    'idle_sessions': self._clear_idle_sessions(now)
+                }
+                error = None
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error sweeping expired rows: {e}")
+                reclaimed, error = {}, str(e)
+
+        with self._lock:
+            self.runs += 1
+            for kind, count in reclaimed.items():
+                self.totals[kind] += count
+            self.last_run = {
+                'at': now.isoformat(),
+                'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+                'reclaimed': reclaimed,
+                'error': error
+            }
+        return reclaimed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'interval_seconds': self.interval,
+                'batch_size': self.batch_size,
+                'idle_after_seconds': self.idle_after,
+                'runs': self.runs,
+                'totals': dict(self.totals),
+                'last_run': self.last_run
+            }
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='expiry-sweeper', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.run_once()
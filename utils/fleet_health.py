@@ -0,0 +1,179 @@
+import threading
+from datetime import datetime
+
+from models import db, Bus, Driver
+
+HEALTH_CHANNEL = 'fleet-health'
+CADENCE_SMOOTHING = 0.2
+
+STATUS_INACTIVE = 'inactive'
+STATUS_NOT_SHARING = 'not_sharing'
+STATUS_STALE = 'stale'
+STATUS_OFF_ROUTE = 'off_route'
+STATUS_OK = 'ok'
+
+
+def bus_status(row, now, stale_after):
+    """
+    Health status of one bus row at ``now``. The dashboard applies the same
+    rules client-side so a bus turns stale without another event.
+    """
+    if not row['is_active']:
+        return STATUS_INACTIVE
+    if not row['is_sharing_location']:
+        return STATUS_NOT_SHARING
+    if row['last_fix_at'] is None or (now - row['last_fix_at']).total_seconds() > stale_after:
+        return STATUS_STALE
+    if row['off_route']:
+        return STATUS_OFF_ROUTE
+    return STATUS_OK
+
+
+class FleetHealthMonitor:
+    """
+    Live health of every bus for the bus manager dashboard.
+
+    The roster of buses, drivers and sharing flags is read once and
+    reloaded only after a manager changes buses or drivers. Report cadence,
+    last fix time and distance from the route are updated from the
+    location ingest path as reports arrive, and every change is published
+    as a single row, so neither the JSON view nor the stream touches the
+    database on a refresh.
+    """
+
+    def __init__(self, publisher, stale_after, off_route_m):
+        self.publisher = publisher
+        self.stale_after = stale_after
+        self.off_route_m = off_route_m
+        self._lock = threading.Lock()
+        self._roster = None
+        self._stats = {}
+
+    def _ensure_roster(self):
+        with self._lock:
+            if self._roster is not None:
+                return self._roster
+
+        rows = db.session.query(
+            Bus.id, Bus.bus_number, Bus.is_active, Bus.last_updated,
+            Driver.id, Driver.name, Driver.is_sharing_location
+        ).outerjoin(Driver, Bus.driver_id == Driver.id).all()
+        roster = {
+            bus_id: {
+                'bus_number': bus_number,
+                'is_active': bool(is_active),
+                'persisted_fix_at': last_updated,
+                'driver_id': driver_id,
+                'driver_name': driver_name,
+                'is_sharing_location': bool(sharing)
+            }
+            for bus_id, bus_number, is_active, last_updated, driver_id, driver_name, sharing in rows
+        }
+
+        with self._lock:
+            if self._roster is None:
+                self._roster = roster
+            return self._roster
+
+    def reset(self):
+        """
+        Reload the roster on next use after buses or drivers changed.
+        Report statistics are kept.
+        """
+        with self._lock:
+            self._roster = None
+        self.publisher.publish(HEALTH_CHANNEL, 'reset', {})
+
+    def forget_bus(self, bus_id):
+        with self._lock:
+            self._stats.pop(bus_id, None)
+        self.reset()
+
+    def _row(self, bus_id, info, now):
+        stats = self._stats.get(bus_id, {})
+        last_fix_at = stats.get('last_fix_at') or info['persisted_fix_at']
+        offset = stats.get('offset_m')
+        row = {
+            'bus_id': bus_id,
+            'bus_number': info['bus_number'],
+            'is_active': info['is_active'],
+            'driver_id': info['driver_id'],
+            'driver_name': info['driver_name'],
+            'is_sharing_location': info['is_sharing_location'],
+            'last_fix_at': last_fix_at,
+            'last_report_at': stats.get('last_report_at'),
+            'report_interval_seconds': stats.get('interval'),
+            'reports': stats.get('reports', 0),
+            'offset_m': round(offset) if offset is not None else None,
+            'off_route': offset is not None and offset > self.off_route_m
+        }
+        row['status'] = bus_status(row, now, self.stale_after)
+        return row
+
+    @staticmethod
+    def _encode(row, now):
+        encoded = dict(row)
+        for field in ('last_fix_at', 'last_report_at'):
+            encoded[field] = row[field].isoformat() if row[field] else None
+        interval = row['report_interval_seconds']
+        encoded['report_interval_seconds'] = round(interval, 1) if interval is not None else None
+        encoded['fix_age_seconds'] = round((now - row['last_fix_at']).total_seconds()) if row['last_fix_at'] else None
+        return encoded
+
+    def _publish_row(self, bus_id, now):
+        roster = self._ensure_roster()
+        with self._lock:
+            info = roster.get(bus_id)
+            row = self._row(bus_id, info, now) if info is not None else None
+        if row is not None:
+            self.publisher.publish(HEALTH_CHANNEL, 'bus', self._encode(row, now))
+
+    def record_report(self, bus_id, fix=None, offset_m=None, received_at=None):
+        """
+        Account for one location upload. ``fix`` is the bus's new live fix,
+        or None when the upload carried nothing newer than it already had.
+        """
+        received_at = received_at or datetime.utcnow()
+        with self._lock:
+            stats = self._stats.setdefault(bus_id, {'reports': 0})
+            previous = stats.get('last_report_at')
+            if previous is not None:
+                elapsed = (received_at - previous).total_seconds()
+                interval = stats.get('interval')
+                stats['interval'] = elapsed if interval is None else \
+                    interval + CADENCE_SMOOTHING * (elapsed - interval)
+            stats['last_report_at'] = received_at
+            stats['reports'] += 1
+            if fix is not None:
+                stats['last_fix_at'] = fix.recorded_at
+                stats['offset_m'] = offset_m
+
+        self._publish_row(bus_id, received_at)
+
+    def set_sharing(self, driver_id, sharing):
+        roster = self._ensure_roster()
+        with self._lock:
+            bus_ids = [bus_id for bus_id, info in roster.items() if info['driver_id'] == driver_id]
+            for bus_id in bus_ids:
+                roster[bus_id]['is_sharing_location'] = bool(sharing)
+
+        now = datetime.utcnow()
+        for bus_id in bus_ids:
+            self._publish_row(bus_id, now)
+
+    def snapshot(self, now=None):
+        now = now or datetime.utcnow()
+        roster = self._ensure_roster()
+        with self._lock:
+            rows = [self._row(bus_id, info, now) for bus_id, info in roster.items()]
+
+        summary = {status: 0 for status in (STATUS_OK, STATUS_OFF_ROUTE, STATUS_STALE, STATUS_NOT_SHARING, STATUS_INACTIVE)}
+        for row in rows:
+            summary[row['status']] += 1
+        return {
+            'generated_at': now.isoformat(),
+            'stale_after': self.stale_after,
+            'off_route_m': self.off_route_m,
+            'summary': summary,
+            'buses': [self._encode(row, now) for row in sorted(rows, key=lambda row: row['bus_number'] or '')]
+        }
@@ -0,0 +1,45 @@
+import math
+
+EARTH_RADIUS_M = 6371000.0
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """
+    Great-circle distance between two points in metres
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+class LocalProjection:
+    """
+    Equirectangular projection around a reference latitude. Accurate to well
+    under a metre over the few tens of kilometres a campus route covers, and
+    much cheaper than haversine for repeated point/segment arithmetic.
+    """
+
+    def __init__(self, ref_lat):
+        self.ky = math.pi * EARTH_RADIUS_M / 180.0
+        self.kx = self.ky * math.cos(math.radians(ref_lat))
+
+    def to_xy(self, lat, lng):
+        return lng * self.kx, lat * self.ky
+
+
+def point_segment_distance(px, py, ax, ay, bx, by):
+    """
+    Distance from P to segment AB and the clamped position of the foot of
+    the perpendicular along AB as a fraction in [0, 1]
+    """
+    dx = bx - ax
+    dy = by - ay
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return math.hypot(px - ax, py - ay), 0.0
+    t = ((px - ax) * dx + (py - ay) * dy) / length_sq
+    t = max(0.0, min(1.0, t))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy)), t
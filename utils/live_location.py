@@ -0,0 +1,289 @@
+import atexit
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import bindparam, update
+
+from models import db, Bus
+from utils.geo import haversine_m
+
+LiveFix = namedtuple('LiveFix', ['lat', 'lng', 'recorded_at', 'seq'])
+
+MAX_FIX_BATCH = 500
+MAX_FIX_AGE = timedelta(hours=12)
+MAX_CLOCK_SKEW = timedelta(seconds=60)
+
+
+def parse_timestamp(value):
+    """
+    Parse an ISO 8601 timestamp into a naive UTC datetime, the form every
+    DateTime column in this app uses
+    """
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def parse_fixes(data, now):
+    """
+    Validate a driver upload, either a single ``{lat, lng}`` or
+    ``{fixes: [{lat, lng, timestamp}, ...]}`` where ``timestamp`` is ISO
+    8601 or epoch milliseconds as reported by the Geolocation API. Fixes
+    without a timestamp are stamped with ``now``.
+
+    Returns ``(fixes, rejected)`` with fixes as (lat, lng, recorded_at)
+    tuples, deduplicated by timestamp and in time order.
+    """
+    if not isinstance(data, dict):
+        return [], 0
+    raw = data.get('fixes') if 'fixes' in data else [data]
+    if not isinstance(raw, list):
+        return [], 0
+
+    by_time = {}
+    rejected = max(len(raw) - MAX_FIX_BATCH, 0)
+    for item in raw[-MAX_FIX_BATCH:]:
+        try:
+            lat = float(item['lat'])
+            lng = float(item['lng'])
+            timestamp = item.get('timestamp')
+            if timestamp is None:
+                recorded_at = now
+            elif isinstance(timestamp, (int, float)):
+                recorded_at = datetime.utcfromtimestamp(timestamp / 1000)
+            else:
+                recorded_at = parse_timestamp(timestamp)
+        except (KeyError, TypeError, ValueError, AttributeError, OverflowError, OSError):
+            rejected += 1
+            continue
+
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180) or not (now - MAX_FIX_AGE <= recorded_at <= now + MAX_CLOCK_SKEW):
+            rejected += 1
+            continue
+        by_time[min(recorded_at, now)] = (lat, lng)
+
+    fixes = [(lat, lng, recorded_at) for recorded_at, (lat, lng) in sorted(by_time.items())]
+    return fixes, rejected
+
+
+def fix_to_dict(fix):
+    return {
+        'lat': fix.lat,
+        'lng': fix.lng,
+        'last_updated': fix.recorded_at.isoformat() if fix.recorded_at else None,
+        'seq': fix.seq
+    }
+
+
+class LiveLocationStore:
+    """
+    Latest fix per bus, kept in memory and persisted to Bus.current_lat,
+    Bus.current_lng and Bus.last_updated by periodic write-behind flushes.
+
+    Every recorded fix gets a monotonically increasing sequence number, so
+    ``version`` changes exactly when some bus position changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fixes = {}
+        self._dirty = set()
+        self._speeds = {}
+        self._driver_buses = {}
+        self._active = None
+        self._active_generation = 0
+        self._seq = 0
+
+    @property
+    def version(self):
+        return self._seq
+
+    def bus_for_driver(self, driver_id):
+        with self._lock:
+            if driver_id in self._driver_buses:
+                return self._driver_buses[driver_id]
+
+        row = db.session.query(Bus.id).filter_by(driver_id=driver_id).first()
+        bus_id = row[0] if row else None
+        with self._lock:
+            self._driver_buses[driver_id] = bus_id
+        return bus_id
+
+    def forget_drivers(self):
+        with self._lock:
+            self._driver_buses.clear()
+
+    def forget_active(self):
+        with self._lock:
+            self._active = None
+            self._active_generation += 1
+
+    def active_bus_ids(self):
+        """
+        Ids of active buses, loaded together with their persisted positions
+        on first use and cached until ``forget_active`` is called
+        """
+        with self._lock:
+            if self._active is not None:
+                return self._active
+
+        rows = db.session.query(Bus.id, Bus.current_lat, Bus.current_lng, Bus.last_updated).filter_by(is_active=True).order_by(Bus.id).all()
+        with self._lock:
+            for bus_id, lat, lng, last_updated in rows:
+                self._fixes.setdefault(bus_id, LiveFix(lat, lng, last_updated, 0))
+            self._active = [row[0] for row in rows]
+            return self._active
+
+    def snapshot_etag(self, now, stale_after):
+        """
+        Tag that changes whenever any position or the active set changes,
+        and at least every quarter of ``stale_after`` so that stale flags
+        are not cached for longer than that
+        """
+        self.active_bus_ids()
+        window = max(int(stale_after // 4), 1)
+        return f"{self._seq}-{self._active_generation}-{int(now.timestamp()) // window}"
+
+    def snapshot(self, now, stale_after):
+        bus_ids = self.active_bus_ids()
+        with self._lock:
+            fixes = [(bus_id, self._fixes.get(bus_id)) for bus_id in bus_ids]
+
+        buses = []
+        for bus_id, fix in fixes:
+            if fix is None or fix.recorded_at is None:
+                buses.append([bus_id, None, None, None, None, True])
+                continue
+            age = max(0, int((now - fix.recorded_at).total_seconds()))
+            buses.append([bus_id, fix.lat, fix.lng, fix.recorded_at.isoformat(), age, age > stale_after])
+
+        return {
+            'version': self._seq,
+            'generated_at': now.isoformat(),
+            'stale_after': stale_after,
+            'fields': ['bus_id', 'lat', 'lng', 'last_updated', 'age_seconds', 'stale'],
+            'buses': buses
+        }
+
+    def forget_bus(self, bus_id):
+        with self._lock:
+            self._fixes.pop(bus_id, None)
+            self._speeds.pop(bus_id, None)
+            self._dirty.discard(bus_id)
+            self._driver_buses = {
+                driver_id: mapped for driver_id, mapped in self._driver_buses.items() if mapped != bus_id
+            }
+
+    def record(self, bus_id, lat, lng, recorded_at=None):
+        with self._lock:
+            self._seq += 1
+            fix = LiveFix(lat, lng, recorded_at or datetime.utcnow(), self._seq)
+            previous = self._fixes.get(bus_id)
+            if previous is not None and previous.lat is not None and previous.recorded_at is not None:
+                elapsed = (fix.recorded_at - previous.recorded_at).total_seconds()
+                if elapsed > 0:
+                    self._speeds[bus_id] = haversine_m(previous.lat, previous.lng, lat, lng) / elapsed
+            self._fixes[bus_id] = fix
+            self._dirty.add(bus_id)
+        return fix
+
+    def speed(self, bus_id):
+        """
+        Ground speed in m/s between the last two recorded fixes, or None
+        """
+        with self._lock:
+            return self._speeds.get(bus_id)
+
+    def get(self, bus_id):
+        """
+        Return the latest fix for a bus, loading the persisted position on a
+        cold cache. Returns None if the bus does not exist.
+        """
+        with self._lock:
+            fix = self._fixes.get(bus_id)
+        if fix is not None:
+            return fix
+
+        row = db.session.query(Bus.current_lat, Bus.current_lng, Bus.last_updated).filter_by(id=bus_id).first()
+        if row is None:
+            return None
+
+        with self._lock:
+            # A ping may have arrived while we were reading the database.
+            return self._fixes.setdefault(bus_id, LiveFix(row[0], row[1], row[2], 0))
+
+    def flush(self):
+        """
+        Write every bus position changed since the last flush in one
+        transaction. Returns the number of buses written.
+        """
+        with self._lock:
+            pending = {bus_id: self._fixes[bus_id] for bus_id in self._dirty}
+            self._dirty.clear()
+
+        if not pending:
+            return 0
+
+        try:
+            table = Bus.__table__
+            db.session.execute(
+                update(table).where(table.c.id == bindparam('bus_id')).values(
+                    current_lat=bindparam('lat'),
+                    current_lng=bindparam('lng'),
+                    last_updated=bindparam('recorded_at')
+                ),
+                [{
+                    'bus_id': bus_id,
+                    'lat': fix.lat,
+                    'lng': fix.lng,
+                    'recorded_at': fix.recorded_at
+                } for bus_id, fix in pending.items()]
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                self._dirty.update(bus_id for bus_id in pending if bus_id in self._fixes)
+            raise
+
+        return len(pending)
+
+
+class WriteBehindFlusher:
+    """
+    Background thread that periodically calls ``flush()`` on every
+    registered store inside an application context, plus a final flush
+    when the process exits.
+    """
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._stores = []
+        self._thread = None
+
+    def register(self, store):
+        self._stores.append(store)
+
+    def flush_all(self):
+        with self.app.app_context():
+            for store in self._stores:
+                try:
+                    store.flush()
+                except Exception as e:
+                    print(f"Error flushing {type(store).__name__}: {e}")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush_all)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush_all()
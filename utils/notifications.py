@@ -0,0 +1,133 @@
+import threading
+
+from models import db, User
+
+APPROACH_RADIUS_M = 500.0
+
+
+def user_channel(user_id):
+    return ('user', int(user_id))
+
+
+class ArrivalNotifier:
+    """
+    Tells students when their bus is approaching their stop.
+
+    Subscriptions are indexed by bus and stop name, loaded per bus on first
+    use and kept in sync by the profile and bus selection views. On each
+    location update only the stops between the bus and the approach radius
+    are looked at, and each stop fires at most once per trip, so the cost
+    of a ping is proportional to the stops that trigger rather than to the
+    number of students. One payload is built per triggered stop and pushed
+    to the stream of every subscriber of that stop.
+    """
+
+    def __init__(self, route_progress, publisher, eta_engine, approach_radius_m=APPROACH_RADIUS_M):
+        self.route_progress = route_progress
+        self.publisher = publisher
+        self.eta_engine = eta_engine
+        self.approach_radius_m = approach_radius_m
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+        self._notified = {}
+        self._latest = {}
+
+    def _bus_subscriptions(self, bus_id):
+        with self._lock:
+            subscriptions = self._subscriptions.get(bus_id)
+        if subscriptions is not None:
+            return subscriptions
+
+        rows = db.session.query(User.id, User.selected_stop).filter(
+            User.selected_bus_id == bus_id,
+            User.selected_stop.isnot(None)
+        ).all()
+        loaded = {}
+        for user_id, stop_name in rows:
+            loaded.setdefault(stop_name, set()).add(user_id)
+
+        with self._lock:
+            return self._subscriptions.setdefault(bus_id, loaded)
+
+    def update_subscription(self, user_id, old_bus_id, old_stop, new_bus_id, new_stop):
+        with self._lock:
+            old = self._subscriptions.get(old_bus_id)
+            if old is not None and old_stop in old:
+                old[old_stop].discard(user_id)
+                if not old[old_stop]:
+                    del old[old_stop]
+            new = self._subscriptions.get(new_bus_id)
+            if new is not None and new_stop:
+                new.setdefault(new_stop, set()).add(user_id)
+
+    def forget_bus(self, bus_id):
+        with self._lock:
+            self._subscriptions.pop(bus_id, None)
+            self._notified.pop(bus_id, None)
+            for key in [key for key in self._latest if key[0] == bus_id]:
+                del self._latest[key]
+
+    def check(self, bus_id, fix):
+        """
+        Fire notifications for stops that just came within the approach
+        radius. Returns the number of stops that fired.
+        """
+        route = self.route_progress.route(bus_id)
+        next_stop = route.next_stop()
+        progress = route.progress
+
+        with self._lock:
+            notified = self._notified.setdefault(bus_id, set())
+            if progress is None or next_stop is None:
+                if notified:
+                    notified.clear()
+                    for key in [key for key in self._latest if key[0] == bus_id]:
+                        del self._latest[key]
+                return 0
+
+            triggered = []
+            for index in range(next_stop, len(route.stop_ids)):
+                distance = route.cumulative[index] - progress
+                if distance > self.approach_radius_m:
+                    break
+                if index not in notified:
+                    notified.add(index)
+                    triggered.append((index, max(distance, 0.0)))
+
+        if not triggered:
+            return 0
+
+        subscriptions = self._bus_subscriptions(bus_id)
+        arrivals = None
+        fired = 0
+        for index, distance in triggered:
+            stop_name = route.names[index]
+            with self._lock:
+                recipients = list(subscriptions.get(stop_name, ()))
+            if not recipients:
+                continue
+
+            if arrivals is None:
+                arrivals = self.eta_engine.estimate(bus_id, fix)
+            arrival = arrivals.get(route.stop_ids[index])
+            payload = {
+                'bus_id': bus_id,
+                'stop_id': route.stop_ids[index],
+                'stop_name': stop_name,
+                'distance_m': round(distance),
+                'eta': arrival.isoformat() if arrival else None,
+                'sent_at': fix.recorded_at.isoformat()
+            }
+            with self._lock:
+                self._latest[(bus_id, stop_name)] = payload
+            self.publisher.publish_many([user_channel(user_id) for user_id in recipients], 'approaching', payload)
+            fired += 1
+        return fired
+
+    def latest(self, bus_id, stop_name):
+        """
+        The most recent approach notification for a stop, for clients that
+        were not connected when it fired
+        """
+        with self._lock:
+            return self._latest.get((bus_id, stop_name))
@@ -0,0 +1,249 @@
+import random
+import smtplib
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+from sqlalchemy import event, insert, or_, select, update
+from sqlalchemy.orm import Session
+
+from models import db, OutboundEmail
+
+# Errors that will not go away by retrying the same message
+PERMANENT_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+# set by EmailOutbox.start() so enqueue_email can wake idle workers
+outbox_wakeup = None
+
+
+def enqueue_email(recipient, subject, html=None, body=None):
+    """
+    Queue a message for the outbox workers instead of talking to SMTP in
+    the request. The row is added to the caller's transaction, so the
+    message goes out exactly when the change that prompted it commits.
+    """
+    email = OutboundEmail(recipient=recipient, subject=subject, html=html, body=body)
+    db.session.add(email)
+    db.session.info['outbox_pending'] = True
+    return email
+
+
+def enqueue_many(messages):
+    """
+    Queue many messages with one executemany insert. ``messages`` are
+    dicts with recipient, subject and html and/or body; as with
+    enqueue_email, the caller commits.
+    """
+    if not messages:
+        return 0
+    now = datetime.utcnow()
+    db.session.execute(insert(OutboundEmail.__table__), [{
+        'recipient': message['recipient'],
+        'subject': message['subject'],
+        'html': message.get('html'),
+        'body': message.get('body'),
+        'status': 'pending',
+        'attempts': 0,
+        'next_attempt_at': now,
+        'created_at': now
+    } for message in messages])
+    db.session.info['outbox_pending'] = True
+    return len(messages)
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_outbox(session):
+    if session.info.pop('outbox_pending', False) and outbox_wakeup is not None:
+        outbox_wakeup.set()
+
+
+class SMTPConnection:
+    """
+    One SMTP session kept open between batches and reopened when the
+    server drops it or it has sat idle longer than ``idle_timeout``
+    """
+
+    def __init__(self, server, port, use_tls=False, use_ssl=False, username=None, password=None,
+                 timeout=30, idle_timeout=60):
+        self.server = server
+        self.port = port
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._smtp = None
+        self._last_used = 0.0
+
+    def _open(self):
+        smtp_class = smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
+        smtp = smtp_class(self.server, self.port, timeout=self.timeout)
+        if self.use_tls:
+            smtp.starttls()
+        if self.username and self.password:
+            smtp.login(self.username, self.password)
+        return smtp
+
+    def send(self, message):
+        if self._smtp is not None and time.monotonic() - self._last_used > self.idle_timeout:
+            self.close()
+        reused = self._smtp is not None
+        if not reused:
+            self._smtp = self._open()
+        try:
+            self._smtp.send_message(message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # a kept-open session the server has since dropped; reconnect
+            # once and leave any further failure to the retry logic
+            self.close()
+            if not reused:
+                raise
+            self._smtp = self._open()
+            self._smtp.send_message(message)
+        self._last_used = time.monotonic()
+
+    def close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except Exception:
+            pass
+        self._smtp = None
+
+
+class EmailOutbox:
+    """
+    Worker threads that drain the outbound_email table. Each worker claims
+    a batch of due messages with a lease, sends them over its own
+    long-lived SMTP connection and records the outcome. Failed sends are
+    retried with exponential backoff; a message whose lease runs out
+    (its process died mid-send) is picked up again.
+    """
+
+    def __init__(self, app, connection_factory, sender, workers=2, batch_size=20, max_attempts=6,
+                 base_delay=30, max_delay=3600, lease_seconds=300, poll_interval=5):
+        self.app = app
+        self.connection_factory = connection_factory
+        self.sender = sender
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def claim(self, worker_id):
+        now = datetime.utcnow()
+        table = OutboundEmail.__table__
+        is_due = or_(
+            (table.c.status == 'pending') & (table.c.next_attempt_at <= now),
+            (table.c.status == 'sending') & (table.c.claimed_until < now)
+        )
+        # Look before taking the write lock, so an idle outbox only reads
+        due = db.session.execute(
+            select(table.c.id).where(is_due).order_by(table.c.next_attempt_at).limit(self.batch_size)
+        ).scalars().all()
+        if not due:
+            db.session.rollback()
+            return []
+
+        # is_due again, as another worker may have claimed some meanwhile
+        db.session.execute(update(table).where(table.c.id.in_(due), is_due).values(
+            status='sending', claimed_by=worker_id, claimed_until=now + timedelta(seconds=self.lease_seconds)
+        ))
+        db.session.commit()
+        return OutboundEmail.query.filter_by(status='sending', claimed_by=worker_id).order_by(OutboundEmail.id).all()
+
+    def build_message(self, email):
+        message = EmailMessage()
+        message['Subject'] = email.subject
+        message['From'] = self.sender
+        message['To'] = email.recipient
+        message.set_content(email.body or 'This message is best viewed in an HTML email client.')
+        if email.html:
+            message.add_alternative(email.html, subtype='html')
+        return message
+
+    def _backoff(self, attempts):
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+    def send_batch(self, worker_id, connection):
+        """
+        Claim and send one batch. Returns the number of messages claimed.
+        """
+        batch = self.claim(worker_id)
+        for email in batch:
+            email.attempts += 1
+            email.claimed_by = None
+            email.claimed_until = None
+            try:
+                connection.send(self.build_message(email))
+            except Exception as e:
+                if not isinstance(e, PERMANENT_ERRORS):
+                    connection.close()
+                email.last_error = f'{type(e).__name__}: {e}'[:1000]
+                if isinstance(e, PERMANENT_ERRORS) or email.attempts >= self.max_attempts:
+                    email.status = 'failed'
+                    outcome = 'failed'
+                else:
+                    email.status = 'pending'
+                    email.next_attempt_at = datetime.utcnow() + self._backoff(email.attempts)
+                    outcome = 'retried'
+            else:
+                email.status = 'sent'
+                email.sent_at = datetime.utcnow()
+                email.last_error = None
+                outcome = 'sent'
+            # commit per message so a crash resends at most the one in flight
+            db.session.commit()
+            with self._lock:
+                setattr(self, outcome, getattr(self, outcome) + 1)
+        return len(batch)
+
+    def _run(self):
+        worker_id = uuid.uuid4().hex
+        connection = self.connection_factory()
+        while True:
+            claimed = 0
+            with self.app.app_context():
+                try:
+                    claimed = self.send_batch(worker_id, connection)
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error sending queued email: {e}")
+            if claimed < self.batch_size and self._wakeup.wait(self.poll_interval):
+                self._wakeup.clear()
+
+    def start(self):
+        global outbox_wakeup
+        if self._threads:
+            return
+        outbox_wakeup = self._wakeup
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'email-outbox-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stats(self):
+        counts = dict(db.session.query(OutboundEmail.status, db.func.count()).group_by(OutboundEmail.status).all())
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queued': counts.get('pending', 0) + counts.get('sending', 0),
+                'by_status': counts,
+                'sent': self.sent,
+                'retried': self.retried,
+                'failed': self.failed
+            }
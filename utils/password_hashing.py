@@ -0,0 +1,82 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from config import Config
+
+
+class PasswordHasherBusy(Exception):
+    """
+    Raised instead of queueing when the hashing pool already has as much
+    work as it accepts
+    """
+
+
+class PasswordHasher:
+    """
+    Runs password hashing and verification on a small dedicated thread
+    pool. hashlib's scrypt and PBKDF2 release the GIL, so the pool size is
+    the number of cores a login burst can take; ``max_pending`` caps how
+    many requests may wait on it, and any beyond that fail straight away
+    with PasswordHasherBusy rather than tying up a web worker.
+    """
+
+    def __init__(self, method, workers=2, max_pending=32):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._lock = threading.Lock()
+        self._hash_prefix = None
+        self.rejected = 0
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordHasherBusy()
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """
+        Whether a stored hash was made with other settings than the current
+        method, e.g. before the cost was raised
+        """
+        if self._hash_prefix is None:
+            # werkzeug fills in default parameters, so take the prefix from
+            # a real hash rather than the configured string
+            self._hash_prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._hash_prefix
+
+    def check_and_upgrade(self, principal, password):
+        """
+        Verify a password against ``principal.password_hash`` and, when it
+        matches but is out of date, replace the hash with one made with the
+        current method. The caller's next commit saves it.
+        """
+        if not principal.password_hash or not self.verify(principal.password_hash, password):
+            return False
+        if self.needs_rehash(principal.password_hash):
+            principal.password_hash = self.hash(password)
+        return True
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'rejected': self.rejected
+        }
+
+
+password_hasher = PasswordHasher(Config.PASSWORD_HASH_METHOD, Config.PASSWORD_HASH_WORKERS, Config.PASSWORD_HASH_MAX_PENDING)
@@ -0,0 +1,235 @@
+import csv
+import secrets
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from sqlalchemy import func, insert
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
+
+from models import db, User, TempUser, IdentityIndex, PasswordResetToken, normalize_email
+from utils.auth import generate_token, get_expiry_time
+from utils.email_utils import send_account_invite_email
+
+ROSTER_FIELDS = ['name', 'email', 'password', 'course', 'branch', 'batch', 'year']
+FIELD_LENGTHS = {'name': 100, 'email': 100, 'course': 50, 'branch': 50, 'batch': 20}
+LOOKUP_CHUNK = 500
+
+
+def parse_roster(lines):
+    """
+    Student rows from a CSV roster with a header of name and email and
+    optional password, course, branch, batch and year columns, read one
+    line at a time. Returns (rows, errors); rows are dicts ready to insert,
+    except that the password is still plain text.
+    """
+    reader = csv.DictReader(lines)
+    missing = {'name', 'email'} - set(reader.fieldnames or ())
+    if missing:
+        return [], [{'row': 1, 'error': f"missing columns: {', '.join(sorted(missing))}"}]
+
+    rows, errors, seen = [], [], {}
+    for record in reader:
+        line = reader.line_num
+        row = {field: (record.get(field) or '').strip() or None for field in ROSTER_FIELDS}
+        row['email'] = normalize_email(row['email']) or None
+
+        too_long = [field for field, limit in FIELD_LENGTHS.items() if row[field] and len(row[field]) > limit]
+        if not row['name'] or not row['email']:
+            errors.append({'row': line, 'error': 'name and email are required'})
+        elif '@' not in row['email']:
+            errors.append({'row': line, 'error': 'email is not valid'})
+        elif too_long:
+            errors.append({'row': line, 'error': f"{', '.join(too_long)} too long"})
+        elif row['email'] in seen:
+            errors.append({'row': line, 'error': f"duplicate of row {seen[row['email']]}"})
+        else:
+            if row['year'] is not None:
+                try:
+                    row['year'] = int(row['year'])
+                except ValueError:
+                    errors.append({'row': line, 'error': 'year must be an integer'})
+                    continue
+            seen[row['email']] = line
+            row['line'] = line
+            rows.append(row)
+    return rows, errors
+
+
+def drop_registered(rows):
+    """
+    Split off rows whose email already has a student account or a pending
+    signup, checked in chunks rather than per row
+    """
+    emails = [row['email'] for row in rows]
+    taken = set()
+    for start in range(0, len(emails), LOOKUP_CHUNK):
+        chunk = emails[start:start + LOOKUP_CHUNK]
+        taken.update(email for email, in db.session.query(IdentityIndex.email).filter(
+            IdentityIndex.role == 'user', IdentityIndex.email.in_(chunk)))
+        taken.update(email for email, in db.session.query(func.lower(func.trim(TempUser.email))).filter(
+            func.lower(func.trim(TempUser.email)).in_(chunk)))
+
+    fresh, errors = [], []
+    for row in rows:
+        if row['email'] in taken:
+            errors.append({'row': row['line'], 'error': 'email already registered'})
+        else:
+            fresh.append(row)
+    return fresh, errors
+
+
+class RosterImportJob:
+    """
+    Hashes the passwords of validated roster rows in a worker pool and
+    inserts the students in batches, one transaction per batch. Students
+    without a password in the roster get a random one and an emailed link,
+    valid for ``invite_hours``, to choose their own. Progress and errors
+    are readable from other threads while it runs.
+
+    The pool is threads rather than processes: hashlib releases the GIL
+    while it hashes, and forking the web process would copy the locks held
+    by its background threads into the children.
+    """
+
+    def __init__(self, rows, errors, hash_method, invite_url, batch_size=1000, workers=None, invite_hours=72):
+        self.id = uuid.uuid4().hex
+        self.rows = rows
+        self.errors = list(errors)
+        self.total = len(rows) + len(errors)
+        self.hash_method = hash_method
+        # reset-password URL that the invite token is appended to
+        self.invite_url = invite_url
+        self.batch_size = batch_size
+        self.workers = workers
+        self.invite_hours = invite_hours
+        self.status = 'queued'
+        self.error = None
+        self.created = 0
+        self.generated_passwords = 0
+        self.invited = 0
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def run(self, app):
+        self.started_at = time.time()
+        self.status = 'running'
+        try:
+            with app.app_context(), ThreadPoolExecutor(self.workers, thread_name_prefix='roster-hash') as pool:
+                hash_password = partial(generate_password_hash, method=self.hash_method)
+                for start in range(0, len(self.rows), self.batch_size):
+                    batch = self.rows[start:start + self.batch_size]
+                    passwords = []
+                    for row in batch:
+                        if row['password'] is None:
+                            # replaced by the student through the invite link
+                            row['password'] = secrets.token_urlsafe(16)
+                            row['invite'] = True
+                            self.generated_passwords += 1
+                        passwords.append(row['password'])
+                    hashes = pool.map(hash_password, passwords)
+                    values = [self._user_values(row, password_hash) for row, password_hash in zip(batch, hashes)]
+                    self._insert(batch, values)
+            self.status = 'finished'
+        except Exception as e:
+            app.logger.exception('Roster import %s failed', self.id)
+            self.error = str(e)
+            self.status = 'failed'
+        finally:
+            self.rows = None
+            self.finished_at = time.time()
+
+    @staticmethod
+    def _user_values(row, password_hash):
+        return {
+            'name': row['name'], 'email': row['email'], 'password_hash': password_hash,
+            'course': row['course'], 'branch': row['branch'], 'batch': row['batch'], 'year': row['year']
+        }
+
+    def _insert(self, batch, values):
+        try:
+            self._insert_users(batch, values)
+        except IntegrityError:
+            # someone signed up mid-import; retry one row at a time to find
+            # the clashing rows
+            db.session.rollback()
+            for row, value in zip(batch, values):
+                try:
+                    self._insert_users([row], [value])
+                except IntegrityError:
+                    db.session.rollback()
+                    self._error(row['line'], 'email already registered')
+
+    def _insert_users(self, rows, values):
+        # Bulk inserts skip the mapper events, so index the new students here
+        created = db.session.execute(insert(User).returning(User.id, User.email), values).all()
+        db.session.execute(insert(IdentityIndex), [
+            {'email': email, 'role': 'user', 'principal_id': user_id, 'is_club_leader': False}
+            for user_id, email in created
+        ])
+
+        # the invites commit with the accounts, so none goes out for a
+        # student who was not created
+        invites = [(row, generate_token()) for row in rows if row.get('invite')]
+        if invites:
+            expires_at = get_expiry_time(self.invite_hours * 60)
+            db.session.execute(insert(PasswordResetToken), [
+                {'email': row['email'], 'token': token, 'expires_at': expires_at} for row, token in invites
+            ])
+            for row, token in invites:
+                send_account_invite_email(row['email'], self.invite_url + token, row['name'], self.invite_hours)
+        db.session.commit()
+        with self._lock:
+            self.created += len(created)
+            self.invited += len(invites)
+
+    def _error(self, line, message):
+        with self._lock:
+            self.errors.append({'row': line, 'error': message})
+
+    def progress(self):
+        with self._lock:
+            elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+            return {
+                'id': self.id,
+                'status': self.status,
+                'total': self.total,
+                'processed': self.created + len(self.errors),
+                'created': self.created,
+                'generated_passwords': self.generated_passwords,
+                'invited': self.invited,
+                'error': self.error,
+                'elapsed_seconds': round(elapsed, 2),
+                'errors': sorted(self.errors, key=lambda error: error['row'])
+            }
+
+
+class RosterImports:
+    """
+    Runs roster imports on background threads, one at a time, and keeps
+    the most recent jobs for progress checks
+    """
+
+    def __init__(self, app, keep=20):
+        self.app = app
+        self.keep = keep
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='roster-import')
+
+    def submit(self, job):
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.keep:
+                self._jobs.popitem(last=False)
+        self._executor.submit(job.run, self.app)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
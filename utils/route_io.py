@@ -0,0 +1,227 @@
+import csv
+import io
+import json
+from collections import namedtuple
+
+from models import db, Bus, BusStop, SegmentTravelTime
+
+CSV_FIELDS = ['bus_number', 'stop_order', 'stop_name', 'lat', 'lng']
+MAX_BUS_NUMBER_LENGTH = 20
+MAX_STOP_NAME_LENGTH = 100
+
+RouteStop = namedtuple('RouteStop', ['stop_name', 'stop_order', 'lat', 'lng'])
+
+
+class RouteCollector:
+    """
+    Validates stop rows from an import file and groups them by bus,
+    collecting an error per bad row instead of stopping at the first one
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.errors = []
+
+    def add(self, location, bus_number, stop_name, stop_order, lat, lng):
+        bus_number = str(bus_number or '').strip()
+        stop_name = str(stop_name or '').strip()
+        if not bus_number or len(bus_number) > MAX_BUS_NUMBER_LENGTH:
+            return self.error(location, f'bus_number must be 1 to {MAX_BUS_NUMBER_LENGTH} characters')
+        if not stop_name or len(stop_name) > MAX_STOP_NAME_LENGTH:
+            return self.error(location, f'stop_name must be 1 to {MAX_STOP_NAME_LENGTH} characters')
+        try:
+            lat, lng = float(lat), float(lng)
+        except (TypeError, ValueError):
+            return self.error(location, 'lat and lng must be numbers')
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            return self.error(location, 'lat or lng out of range')
+
+        stops = self.routes.setdefault(bus_number, [])
+        if stop_order in (None, ''):
+            stop_order = len(stops) + 1
+        try:
+            stop_order = int(stop_order)
+        except (TypeError, ValueError):
+            return self.error(location, 'stop_order must be an integer')
+        if any(stop.stop_name == stop_name for stop in stops):
+            return self.error(location, f'duplicate stop {stop_name!r} for bus {bus_number}')
+
+        stops.append(RouteStop(stop_name, stop_order, lat, lng))
+
+    def error(self, location, message):
+        self.errors.append({'row': location, 'error': message})
+
+    def sorted_routes(self):
+        return {
+            bus_number: sorted(stops, key=lambda stop: stop.stop_order)
+            for bus_number, stops in self.routes.items()
+        }
+
+
+def parse_routes_csv(text):
+    """
+    Routes from CSV with a header of bus_number, stop_name, lat, lng and an
+    optional stop_order; rows without an order keep their file order
+    """
+    collector = RouteCollector()
+    reader = csv.DictReader(io.StringIO(text))
+    missing = {'bus_number', 'stop_name', 'lat', 'lng'} - set(reader.fieldnames or ())
+    if missing:
+        collector.error(1, f"missing columns: {', '.join(sorted(missing))}")
+        return {}, collector.errors
+
+    for row in reader:
+        collector.add(reader.line_num, row.get('bus_number'), row.get('stop_name'),
+                      row.get('stop_order'), row.get('lat'), row.get('lng'))
+    return collector.sorted_routes(), collector.errors
+
+
+def parse_routes_geojson(data):
+    """
+    Routes from a GeoJSON FeatureCollection of Point features carrying
+    bus_number, stop_name and an optional stop_order in their properties
+    """
+    collector = RouteCollector()
+    features = data.get('features') if isinstance(data, dict) else None
+    if not isinstance(features, list):
+        collector.error(0, 'expected a FeatureCollection')
+        return {}, collector.errors
+
+    for index, feature in enumerate(features):
+        geometry = (feature or {}).get('geometry') or {}
+        properties = (feature or {}).get('properties') or {}
+        coordinates = geometry.get('coordinates')
+        if geometry.get('type') != 'Point' or not isinstance(coordinates, list) or len(coordinates) < 2:
+            collector.error(index, 'feature must be a Point')
+            continue
+        collector.add(index, properties.get('bus_number'), properties.get('stop_name'),
+                      properties.get('stop_order'), coordinates[1], coordinates[0])
+    return collector.sorted_routes(), collector.errors
+
+
+def diff_routes(routes):
+    """
+    Compare imported routes with the stored stops of the same buses,
+    matching stops by name. Buses missing from the import are left alone;
+    for buses in it, the import is the complete route.
+    """
+    buses = {bus.bus_number: bus for bus in Bus.query.filter(Bus.bus_number.in_(list(routes)))}
+    existing = {}
+    if buses:
+        for stop in BusStop.query.filter(BusStop.bus_id.in_([bus.id for bus in buses.values()])):
+            existing.setdefault(stop.bus_id, {}).setdefault(stop.stop_name, []).append(stop)
+
+    diff = {'new_buses': [], 'added': [], 'updated': [], 'removed': [], 'unchanged': 0}
+    for bus_number, stops in routes.items():
+        bus = buses.get(bus_number)
+        if bus is None:
+            diff['new_buses'].append(bus_number)
+        current = existing.get(bus.id, {}) if bus else {}
+
+        for order, stop in enumerate(stops, start=1):
+            matches = current.get(stop.stop_name)
+            row = matches.pop(0) if matches else None
+            if row is None:
+                diff['added'].append((bus_number, order, stop))
+            elif (row.stop_order, row.lat, row.lng) != (order, stop.lat, stop.lng):
+                diff['updated'].append((bus_number, order, stop, row))
+            else:
+                diff['unchanged'] += 1
+        diff['removed'].extend((bus_number, row) for rows in current.values() for row in rows)
+
+    return diff, buses
+
+
+def summarize_diff(diff):
+    return {
+        'new_buses': diff['new_buses'],
+        'added': [{'bus_number': bus_number, 'stop_name': stop.stop_name, 'stop_order': order}
+                  for bus_number, order, stop in diff['added']],
+        'updated': [{'bus_number': bus_number, 'stop_name': stop.stop_name, 'stop_order': order}
+                    for bus_number, order, stop, _ in diff['updated']],
+        'removed': [{'bus_number': bus_number, 'stop_name': row.stop_name, 'stop_id': row.id}
+                    for bus_number, row in diff['removed']],
+        'unchanged': diff['unchanged']
+    }
+
+
+def apply_diff(diff, buses):
+    """
+    Write a diff in a single transaction. Returns the ids of every bus
+    whose stops changed.
+    """
+    try:
+        for bus_number in diff['new_buses']:
+            bus = Bus(bus_number=bus_number, is_active=True)
+            db.session.add(bus)
+            buses[bus_number] = bus
+        db.session.flush()
+
+        removed_ids = [row.id for _, row in diff['removed']]
+        if removed_ids:
+            SegmentTravelTime.query.filter(db.or_(
+                SegmentTravelTime.from_stop_id.in_(removed_ids),
+                SegmentTravelTime.to_stop_id.in_(removed_ids)
+            )).delete(synchronize_session=False)
+            for _, row in diff['removed']:
+                db.session.delete(row)
+
+        for bus_number, order, stop, row in diff['updated']:
+            row.stop_order = order
+            row.lat = stop.lat
+            row.lng = stop.lng
+
+        db.session.add_all([
+            BusStop(bus_id=buses[bus_number].id, stop_name=stop.stop_name, stop_order=order, lat=stop.lat, lng=stop.lng)
+            for bus_number, order, stop in diff['added']
+        ])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    changed = {bus_number for bus_number, *_ in diff['added']}
+    changed.update(bus_number for bus_number, *_ in diff['updated'])
+    changed.update(bus_number for bus_number, _ in diff['removed'])
+    return [buses[bus_number].id for bus_number in changed]
+
+
+def _route_rows(batch_size=500):
+    return db.session.query(
+        Bus.bus_number, BusStop.stop_order, BusStop.stop_name, BusStop.lat, BusStop.lng
+    ).join(BusStop, BusStop.bus_id == Bus.id).order_by(Bus.bus_number, BusStop.stop_order).yield_per(batch_size)
+
+
+def export_routes_csv():
+    """
+    Generator of CSV text for every stop of every bus, read in batches so
+    the whole fleet is never held in memory
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_FIELDS)
+    for row in _route_rows():
+        writer.writerow(row)
+        if buffer.tell() > 8192:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_routes_geojson():
+    """
+    Generator of a GeoJSON FeatureCollection of every stop, one feature at
+    a time
+    """
+    yield '{"type":"FeatureCollection","features":['
+    separator = ''
+    for bus_number, stop_order, stop_name, lat, lng in _route_rows():
+        feature = {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+            'properties': {'bus_number': bus_number, 'stop_order': stop_order, 'stop_name': stop_name}
+        }
+        yield separator + json.dumps(feature, separators=(',', ':'))
+        separator = ','
+    yield ']}\n'
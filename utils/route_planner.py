@@ -0,0 +1,115 @@
+import time
+
+import numpy as np
+
+from utils.geo import EARTH_RADIUS_M
+
+DEFAULT_DWELL_SECONDS = 30.0
+TWO_OPT_TIME_BUDGET = 0.5
+
+
+def distance_matrix(lats, lngs):
+    """
+    Great-circle distances in metres between every pair of points, as an
+    N x N array computed in one vectorised haversine pass
+    """
+    phi = np.radians(np.asarray(lats, dtype=float))
+    lmb = np.radians(np.asarray(lngs, dtype=float))
+    dphi = phi[:, None] - phi[None, :]
+    dlmb = lmb[:, None] - lmb[None, :]
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi)[:, None] * np.cos(phi)[None, :] * np.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def route_length(order, dist, round_trip=False):
+    order = np.asarray(order)
+    if len(order) < 2:
+        return 0.0
+    length = dist[order[:-1], order[1:]].sum()
+    if round_trip:
+        length += dist[order[-1], order[0]]
+    return float(length)
+
+
+def nearest_neighbour(dist, start=0):
+    """
+    Greedy tour from ``start`` that always moves to the closest stop not
+    yet visited
+    """
+    n = len(dist)
+    visited = np.zeros(n, dtype=bool)
+    order = [start]
+    visited[start] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, dist[order[-1]])
+        nxt = int(np.argmin(row))
+        order.append(nxt)
+        visited[nxt] = True
+    return np.array(order)
+
+
+def two_opt(order, dist, round_trip=False, time_budget=TWO_OPT_TIME_BUDGET):
+    """
+    Improve a tour by reversing the stretch between two edges whenever that
+    shortens it, until no reversal helps or the time budget runs out. The
+    first stop never moves. For each first edge every candidate second
+    edge is scored in one vectorised step.
+    """
+    order = np.array(order)
+    n = len(order)
+    if n < 4:
+        return order
+
+    deadline = time.perf_counter() + time_budget
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(n - 2):
+            a, b = order[i], order[i + 1]
+            j = np.arange(i + 2, n)
+            c = order[j]
+            # The stop after each candidate edge; an open route's last stop
+            # has none, so that edge costs nothing either way.
+            has_next = j < n - 1
+            d = order[np.where(has_next, j + 1, 0)]
+            if round_trip:
+                has_next = np.ones_like(has_next)
+            old = dist[a, b] + np.where(has_next, dist[c, d], 0.0)
+            new = dist[a, c] + np.where(has_next, dist[b, d], 0.0)
+            gains = old - new
+            best = int(np.argmax(gains))
+            if gains[best] > 1e-6:
+                k = j[best]
+                order[i + 1:k + 1] = order[i + 1:k + 1][::-1]
+                improved = True
+            if time.perf_counter() >= deadline:
+                break
+    return order
+
+
+def plan_route(lats, lngs, start=0, round_trip=False, speed_mps=6.0, dwell_seconds=DEFAULT_DWELL_SECONDS):
+    """
+    Suggested visiting order for a set of stops starting at ``start``, with
+    its straight-line length and an estimated trip time. Road distances are
+    longer than straight lines, so the estimate is a lower bound meant for
+    comparing orders rather than for timetables.
+    """
+    n = len(lats)
+    if n == 0:
+        return {'order': [], 'length_m': 0.0, 'estimated_seconds': 0.0, 'original_length_m': 0.0}
+
+    dist = distance_matrix(lats, lngs)
+    order = two_opt(nearest_neighbour(dist, start), dist, round_trip)
+    length = route_length(order, dist, round_trip)
+
+    original = list(range(n))
+    if start:
+        original.remove(start)
+        original.insert(0, start)
+
+    return {
+        'order': [int(i) for i in order],
+        'length_m': length,
+        'estimated_seconds': length / speed_mps + dwell_seconds * max(n - 1, 0),
+        'original_length_m': route_length(original, dist, round_trip)
+    }
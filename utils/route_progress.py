@@ -0,0 +1,234 @@
+import threading
+from collections import namedtuple
+
+from sqlalchemy import bindparam, update
+
+from models import db, BusStop
+from utils.geo import LocalProjection, point_segment_distance
+
+ProgressUpdate = namedtuple('ProgressUpdate', ['progress', 'offset', 'next_stop', 'crossed', 'completed'])
+
+
+class RouteState:
+    """
+    Precomputed polyline through a bus's ordered stops plus the bus's
+    progress along it for the current trip
+    """
+
+    def __init__(self, stops, pending_crossed=None, version=0):
+        pending_crossed = pending_crossed or {}
+        self.stop_ids = [stop.id for stop in stops]
+        self.names = [stop.stop_name for stop in stops]
+        self.coords = [(stop.lat, stop.lng) for stop in stops]
+        self.projection = LocalProjection(stops[0].lat) if stops else None
+        self.xy = [self.projection.to_xy(lat, lng) for lat, lng in self.coords] if stops else []
+
+        self.cumulative = [0.0]
+        for (ax, ay), (bx, by) in zip(self.xy, self.xy[1:]):
+            self.cumulative.append(self.cumulative[-1] + ((bx - ax) ** 2 + (by - ay) ** 2) ** 0.5)
+
+        self.crossed = [bool(pending_crossed.get(stop.id, stop.is_crossed)) for stop in stops]
+        self.progress = None
+        if any(self.crossed):
+            last_crossed = max(i for i, crossed in enumerate(self.crossed) if crossed)
+            self.progress = self.cumulative[last_crossed]
+        self.awaiting_start = False
+        # Version at which the stop list was loaded and at which each stop's
+        # flag last changed, for clients that only want what changed.
+        self.loaded_version = version
+        self.changed = [version] * len(stops)
+
+    @property
+    def length(self):
+        return self.cumulative[-1] if self.cumulative else 0.0
+
+    def next_stop(self):
+        for i, crossed in enumerate(self.crossed):
+            if not crossed:
+                return i
+        return None
+
+
+class RouteProgressEngine:
+    """
+    Tracks each bus along the polyline of its ordered BusStops and sets
+    BusStop.is_crossed as stops are passed.
+
+    A fix is projected onto each route segment, preferring segments at or
+    ahead of the current progress so that a route which doubles back on
+    itself does not jump backwards. Progress never
+    decreases within a trip. When the final stop is reached all stops are
+    reset, and the next trip starts once the bus is back on the first
+    segment. Changed flags are persisted by the write-behind flusher.
+
+    Every route load and every update that changes a flag takes a new
+    version from one engine-wide counter, so ``stop_changes`` can tell a
+    client exactly which stops changed since the version it last saw.
+    """
+
+    def __init__(self, arrival_radius_m=40.0, off_route_m=150.0, backtrack_m=100.0):
+        self.arrival_radius_m = arrival_radius_m
+        self.off_route_m = off_route_m
+        self.backtrack_m = backtrack_m
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._dirty = {}
+        self._version = 0
+
+    def route(self, bus_id):
+        with self._lock:
+            state = self._routes.get(bus_id)
+        if state is not None:
+            return state
+
+        stops = BusStop.query.filter_by(bus_id=bus_id).order_by(BusStop.stop_order).all()
+        with self._lock:
+            if bus_id in self._routes:
+                return self._routes[bus_id]
+            # Flags not yet flushed are newer than the rows just read.
+            self._version += 1
+            state = RouteState(stops, self._dirty, self._version)
+            self._routes[bus_id] = state
+            return state
+
+    def invalidate(self, bus_id):
+        with self._lock:
+            self._routes.pop(bus_id, None)
+
+    @staticmethod
+    def _stop_dict(state, i):
+        lat, lng = state.coords[i]
+        return {
+            'stop_id': state.stop_ids[i],
+            'stop_name': state.names[i],
+            'lat': lat,
+            'lng': lng,
+            'is_crossed': state.crossed[i]
+        }
+
+    def stops(self, bus_id):
+        state = self.route(bus_id)
+        with self._lock:
+            return [self._stop_dict(state, i) for i in range(len(state.stop_ids))]
+
+    def stop_changes(self, bus_id, since=None):
+        """
+        (version, stops) where stops holds only the stops whose state
+        changed after version ``since``. Stops is None when the client has
+        to reload every stop, because it has no version, the route was
+        reloaded since, or the version is from before a restart.
+        """
+        state = self.route(bus_id)
+        with self._lock:
+            version = max(state.changed, default=state.loaded_version)
+            if since is None or since < state.loaded_version or since > self._version:
+                return version, None
+            return version, [self._stop_dict(state, i) for i, changed in enumerate(state.changed) if changed > since]
+
+    def distance_to_next_stop(self, bus_id):
+        """
+        Metres along the route from the bus to its next stop, or None when
+        the bus is not currently on a trip
+        """
+        state = self.route(bus_id)
+        with self._lock:
+            next_stop = state.next_stop()
+            if state.progress is None or next_stop is None:
+                return None
+            return max(state.cumulative[next_stop] - state.progress, 0.0)
+
+    def _project(self, state, x, y):
+        best = None
+        for i in range(len(state.xy) - 1):
+            ax, ay = state.xy[i]
+            bx, by = state.xy[i + 1]
+            offset, t = point_segment_distance(x, y, ax, ay, bx, by)
+            along = state.cumulative[i] + t * (state.cumulative[i + 1] - state.cumulative[i])
+            if state.progress is not None and along < state.progress - self.backtrack_m:
+                continue
+            if best is None or offset < best[0]:
+                best = (offset, along, i)
+        return best
+
+    def update(self, bus_id, lat, lng):
+        state = self.route(bus_id)
+        if not state.stop_ids:
+            return ProgressUpdate(None, None, None, [], False)
+
+        with self._lock:
+            x, y = state.projection.to_xy(lat, lng)
+            if len(state.xy) == 1:
+                offset = ((x - state.xy[0][0]) ** 2 + (y - state.xy[0][1]) ** 2) ** 0.5
+                best = (offset, 0.0, 0)
+            else:
+                best = self._project(state, x, y)
+
+            if best is None or best[0] > self.off_route_m:
+                offset = best[0] if best else None
+                return ProgressUpdate(state.progress, offset, state.next_stop(), [], False)
+
+            offset, along, segment = best
+            if state.awaiting_start:
+                near_first = ((x - state.xy[0][0]) ** 2 + (y - state.xy[0][1]) ** 2) ** 0.5 <= self.arrival_radius_m
+                if segment != 0 and not near_first:
+                    return ProgressUpdate(None, offset, 0, [], False)
+                state.awaiting_start = False
+
+            state.progress = max(state.progress or 0.0, along)
+
+            newly_crossed = []
+            version = self._version + 1
+            reached_by_proximity = False
+            for i, crossed in enumerate(state.crossed):
+                if crossed:
+                    continue
+                if state.progress < state.cumulative[i] - self.arrival_radius_m:
+                    # Only the next stop may also be reached by proximity, so a
+                    # later stop that happens to lie nearby is not skipped to.
+                    sx, sy = state.xy[i]
+                    if reached_by_proximity or ((x - sx) ** 2 + (y - sy) ** 2) ** 0.5 > self.arrival_radius_m:
+                        break
+                    reached_by_proximity = True
+                state.crossed[i] = True
+                state.changed[i] = version
+                newly_crossed.append(i)
+                self._dirty[state.stop_ids[i]] = True
+
+            completed = state.crossed[-1]
+            if completed:
+                for i, stop_id in enumerate(state.stop_ids):
+                    state.crossed[i] = False
+                    state.changed[i] = version
+                    self._dirty[stop_id] = False
+                state.progress = None
+                state.awaiting_start = True
+            if newly_crossed:
+                self._version = version
+
+            return ProgressUpdate(state.progress, offset, state.next_stop(), newly_crossed, completed)
+
+    def flush(self):
+        with self._lock:
+            pending = self._dirty
+            self._dirty = {}
+
+        if not pending:
+            return 0
+
+        try:
+            # Core UPDATE rather than the ORM bulk form, so a stop deleted
+            # since it was marked simply matches no row.
+            table = BusStop.__table__
+            db.session.execute(
+                update(table).where(table.c.id == bindparam('stop_id')).values(is_crossed=bindparam('crossed')),
+                [{'stop_id': stop_id, 'crossed': crossed} for stop_id, crossed in pending.items()]
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for stop_id, crossed in pending.items():
+                    self._dirty.setdefault(stop_id, crossed)
+            raise
+
+        return len(pending)
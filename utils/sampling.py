@@ -0,0 +1,24 @@
+PARKED_SPEED_MPS = 0.5
+APPROACH_DISTANCE_M = 300.0
+MOVING_INTERVAL_WATCHED = 5
+MOVING_INTERVAL_UNWATCHED = 20
+PARKED_INTERVAL_WATCHED = 30
+
+
+def recommend_interval(speed_mps, distance_to_stop_m, watchers, min_interval=3, max_interval=60):
+    """
+    Seconds until the driver app should send its next fix.
+
+    A parked bus nobody is watching reports at the slowest rate. A moving
+    bus reports faster while someone watches it, and while approaching a
+    stop it reports at least twice before it is expected to get there, so
+    stop crossings and arrival alerts stay accurate.
+    """
+    if speed_mps is None or speed_mps < PARKED_SPEED_MPS:
+        interval = PARKED_INTERVAL_WATCHED if watchers else max_interval
+    else:
+        interval = MOVING_INTERVAL_WATCHED if watchers else MOVING_INTERVAL_UNWATCHED
+        if distance_to_stop_m is not None and distance_to_stop_m <= APPROACH_DISTANCE_M:
+            interval = min(interval, distance_to_stop_m / speed_mps / 2)
+
+    return int(max(min_interval, min(max_interval, interval)))
@@ -0,0 +1,33 @@
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from flask_migrate import stamp
+from sqlalchemy import inspect
+
+
+def prepare_schema(db, migrations_dir):
+    """
+    Get the database ready at startup and return whether its schema
+    matches the models.
+
+    A new, empty database is created from the models and stamped at the
+    latest migration. A database that Alembic manages is left to
+    ``flask db upgrade``: creating the newer tables here would make those
+    migrations fail, so when it is behind this only warns. Databases from
+    before migrations were used keep getting create_all().
+    """
+    with db.engine.connect() as connection:
+        tables = inspect(connection).get_table_names()
+        current = set(MigrationContext.configure(connection).get_current_heads())
+
+    if 'alembic_version' not in tables:
+        db.create_all()
+        if not tables:
+            stamp(directory=migrations_dir)
+        return True
+
+    heads = set(ScriptDirectory(migrations_dir).get_heads())
+    if current != heads:
+        print(f"Database schema is at {', '.join(sorted(current)) or 'no revision'}, "
+              f"expected {', '.join(sorted(heads))}; run 'flask db upgrade'")
+        return False
+    return True
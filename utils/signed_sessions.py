@@ -0,0 +1,152 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, SessionGeneration
+
+TOKEN_VERSION = 's1'
+CHANGE_LOOKBACK = timedelta(seconds=30)
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _signature(secret_key, payload):
+    return hmac.new(secret_key.encode(), b'session:' + payload, hashlib.sha256).digest()
+
+
+def sign_session_token(secret_key, role, principal_id, generation, max_age):
+    """
+    A session token carrying the role, principal id, session generation and
+    expiry, signed with HMAC-SHA256 so it can be checked without a lookup
+    """
+    expires = int(time.time()) + max_age
+    payload = f'{role}:{int(principal_id)}:{int(generation)}:{expires}:{secrets.token_hex(8)}'.encode()
+    return f'{TOKEN_VERSION}.{_b64encode(payload)}.{_b64encode(_signature(secret_key, payload))}'
+
+
+def parse_session_token(secret_key, token):
+    """
+    (role, principal_id, generation, expires) from a token whose signature
+    checks out, else None. Expiry and generation are left to the caller.
+    """
+    try:
+        version, payload, signature = token.split('.')
+        if version != TOKEN_VERSION:
+            return None
+        payload = _b64decode(payload)
+        if not hmac.compare_digest(_b64decode(signature), _signature(secret_key, payload)):
+            return None
+        role, principal_id, generation, expires, _ = payload.decode().split(':')
+        return role, int(principal_id), int(generation), int(expires)
+    except (AttributeError, ValueError, UnicodeDecodeError):
+        return None
+
+
+class SessionGenerations:
+    """
+    In-memory copy of the SessionGeneration table. A signed token is only
+    valid while its generation is the principal's current one, so bumping
+    the generation on login and logout revokes every older token.
+
+    Other processes pick up bumps by reading the rows changed since their
+    last refresh, at most once every ``refresh_interval`` seconds, or at
+    once when they see a token from a newer generation than they know.
+    """
+
+    def __init__(self, refresh_interval=5):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._generations = {}
+        self._changed_since = None
+        self._refreshed_at = None
+
+    def _merge(self, rows):
+        for role, principal_id, generation, updated_at in rows:
+            key = (role, principal_id)
+            if generation > self._generations.get(key, 0):
+                self._generations[key] = generation
+            if self._changed_since is None or updated_at > self._changed_since:
+                self._changed_since = updated_at
+
+    def refresh(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._refreshed_at is not None and now - self._refreshed_at < self.refresh_interval:
+                return
+            self._refreshed_at = now
+            changed_since = self._changed_since
+
+        query = db.session.query(
+            SessionGeneration.role, SessionGeneration.principal_id,
+            SessionGeneration.generation, SessionGeneration.updated_at
+        )
+        if changed_since is not None:
+            # Look back a little so a bump committed just after a newer one
+            # is not missed; merging keeps the highest generation, so rows
+            # read twice are harmless.
+            query = query.filter(SessionGeneration.updated_at >= changed_since - CHANGE_LOOKBACK)
+        rows = query.all()
+
+        with self._lock:
+            self._merge(rows)
+
+    def current(self, role, principal_id):
+        self.refresh()
+        with self._lock:
+            return self._generations.get((role, int(principal_id)), 0)
+
+    def bump(self, role, principal_id):
+        """
+        Start a new generation for a principal, revoking its earlier
+        tokens, and return it. Commits the current session.
+        """
+        principal_id = int(principal_id)
+        now = datetime.utcnow()
+        for attempt in range(2):
+            updated = SessionGeneration.query.filter_by(role=role, principal_id=principal_id).update(
+                {'generation': SessionGeneration.generation + 1, 'updated_at': now},
+                synchronize_session=False
+            )
+            if not updated:
+                db.session.add(SessionGeneration(role=role, principal_id=principal_id, generation=1, updated_at=now))
+            try:
+                db.session.commit()
+                break
+            except IntegrityError:
+                # another process created the row first; bump that one
+                db.session.rollback()
+                if attempt:
+                    raise
+
+        generation = db.session.query(SessionGeneration.generation).filter_by(
+            role=role, principal_id=principal_id
+        ).scalar()
+        with self._lock:
+            self._merge([(role, principal_id, generation, now)])
+        return generation
+
+    def is_current(self, role, principal_id, generation):
+        known = self.current(role, principal_id)
+        if generation > known:
+            # issued by another process since our last refresh
+            row = db.session.query(
+                SessionGeneration.role, SessionGeneration.principal_id,
+                SessionGeneration.generation, SessionGeneration.updated_at
+            ).filter_by(role=role, principal_id=int(principal_id)).first()
+            if row is not None:
+                with self._lock:
+                    self._merge([tuple(row)])
+                    known = self._generations.get((role, int(principal_id)), 0)
+        return generation == known
@@ -0,0 +1,112 @@
+import math
+import threading
+
+from utils.geo import haversine_m
+
+METRES_PER_DEGREE = 111320.0
+
+
+class GridIndex:
+    """
+    Uniform grid of roughly ``cell_m`` square cells for radius queries over
+    points that move or change one at a time.
+
+    Rows are fixed bands of latitude and each row's longitude step is
+    scaled by the cosine of its latitude, so cells stay close to square
+    anywhere on the globe. A radius query only visits the handful of cells
+    that overlap the search circle, and the index is filled lazily by
+    ``loader`` on first use.
+    """
+
+    def __init__(self, cell_m=250.0, loader=None):
+        self.cell_m = cell_m
+        self.loader = loader
+        self._lat_step = cell_m / METRES_PER_DEGREE
+        self._lock = threading.RLock()
+        self._cells = {}
+        self._points = {}
+        self._loaded = loader is None
+
+    def _lng_step(self, row):
+        lat = min(abs((row + 0.5) * self._lat_step), 89.0)
+        return self._lat_step / math.cos(math.radians(lat))
+
+    def _cell(self, lat, lng):
+        row = math.floor(lat / self._lat_step)
+        return row, math.floor(lng / self._lng_step(row))
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            for key, lat, lng, payload in self.loader():
+                self._insert(key, lat, lng, payload)
+            self._loaded = True
+
+    def reset(self):
+        """
+        Drop everything and reload from ``loader`` on the next query
+        """
+        with self._lock:
+            self._cells.clear()
+            self._points.clear()
+            self._loaded = self.loader is None
+
+    def _insert(self, key, lat, lng, payload):
+        self._remove(key)
+        cell = self._cell(lat, lng)
+        self._points[key] = (lat, lng, payload, cell)
+        self._cells.setdefault(cell, set()).add(key)
+
+    def _remove(self, key):
+        point = self._points.pop(key, None)
+        if point is None:
+            return
+        members = self._cells.get(point[3])
+        if members is not None:
+            members.discard(key)
+            if not members:
+                del self._cells[point[3]]
+
+    def insert(self, key, lat, lng, payload=None):
+        with self._lock:
+            if self._loaded:
+                self._insert(key, lat, lng, payload)
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._points)
+
+    def nearby(self, lat, lng, radius_m, limit=None):
+        """
+        (distance_m, key, lat, lng, payload) for every point within
+        ``radius_m`` of the given position, nearest first
+        """
+        self._ensure_loaded()
+        lat_span = radius_m / METRES_PER_DEGREE
+        row_min = math.floor((lat - lat_span) / self._lat_step)
+        row_max = math.floor((lat + lat_span) / self._lat_step)
+
+        results = []
+        with self._lock:
+            for row in range(row_min, row_max + 1):
+                lng_step = self._lng_step(row)
+                row_lat = min(abs(lat) + lat_span, 89.0)
+                lng_span = lat_span / math.cos(math.radians(row_lat))
+                col_min = math.floor((lng - lng_span) / lng_step)
+                col_max = math.floor((lng + lng_span) / lng_step)
+                for col in range(col_min, col_max + 1):
+                    for key in self._cells.get((row, col), ()):
+                        point_lat, point_lng, payload, _ = self._points[key]
+                        distance = haversine_m(lat, lng, point_lat, point_lng)
+                        if distance <= radius_m:
+                            results.append((distance, key, point_lat, point_lng, payload))
+
+        results.sort(key=lambda result: result[0])
+        return results[:limit] if limit else results
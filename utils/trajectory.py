@@ -0,0 +1,257 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert
+
+from models import db, BusTrackBlock
+from utils.geo import LocalProjection, point_segment_distance
+
+COORD_SCALE = 100000
+STATIONARY_KEEP_SECONDS = 60
+# closed days are folded into one row at most this often, this many at a time
+COMPACT_INTERVAL = 300
+COMPACT_BATCH = 20
+
+
+def _write_varint(out, value):
+    # Zigzag so that small negative deltas stay small.
+    value = (value << 1) ^ (value >> 63)
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return (result >> 1) ^ -(result & 1), pos
+
+
+def encode_chunk(points):
+    """
+    Encode (seconds_of_day, lat_e5, lng_e5) tuples as a count followed by
+    zigzag varint deltas. Chunks are self-contained so a day's chunks
+    decode as one block when concatenated.
+    """
+    out = bytearray()
+    _write_varint(out, len(points))
+    prev_t = prev_lat = prev_lng = 0
+    for t, lat, lng in points:
+        _write_varint(out, t - prev_t)
+        _write_varint(out, lat - prev_lat)
+        _write_varint(out, lng - prev_lng)
+        prev_t, prev_lat, prev_lng = t, lat, lng
+    return bytes(out)
+
+
+def decode_block(data):
+    points = []
+    pos = 0
+    while pos < len(data):
+        count, pos = _read_varint(data, pos)
+        t = lat = lng = 0
+        for _ in range(count):
+            dt, pos = _read_varint(data, pos)
+            dlat, pos = _read_varint(data, pos)
+            dlng, pos = _read_varint(data, pos)
+            t += dt
+            lat += dlat
+            lng += dlng
+            points.append((t, lat, lng))
+    return points
+
+
+def simplify(points, tolerance_m):
+    """
+    Douglas-Peucker simplification of (timestamp, lat, lng) points, keeping
+    every point that deviates from the simplified line by more than
+    ``tolerance_m`` metres
+    """
+    if len(points) < 3 or tolerance_m <= 0:
+        return list(points)
+
+    projection = LocalProjection(points[0][1])
+    xy = [projection.to_xy(lat, lng) for _, lat, lng in points]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        ax, ay = xy[first]
+        bx, by = xy[last]
+        max_dist = 0.0
+        index = None
+        for i in range(first + 1, last):
+            dist, _ = point_segment_distance(xy[i][0], xy[i][1], ax, ay, bx, by)
+            if dist > max_dist:
+                max_dist = dist
+                index = i
+        if index is not None and max_dist > tolerance_m:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+class TrajectoryStore:
+    """
+    Append-only per-bus, per-day trajectory history.
+
+    Fixes are buffered in memory and each write-behind flush inserts one
+    new BusTrackBlock chunk row per bus per day, so a flush writes only the
+    new points however long the day's track has grown. Coordinates are
+    stored at 1e-5 degree (about one metre) and times at one second
+    resolution, delta and varint encoded, so a moving bus costs a few bytes
+    per ping. Repeated fixes from a parked bus are kept only once a minute.
+    Once a day is over its chunks are folded into a single row, so history
+    costs one row per bus per day.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_kept = {}
+        self._next_compaction = time.monotonic() + COMPACT_INTERVAL
+
+    def append(self, bus_id, lat, lng, recorded_at):
+        day = recorded_at.date()
+        seconds = recorded_at.hour * 3600 + recorded_at.minute * 60 + recorded_at.second
+        point = (seconds, round(lat * COORD_SCALE), round(lng * COORD_SCALE))
+
+        with self._lock:
+            last = self._last_kept.get(bus_id)
+            if last is not None:
+                last_day, last_point = last
+                if (last_day == day and last_point[1:] == point[1:]
+                        and 0 <= seconds - last_point[0] < STATIONARY_KEEP_SECONDS):
+                    return False
+            self._last_kept[bus_id] = (day, point)
+            self._pending.setdefault((bus_id, day), []).append(point)
+        return True
+
+    def forget_bus(self, bus_id):
+        with self._lock:
+            self._last_kept.pop(bus_id, None)
+            for key in [key for key in self._pending if key[0] == bus_id]:
+                del self._pending[key]
+
+    def flush(self):
+        flushed = self._flush_pending()
+        if time.monotonic() >= self._next_compaction:
+            self._next_compaction = time.monotonic() + COMPACT_INTERVAL
+            self.compact(datetime.utcnow().date())
+        return flushed
+
+    def _flush_pending(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+
+        if not pending:
+            return 0
+
+        bus_ids = {bus_id for bus_id, _ in pending}
+        days = {day for _, day in pending}
+
+        try:
+            last_seq = {
+                (bus_id, day): seq
+                for bus_id, day, seq in db.session.query(
+                    BusTrackBlock.bus_id, BusTrackBlock.day, func.max(BusTrackBlock.seq)
+                ).filter(
+                    BusTrackBlock.bus_id.in_(bus_ids),
+                    BusTrackBlock.day.in_(days)
+                ).group_by(BusTrackBlock.bus_id, BusTrackBlock.day)
+            }
+            db.session.execute(insert(BusTrackBlock.__table__), [{
+                'bus_id': bus_id,
+                'day': day,
+                'seq': last_seq.get((bus_id, day), -1) + 1,
+                'point_count': len(points),
+                'data': encode_chunk(points)
+            } for (bus_id, day), points in pending.items()])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for key, points in pending.items():
+                    self._pending[key] = points + self._pending.get(key, [])
+            raise
+
+        return sum(len(points) for points in pending.values())
+
+    def compact(self, before_day, limit=COMPACT_BATCH):
+        """
+        Fold the chunks of up to ``limit`` bus-days before ``before_day``
+        into the day's first row, one transaction per bus-day. Returns the
+        number of bus-days folded.
+        """
+        days = db.session.query(BusTrackBlock.bus_id, BusTrackBlock.day).filter(
+            BusTrackBlock.day < before_day
+        ).group_by(BusTrackBlock.bus_id, BusTrackBlock.day).having(func.count() > 1).limit(limit).all()
+
+        table = BusTrackBlock.__table__
+        for bus_id, day in days:
+            chunks = BusTrackBlock.query.filter_by(bus_id=bus_id, day=day).order_by(BusTrackBlock.seq).all()
+            first = chunks[0]
+            first.data = b''.join(chunk.data for chunk in chunks)
+            first.point_count = sum(chunk.point_count or 0 for chunk in chunks)
+            db.session.execute(delete(table).where(table.c.id.in_([chunk.id for chunk in chunks[1:]])))
+            db.session.commit()
+        return len(days)
+
+    def points(self, bus_id, start, end):
+        """
+        All recorded (datetime, lat, lng) fixes for a bus between ``start``
+        and ``end`` inclusive, in time order
+        """
+        blocks = BusTrackBlock.query.filter(
+            BusTrackBlock.bus_id == bus_id,
+            BusTrackBlock.day >= start.date(),
+            BusTrackBlock.day <= end.date()
+        ).order_by(BusTrackBlock.day, BusTrackBlock.seq).all()
+        encoded = [(block.day, decode_block(block.data)) for block in blocks]
+
+        with self._lock:
+            encoded.extend(
+                (day, list(points)) for (pending_bus, day), points in self._pending.items()
+                if pending_bus == bus_id and start.date() <= day <= end.date()
+            )
+
+        result = []
+        for day, day_points in encoded:
+            midnight = datetime(day.year, day.month, day.day)
+            for seconds, lat, lng in day_points:
+                recorded_at = midnight + timedelta(seconds=seconds)
+                if start <= recorded_at <= end:
+                    result.append((recorded_at, lat / COORD_SCALE, lng / COORD_SCALE))
+
+        result.sort(key=lambda point: point[0])
+        return result
+
+
+def downsample(points, tolerance_m=0, max_points=None):
+    """
+    Simplify with ``tolerance_m`` and, if a ``max_points`` cap is given,
+    keep doubling the tolerance until the result fits under it
+    """
+    result = simplify(points, tolerance_m)
+    if not max_points or max_points < 2:
+        return result
+
+    tolerance = max(tolerance_m, 5.0)
+    while len(result) > max_points and tolerance < 100000:
+        tolerance *= 2
+        result = simplify(points, tolerance)
+    return result